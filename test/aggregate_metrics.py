@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cross-shard aggregation of hit-rate evaluation metrics
+Each evaluator shard writes a JSON file with its sample count and per-metric
+sums (--metrics_file); this script combines them into exact sample-weighted
+global metrics. Metrics can also be recomputed from per-sample result parts
+written with --results_dir, without regenerating anything.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+SHARD_FORMAT_VERSION = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Aggregate per-shard hit-rate metrics")
+    parser.add_argument("--shard_files", type=str, nargs="*", default=[],
+                        help="Per-shard metrics JSON files (glob patterns allowed)")
+    parser.add_argument("--results_dir", type=str, default=None,
+                        help="Recompute metrics from per-sample result parts instead")
+    parser.add_argument("--metrics", type=str, default="hit@1,hit@5,hit@10,ndcg@5,ndcg@10",
+                        help="Metrics to recompute from --results_dir, separated by comma")
+    parser.add_argument("--expected_shards", type=int, default=0,
+                        help="Number of shards that should have reported, 0 to skip the check")
+    parser.add_argument("--output_json", type=str, default=None, help="Optional global summary JSON file")
+    return parser.parse_args()
+
+
+def write_shard_metrics(path, num_samples, metric_sums, **info):
+    """Write one shard's sample count and exact per-metric sums"""
+    payload = {
+        "format_version": SHARD_FORMAT_VERSION,
+        "num_samples": num_samples,
+        "metric_sums": {m: float(v) for m, v in metric_sums.items()},
+        "metrics": {m: (float(v) / num_samples if num_samples else 0.0) for m, v in metric_sums.items()},
+    }
+    payload.update(info)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_shards(patterns):
+    paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+    shards = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            shard = json.load(f)
+        if shard.get("format_version") != SHARD_FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard metrics format in {path}: {shard.get('format_version')}")
+        shard["path"] = path
+        shards.append(shard)
+    return shards
+
+
+def aggregate_shards(shards):
+    """Sample-weighted global metrics: sum of per-shard sums over total samples"""
+    total_samples = sum(shard["num_samples"] for shard in shards)
+    metric_names = []
+    for shard in shards:
+        metric_names.extend(m for m in shard["metric_sums"] if m not in metric_names)
+    sums = {m: sum(shard["metric_sums"].get(m, 0.0) for shard in shards) for m in metric_names}
+    metrics = {m: (s / total_samples if total_samples else 0.0) for m, s in sums.items()}
+    return total_samples, sums, metrics
+
+
+def metrics_from_results(results_dir, metrics):
+    """Recompute metric sums from the hit vectors stored by ResultSink"""
+    from result_sink import load_results
+    from topk_metrics import MetricAccumulator
+
+    table = load_results(results_dir, columns=["sample_index", "hits"])
+    _, first = np.unique(np.asarray(table.column("sample_index").to_pylist(), dtype=np.int64), return_index=True)
+    hits = table.column("hits").take(first).to_pylist()
+    accumulator = MetricAccumulator(metrics)
+    accumulator.update_rows(hits)
+    return accumulator.count, accumulator.sums
+
+
+def main():
+    args = parse_args()
+
+    if args.results_dir:
+        metrics = args.metrics.split(",")
+        total_samples, sums = metrics_from_results(args.results_dir, metrics)
+        global_metrics = {m: (s / total_samples if total_samples else 0.0) for m, s in sums.items()}
+        shards = []
+        print(f"Recomputed metrics from per-sample results: {args.results_dir}")
+    else:
+        shards = load_shards(args.shard_files)
+        total_samples, sums, global_metrics = aggregate_shards(shards)
+        print("Per-shard results:")
+        for shard in shards:
+            label = f"GPU {shard['gpu_id']}" if "gpu_id" in shard else os.path.basename(shard["path"])
+            values = ", ".join(f"{m}={v:.4f}" for m, v in shard["metrics"].items())
+            print(f"  {label}: {shard['num_samples']} samples  {values}")
+
+    print("=" * 60)
+    print("🎯 Sample-weighted global results:")
+    print("=" * 60)
+    for metric, value in global_metrics.items():
+        print(f"{metric:>10}: {value:.4f}")
+    print("=" * 60)
+    print(f"Total samples: {total_samples}")
+
+    missing = args.expected_shards - len(shards) if args.expected_shards and not args.results_dir else 0
+    if missing > 0:
+        print(f"❌ Only {len(shards)}/{args.expected_shards} shards reported results")
+
+    if args.output_json:
+        with open(args.output_json, "w", encoding="utf-8") as f:
+            json.dump({
+                "num_samples": total_samples,
+                "num_shards": len(shards),
+                "metric_sums": sums,
+                "metrics": global_metrics,
+            }, f, indent=2)
+        print(f"Summary saved to: {args.output_json}")
+
+    return missing <= 0 and total_samples > 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
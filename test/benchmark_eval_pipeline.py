@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage-by-stage throughput / latency benchmark of the hit-rate evaluators
+Runs the batch path of test_model_hitrate.py and test_model_hitrate_cot.py on
+a synthetic SID catalog with a tiny randomly initialized Qwen3 model, so it
+needs no checkpoint or GPU. Stages are timed with the evaluators' own hooks
+(eval_hooks.py): tokenize, prefill and decode steps of every generate() call,
+SIDLogitsProcessor calls, token-to-item mapping and metrics, plus thinking
+generation and top-10 re-ranking for CoT. Reports samples/s, tokens/s, the
+constraint share of generation time and peak memory as JSON:
+    python3 benchmark_eval_pipeline.py --num_items 5000 --num_samples 32 --output_json bench.json
+"""
+
+import argparse
+import json
+import logging
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from eval_hooks import EvalHooks, timed
+from sid_constraint import SIDLogitsProcessor
+from sid_trie import SIDTrie
+from topk_metrics import ItemIndex, MetricAccumulator, topk_hit_matrix
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<think>", "</think>", "<|sid_begin|>", "<|sid_end|>"]
+FILLER_WORDS = ["the", "user", "bought", "item", "items", "category", "beauty", "skin", "hair", "nail",
+                "likely", "to", "buy", "next", "in", ":", ",", "."]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stage-by-stage benchmark of the hit-rate evaluation pipeline")
+    parser.add_argument("--evaluators", type=str, default="hitrate,cot",
+                        help="Evaluators to benchmark (hitrate, cot), separated by comma")
+    parser.add_argument("--num_items", type=int, default=5000, help="Synthetic catalog size")
+    parser.add_argument("--codebook_size", type=int, default=256, help="Codes per SID level")
+    parser.add_argument("--num_samples", type=int, default=32, help="Timed test samples")
+    parser.add_argument("--history_length", type=int, default=20, help="Purchased items per user description")
+    parser.add_argument("--hidden_size", type=int, default=64, help="Hidden size of the random model")
+    parser.add_argument("--num_layers", type=int, default=2, help="Layers of the random model")
+    parser.add_argument("--batch_size", type=int, default=4, help="Prompts per batch")
+    parser.add_argument("--num_beams", type=int, default=10, help="Beams per prompt (hitrate)")
+    parser.add_argument("--max_new_tokens", type=int, default=6, help="New tokens per beam (hitrate)")
+    parser.add_argument("--num_thinking_samples", type=int, default=2, help="Thinking samples per prompt (cot)")
+    parser.add_argument("--num_beams_per_sample", type=int, default=5, help="Beams per thinking sample (cot)")
+    parser.add_argument("--think_max_tokens", type=int, default=32, help="Thinking tokens (cot)")
+    parser.add_argument("--sid_max_tokens", type=int, default=8, help="SID tokens (cot)")
+    parser.add_argument("--device", type=str, default="cpu", help="Device of the random model")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output_json", type=str, default=None, help="Optional JSON result file")
+    return parser.parse_args()
+
+
+def build_tokenizer(codebook_size, path):
+    """Word-level tokenizer with the chat / think / SID special tokens the evaluators rely on"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+
+    specials = SPECIAL_TOKENS + [f"<s_{level}_{i}>" for level in "abc" for i in range(codebook_size)]
+    vocab = {}
+    for token in specials + FILLER_WORDS + ["\n", "[UNK]"]:
+        vocab.setdefault(token, len(vocab))
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split("\n", "isolated"),
+        pre_tokenizers.Split(" ", "removed"),
+    ])
+    backend.add_special_tokens(specials)
+    backend.decoder = decoders.WordPiece(prefix="##", cleanup=False)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<|im_end|>",
+                                        pad_token="<|endoftext|>", unk_token="[UNK]")
+    tokenizer.model_max_length = 8192
+    # Round trip through disk so the tokenizer loads exactly like a checkpoint's
+    tokenizer.save_pretrained(path)
+    from test_model_hitrate import load_tokenizer
+    return load_tokenizer(path)
+
+
+def build_model(tokenizer, args):
+    """Tiny randomly initialized Qwen3-architecture model over the synthetic vocabulary"""
+    from transformers import Qwen3Config, Qwen3ForCausalLM
+
+    num_heads = max(1, args.hidden_size // 16)
+    config = Qwen3Config(
+        vocab_size=len(tokenizer), hidden_size=args.hidden_size, intermediate_size=2 * args.hidden_size,
+        num_hidden_layers=args.num_layers, num_attention_heads=num_heads,
+        num_key_value_heads=max(1, num_heads // 2), head_dim=16, max_position_embeddings=8192,
+        eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(args.seed)
+    return Qwen3ForCausalLM(config).to(args.device).eval()
+
+
+def build_catalog(args, tokenizer):
+    """Random SID strings, their prefix trie and user descriptions with targets"""
+    rng = random.Random(args.seed)
+    c = args.codebook_size
+    sids = set()
+    while len(sids) < min(args.num_items, c ** 3):
+        sids.add(f"<|sid_begin|><s_a_{rng.randrange(c)}><s_b_{rng.randrange(c)}><s_c_{rng.randrange(c)}><|sid_end|>")
+    sids = sorted(sids)
+    token_ids = [tokenizer(sid, add_special_tokens=False)["input_ids"] for sid in sids]
+    trie = SIDTrie.build(token_ids, sids)
+
+    samples = []
+    for _ in range(args.num_samples + args.batch_size):
+        history = rng.sample(sids, min(args.history_length, len(sids)))
+        description = "the user bought : " + " , ".join(f"item {sid} category beauty" for sid in history)
+        samples.append((description, rng.choice(sids)))
+    # The first batch only warms up
+    return trie, samples[:args.batch_size], samples[args.batch_size:]
+
+
+def peak_memory():
+    """Process peak RSS (and CUDA peak allocation) in MB"""
+    peak = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if torch.cuda.is_available():
+        peak["peak_cuda_allocated_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    return peak
+
+
+def hitrate_batch(model, tokenizer, processor, batch, args, hooks, item_index, accumulator):
+    from generation_planner import generate_in_sub_batches
+    from test_model_hitrate import format_chat_prompt
+
+    descriptions = [description for description, _ in batch]
+    with timed(hooks, "tokenize"):
+        enc = tokenizer([format_chat_prompt(d) for d in descriptions], return_tensors="pt", padding=True,
+                        truncation=True, max_length=tokenizer.model_max_length)
+    enc = {k: v.to(model.device) for k, v in enc.items()}
+    generate_kwargs = {
+        "max_new_tokens": args.max_new_tokens,
+        "num_beams": args.num_beams,
+        "num_return_sequences": args.num_beams,
+        "output_scores": True,
+        "return_dict_in_generate": True,
+        "early_stopping": True,
+    }
+    items, scores = generate_in_sub_batches(model, enc, [(0, len(batch))], generate_kwargs, processor,
+                                            logging.getLogger(__name__), hooks)
+    with timed(hooks, "metrics"):
+        accumulator.update(topk_hit_matrix(
+            items.reshape(len(batch), args.num_beams),
+            np.asarray(scores, dtype=np.float64).reshape(len(batch), args.num_beams),
+            item_index.lookup([target for _, target in batch]),
+        ))
+    return int(enc["attention_mask"].sum())
+
+
+def cot_batch(model, tokenizer, processor, batch, args, hooks, item_index, accumulator):
+    from generation_planner import GenerationMemoryPlanner
+    from test_model_hitrate_cot import (
+        batch_generate_sid, batch_generate_thinking_optimized, format_chat_prompt_think_stage,
+        process_unique_top10_candidates,
+    )
+
+    logger = logging.getLogger(__name__)
+    descriptions = [description for description, _ in batch]
+    with timed(hooks, "tokenize"):
+        think_ids = [np.asarray(ids) for ids in tokenizer(
+            [format_chat_prompt_think_stage(d) for d in descriptions],
+            truncation=True, max_length=tokenizer.model_max_length
+        )["input_ids"]]
+    thinking, _ = batch_generate_thinking_optimized(model, tokenizer, descriptions, args, logger,
+                                                    think_prompt_ids=think_ids, hooks=hooks)
+    # No budget: the whole batch runs as one generate() call, like hitrate_batch
+    planner = GenerationMemoryPlanner(model.config, model.dtype.itemsize, None)
+    items, scores, keys = batch_generate_sid(model, tokenizer, descriptions, thinking, processor, planner, args,
+                                             logger, hooks)
+    with timed(hooks, "rerank"):
+        items, scores = process_unique_top10_candidates(items, scores,
+                                                        args.num_thinking_samples * args.num_beams_per_sample, keys)
+    with timed(hooks, "metrics"):
+        accumulator.update(topk_hit_matrix(
+            items, np.asarray(scores, dtype=np.float64).reshape(len(batch), 10),
+            item_index.lookup([target for _, target in batch]),
+        ))
+    return sum(len(ids) for ids in think_ids) * args.num_thinking_samples
+
+
+def make_processor(evaluator, tokenizer, trie):
+    """The evaluator's SID constraint configuration"""
+    if evaluator == "hitrate":
+        sep = tokenizer("</think>", add_special_tokens=False)["input_ids"]
+        lead = tokenizer.encode("\n", add_special_tokens=False)
+        return SIDLogitsProcessor(trie, sep, tokenizer.eos_token_id, lead_tokens=lead)
+    sep = tokenizer("</think>\n", add_special_tokens=False)["input_ids"]
+    return SIDLogitsProcessor(trie, sep, tokenizer.eos_token_id, fallback_allow_all=True)
+
+
+def run_benchmark(evaluator, model, tokenizer, trie, warmup, samples, args):
+    run_batch = hitrate_batch if evaluator == "hitrate" else cot_batch
+    processor = make_processor(evaluator, tokenizer, trie)
+    item_index = ItemIndex(trie.sids)
+    batches = [samples[i:i + args.batch_size] for i in range(0, len(samples), args.batch_size)]
+
+    with torch.no_grad():
+        run_batch(model, tokenizer, processor, warmup, args, None, item_index, MetricAccumulator(["hit@1"]))
+        # Same hooks as run_evaluation --timing_file, without a sink
+        hooks = EvalHooks()
+        accumulator = MetricAccumulator(["hit@1", "hit@5", "hit@10", "ndcg@10"])
+        prompt_tokens = 0
+        start = time.perf_counter()
+        for step, batch in enumerate(batches):
+            prompt_tokens += run_batch(model, tokenizer, processor, batch, args, hooks, item_index, accumulator)
+            hooks.end_batch(step, len(batch))
+        wall = time.perf_counter() - start
+
+    seconds = hooks.total_seconds
+    counts = hooks.total_counts
+    generation = seconds["sid_prefill"] + seconds["sid_decode"]
+    return {
+        "num_samples": len(samples),
+        "wall_seconds": wall,
+        "samples_per_sec": len(samples) / wall,
+        "prompt_tokens": prompt_tokens,
+        "prompt_tokens_per_sec": prompt_tokens / wall,
+        "beam_tokens": counts["sid_rows"],
+        "beam_tokens_per_sec": counts["sid_rows"] / generation if generation > 0 else 0.0,
+        "stage_seconds": dict(seconds),
+        "stage_share": {stage: value / wall for stage, value in seconds.items()},
+        "counts": dict(counts),
+        "constraint_calls": counts["constraint_calls"],
+        "constraint_seconds": seconds["constraint"],
+        "constraint_ms_per_call": seconds["constraint"] / max(counts["constraint_calls"], 1) * 1000,
+        "constraint_share_of_generation": seconds["constraint"] / generation if generation > 0 else 0.0,
+        "metrics": accumulator.results(),
+        **peak_memory(),
+    }
+
+
+def main():
+    args = parse_args()
+    evaluators = args.evaluators.split(",")
+    for evaluator in evaluators:
+        if evaluator not in ("hitrate", "cot"):
+            raise ValueError(f"Unknown evaluator: {evaluator}")
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    # Evaluator functions log at INFO on every batch; keep them out of the timings
+    logging.getLogger(__name__).addHandler(logging.NullHandler())
+    logging.getLogger(__name__).propagate = False
+
+    # Attributes read by the CoT batch functions
+    args.think_temperature = 1.0
+    args.think_top_p = 0.95
+    args.reuse_think_cache = False
+    args.sid_batch_size = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tokenizer = build_tokenizer(args.codebook_size, tmp)
+    model = build_model(tokenizer, args)
+    print(f"Random Qwen3: {sum(p.numel() for p in model.parameters()) / 1e6:.2f}M parameters, "
+          f"vocab {len(tokenizer):,}, device {args.device}")
+    print(f"Building synthetic catalog with {args.num_items:,} items...")
+    trie, warmup, samples = build_catalog(args, tokenizer)
+
+    results = {}
+    for evaluator in evaluators:
+        print(f"Benchmarking {evaluator}: {len(samples)} samples in batches of {args.batch_size}...")
+        result = run_benchmark(evaluator, model, tokenizer, trie, warmup, samples, args)
+        results[evaluator] = result
+        stages = "  ".join(f"{stage}={seconds:.2f}s" for stage, seconds in result["stage_seconds"].items())
+        print(f"  {result['samples_per_sec']:.2f} samples/s, {result['prompt_tokens_per_sec']:,.0f} prompt tokens/s, "
+              f"{result['beam_tokens_per_sec']:,.0f} beam tokens/s")
+        print(f"  stages: {stages}")
+        print(f"  constraint: {result['constraint_calls']} calls, {result['constraint_ms_per_call']:.2f} ms/call, "
+              f"{result['constraint_share_of_generation']:.1%} of generation; peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    output = {"config": vars(args), "results": results}
+    if args.output_json:
+        with open(args.output_json, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results saved to: {args.output_json}")
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
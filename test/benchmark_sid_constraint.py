@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for one decode step of SID constrained generation
+Compares the legacy per-beam prefix_allowed_tokens_fn callback (which returns
+the full vocabulary as a list for unconstrained rows) with SIDLogitsProcessor
+on a synthetic catalog, for the thinking stage and the SID stage
+"""
+
+import argparse
+import json
+import random
+import time
+
+import torch
+from transformers import AutoTokenizer
+from transformers.generation.logits_process import PrefixConstrainedLogitsProcessor
+
+from sid_constraint import SIDLogitsProcessor
+from sid_trie import SIDTrie
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SID constraint per-step microbenchmark")
+    parser.add_argument("--model_path", type=str, default=None,
+                        help="Tokenizer path; a synthetic vocabulary is used when omitted")
+    parser.add_argument("--vocab_size", type=int, default=152_000, help="Synthetic vocabulary size")
+    parser.add_argument("--num_items", type=int, default=20_000, help="Synthetic catalog size")
+    parser.add_argument("--codebook_size", type=int, default=256, help="Codes per SID level")
+    parser.add_argument("--batch_size", type=int, default=4, help="Prompts per batch")
+    parser.add_argument("--num_beams", type=int, default=10, help="Beams per prompt")
+    parser.add_argument("--prompt_length", type=int, default=2048, help="Prompt tokens per row")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed calls per measurement")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output_json", type=str, default=None, help="Optional JSON result file")
+    return parser.parse_args()
+
+
+class SyntheticVocab:
+    """Stand-in for a tokenizer: get_vocab() returns a fresh dict like HF tokenizers do"""
+
+    def __init__(self, vocab_size):
+        self.vocab = {f"tok_{i}": i for i in range(vocab_size)}
+        self.sid_begin, self.sid_end, self.sep, self.newline, self.eos_token_id = range(5)
+        self.code_base = 16
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+
+def build_catalog(args, vocab):
+    rng = random.Random(args.seed)
+    c = args.codebook_size
+    sequences = set()
+    while len(sequences) < args.num_items:
+        codes = [vocab.code_base + level * c + rng.randrange(c) for level in range(3)]
+        sequences.add(tuple([vocab.sid_begin] + codes + [vocab.sid_end]))
+    return SIDTrie.build(sorted(sequences))
+
+
+def legacy_prefix_allowed_tokens_fn(trie, vocab, sep, lead):
+    """The callback the evaluators used before SIDLogitsProcessor"""
+
+    def find_last_sublist(lst, sub):
+        n, m = len(lst), len(sub)
+        for start in range(n - m, -1, -1):
+            if lst[start:start + m] == sub:
+                return start
+        return None
+
+    def prefix_allowed_tokens_fn(batch_id, sentence):
+        sentence = sentence.tolist()
+        pos = find_last_sublist(sentence, sep)
+        if pos is None:
+            return list(vocab.get_vocab().values())
+        generated_after_sep = sentence[pos + len(sep):]
+        if len(generated_after_sep) < len(lead):
+            return [lead[len(generated_after_sep)]]
+        node = trie.walk(generated_after_sep[len(lead):])
+        if node < 0 or trie.is_terminal(node):
+            return [vocab.eos_token_id]
+        return trie.children(node).tolist()
+
+    return prefix_allowed_tokens_fn
+
+
+def make_inputs(args, vocab, sid_prefix):
+    """Rows of prompt tokens, optionally followed by separator, newline and a SID prefix"""
+    num_rows = args.batch_size * args.num_beams
+    prompt = torch.randint(100_000, 150_000, (num_rows, args.prompt_length))
+    if sid_prefix is None:
+        return prompt
+    tail = torch.tensor([vocab.sep, vocab.newline] + list(sid_prefix)).expand(num_rows, -1)
+    return torch.cat([prompt, tail], dim=1)
+
+
+def time_call(processor, input_ids, vocab_size, repeats, device):
+    input_ids = input_ids.to(device)
+    scores = torch.zeros(input_ids.shape[0], vocab_size, device=device)
+    # The warm-up call is the first step of a generation (prompt scan); timed
+    # calls then measure steady-state decode steps
+    if hasattr(processor, "reset"):
+        processor.reset()
+    processor(input_ids, scores.clone())
+    total = 0.0
+    for _ in range(repeats):
+        fresh = scores.clone()
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        processor(input_ids, fresh)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        total += time.perf_counter() - start
+    return total / repeats * 1000
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+
+    if args.model_path:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+        vocab = SyntheticVocab(0)
+        vocab.get_vocab = tokenizer.get_vocab
+        vocab.sep, = tokenizer("</think>", add_special_tokens=False)["input_ids"]
+        vocab.newline, = tokenizer.encode("\n", add_special_tokens=False)
+        vocab.sid_begin, vocab.sid_end = tokenizer.convert_tokens_to_ids(["<|sid_begin|>", "<|sid_end|>"])
+        vocab.code_base = tokenizer.convert_tokens_to_ids("<s_a_0>")
+        vocab.eos_token_id = tokenizer.eos_token_id
+        vocab_size = len(tokenizer)
+    else:
+        vocab = SyntheticVocab(args.vocab_size)
+        vocab_size = args.vocab_size
+
+    print(f"Building synthetic catalog with {args.num_items:,} items...")
+    trie = build_catalog(args, vocab)
+    sep, lead = [vocab.sep], [vocab.newline]
+
+    legacy = PrefixConstrainedLogitsProcessor(
+        legacy_prefix_allowed_tokens_fn(trie, vocab, sep, lead), args.num_beams
+    )
+    batched = SIDLogitsProcessor(trie, sep, vocab.eos_token_id, lead_tokens=lead)
+
+    node = SIDTrie.ROOT
+    first_sid = []
+    while not trie.is_terminal(node):
+        token = int(trie.children(node)[0])
+        first_sid.append(token)
+        node = trie.step(node, token)
+
+    scenarios = {"thinking (no </think> yet)": None}
+    for depth in range(len(first_sid) + 1):
+        scenarios[f"SID position {depth}"] = first_sid[:depth]
+
+    num_rows = args.batch_size * args.num_beams
+    print(f"Rows per step: {num_rows} ({args.batch_size} prompts x {args.num_beams} beams), "
+          f"prompt length {args.prompt_length}, vocab {vocab_size:,}, device {args.device}")
+    print(f"{'scenario':<30}{'legacy ms/step':>16}{'batched ms/step':>17}{'speedup':>10}")
+
+    results = []
+    for name, sid_prefix in scenarios.items():
+        input_ids = make_inputs(args, vocab, sid_prefix)
+        legacy_ms = time_call(legacy, input_ids, vocab_size, args.repeats, args.device)
+        batched_ms = time_call(batched, input_ids, vocab_size, args.repeats, args.device)
+        print(f"{name:<30}{legacy_ms:>16.2f}{batched_ms:>17.2f}{legacy_ms / batched_ms:>9.1f}x")
+        results.append({"scenario": name, "legacy_ms": legacy_ms, "batched_ms": batched_ms})
+
+    if args.output_json:
+        with open(args.output_json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"Results saved to: {args.output_json}")
+
+
+if __name__ == "__main__":
+    main()
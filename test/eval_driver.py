@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-process driver for multi-GPU hit-rate evaluation
+Replaces the nohup fan-out of eval_parallel_8gpu*.sh. The prefix trie is
+loaded once and handed to the workers in shared memory, the prompt token cache
+is built once (workers memory-map it), row chunks come from one work queue,
+and every evaluated batch is streamed back over a queue, so the driver reports
+live aggregate throughput and metrics and writes the global summary itself.
+
+Evaluator arguments go after "--" and are passed to every worker unchanged:
+    python3 eval_driver.py --evaluator hitrate --num_workers 8 --log_dir logs/run -- \\
+        --merged_model_path MODEL --test_parquet_file test.parquet --global_trie_file trie.npz
+
+With --cpu the workers run on CPU threads instead of one GPU each (for testing).
+"""
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import queue
+import sys
+import time
+import traceback
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from sid_trie import SIDTrie
+from topk_metrics import MetricAccumulator
+from work_queue import DONE, PENDING, RUNNING, WorkQueue, parquet_num_rows
+
+Evaluator = namedtuple("Evaluator", ["module", "template_version", "format_prompt"])
+
+EVALUATORS = {
+    "hitrate": Evaluator("test_model_hitrate", "PROMPT_TEMPLATE_VERSION", "format_chat_prompt"),
+    "cot": Evaluator("test_model_hitrate_cot", "THINK_PROMPT_TEMPLATE_VERSION", "format_chat_prompt_think_stage"),
+}
+
+TRIE_ARRAYS = ["child_offsets", "child_tokens", "child_nodes", "node_item", "edge_keys"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Multi-GPU hit-rate evaluation driver; evaluator arguments follow '--'"
+    )
+    parser.add_argument("--evaluator", type=str, choices=sorted(EVALUATORS), default="hitrate",
+                        help="hitrate (test_model_hitrate.py) or cot (test_model_hitrate_cot.py)")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Worker processes, one per GPU; 0 uses every visible GPU")
+    parser.add_argument("--cpu", action="store_true", help="Run the workers on CPU instead of GPUs")
+    parser.add_argument("--log_dir", type=str, required=True,
+                        help="Directory for per-worker logs, shard metrics and the work queue")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Rows per work queue chunk")
+    parser.add_argument("--report_every", type=float, default=30.0, help="Seconds between progress reports")
+    parser.add_argument("--output_json", type=str, default=None,
+                        help="Global summary JSON file (default: LOG_DIR/summary_results.json)")
+    args, evaluator_argv = parser.parse_known_args(argv)
+    if evaluator_argv[:1] == ["--"]:
+        evaluator_argv = evaluator_argv[1:]
+    return args, evaluator_argv
+
+
+def share_trie(trie):
+    """Trie arrays and SID strings as shared-memory tensors, picklable to spawned workers"""
+    shared = {name: torch.from_numpy(getattr(trie, name)).share_memory_() for name in TRIE_ARRAYS}
+    encoded = [(sid or "").encode("utf-8") for sid in trie.sids]
+    sid_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(sid) for sid in encoded], out=sid_offsets[1:])
+    shared["sid_bytes"] = torch.from_numpy(np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()).share_memory_()
+    shared["sid_offsets"] = torch.from_numpy(sid_offsets).share_memory_()
+    shared["metadata"] = json.dumps(trie.metadata)
+    return shared
+
+
+def trie_from_shared(shared):
+    """SIDTrie whose arrays are views of the driver's shared memory"""
+    arrays = {name: shared[name].numpy() for name in TRIE_ARRAYS}
+    sid_bytes = shared["sid_bytes"].numpy().tobytes()
+    offsets = shared["sid_offsets"].numpy().tolist()
+    sids = [sid_bytes[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+    return SIDTrie(
+        arrays["child_offsets"], arrays["child_tokens"], arrays["child_nodes"], arrays["node_item"],
+        sids, json.loads(shared["metadata"]), edge_keys=arrays["edge_keys"],
+    )
+
+
+def worker_main(rank, evaluator, worker_args, shared_trie, progress_queue, use_cpu, num_threads, out_file):
+    """Evaluate chunks from the work queue on one device, reporting every batch"""
+    # Spawned workers have not touched CUDA yet, so this pins each one to its GPU; the rank
+    # indexes the devices the driver was given, not the physical device ids
+    visible = [device for device in os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",") if device]
+    os.environ["CUDA_VISIBLE_DEVICES"] = "" if use_cpu else (visible[rank] if visible else str(rank))
+    if use_cpu:
+        torch.set_num_threads(num_threads)
+    with open(out_file, "w", encoding="utf-8", buffering=1) as out:
+        sys.stdout = sys.stderr = out
+        try:
+            module = importlib.import_module(EVALUATORS[evaluator].module)
+            module.run_evaluation(worker_args, trie=trie_from_shared(shared_trie), progress_queue=progress_queue)
+        except Exception:
+            traceback.print_exc()
+            progress_queue.put(("error", rank, traceback.format_exc()))
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def report_progress(live, start_time, work_queue, num_rows, num_active):
+    elapsed = time.time() - start_time
+    rate = live.count / elapsed if elapsed > 0 else 0.0
+    progress = work_queue.progress()
+    remaining = progress[PENDING] + progress[RUNNING]
+    eta = format_duration(remaining / rate) if rate > 0 else "?"
+    values = ", ".join(f"{m}={v:.4f}" for m, v in live.results().items())
+    print(f"⏱️ [{format_duration(elapsed)}] {live.count}/{num_rows} samples, {rate:.2f} samples/s "
+          f"({num_active} workers, {progress[DONE]} rows in done chunks, ETA {eta})  {values}", flush=True)
+
+
+def main():
+    args, evaluator_argv = parse_args()
+    evaluator = EVALUATORS[args.evaluator]
+    module = importlib.import_module(evaluator.module)
+    eval_args = module.parse_args(evaluator_argv)
+
+    num_workers = args.num_workers or (1 if args.cpu else torch.cuda.device_count())
+    if num_workers <= 0:
+        raise ValueError("No GPUs visible; pass --cpu to run the workers on CPU")
+    if not eval_args.global_trie_file or not os.path.exists(eval_args.global_trie_file):
+        raise FileNotFoundError(f"Global trie file not found: {eval_args.global_trie_file}. "
+                                f"Please run precompute_global_trie.py first.")
+    os.makedirs(args.log_dir, exist_ok=True)
+    output_json = args.output_json or os.path.join(args.log_dir, "summary_results.json")
+
+    print(f"🚀 Evaluation driver: {args.evaluator}, {num_workers} {'CPU' if args.cpu else 'GPU'} workers")
+    print(f"📝 Log directory: {args.log_dir}")
+
+    # 1. Trie, loaded once and shared with every worker
+    trie = SIDTrie.load(eval_args.global_trie_file)
+    shared_trie = share_trie(trie)
+    print(f"✅ Prefix trie in shared memory: {trie.num_items} SIDs, {trie.num_nodes} nodes")
+
+    # 2. Token cache, built once; workers memory-map the same files
+    from token_cache import TokenCache
+    from transformers import AutoTokenizer
+
+    eval_args.token_cache_dir = eval_args.token_cache_dir or "./token_cache"
+    tokenizer = AutoTokenizer.from_pretrained(eval_args.merged_model_path)
+    token_cache = TokenCache.open_or_build(
+        eval_args.token_cache_dir, eval_args.test_parquet_file, tokenizer,
+        getattr(module, evaluator.format_prompt), getattr(module, evaluator.template_version)
+    )
+    print(f"✅ Token cache: {token_cache.path} ({len(token_cache)} rows, {len(token_cache.tokens):,} tokens)")
+
+    # 3. Work queue; an existing queue requeues chunks left running by a killed run
+    if not eval_args.work_queue:
+        eval_args.work_queue = os.path.join(args.log_dir, "work_queue.sqlite")
+    num_rows = parquet_num_rows(eval_args.test_parquet_file)
+    work_queue = WorkQueue.create(eval_args.work_queue, num_rows, args.chunk_size)
+    print(f"✅ Work queue: {eval_args.work_queue} ({num_rows} rows in chunks of {args.chunk_size})")
+
+    # 4. Workers
+    ctx = mp.get_context("spawn")
+    progress_queue = ctx.Queue()
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    processes = []
+    for rank in range(num_workers):
+        worker_args = copy.copy(eval_args)
+        worker_args.gpu_id = rank
+        worker_args.log_file = os.path.join(args.log_dir, f"gpu_{rank}.log")
+        worker_args.metrics_file = os.path.join(args.log_dir, f"metrics_gpu_{rank}.json")
+        if eval_args.timing_file:
+            root, ext = os.path.splitext(eval_args.timing_file)
+            worker_args.timing_file = f"{root}_gpu_{rank}{ext}"
+        out_file = os.path.join(args.log_dir, f"gpu_{rank}.out")
+        process = ctx.Process(
+            target=worker_main,
+            args=(rank, args.evaluator, worker_args, shared_trie, progress_queue, args.cpu, num_threads, out_file),
+        )
+        process.start()
+        processes.append(process)
+        print(f"🔄 Worker {rank}: PID {process.pid} -> {worker_args.log_file}")
+
+    # 5. Stream batch results until every worker reported or died
+    metrics = eval_args.metrics.split(",")
+    live = MetricAccumulator(metrics)
+    final = MetricAccumulator(metrics)
+    finished = set()
+    failed = {}
+    start_time = time.time()
+    last_report = start_time
+    while len(finished) + len(failed) < num_workers:
+        try:
+            kind, rank, *payload = progress_queue.get(timeout=1.0)
+        except queue.Empty:
+            # A queued message is always delivered before its sender counts as dead
+            for rank, process in enumerate(processes):
+                if not process.is_alive() and rank not in finished and rank not in failed:
+                    failed[rank] = f"exited with code {process.exitcode} without reporting"
+        else:
+            if kind == "batch":
+                live.update(payload[0])
+            elif kind == "done":
+                # Exact shard totals, including samples restored with --resume
+                num_samples, sums = payload
+                finished.add(rank)
+                final.count += num_samples
+                for metric, value in sums.items():
+                    final.sums[metric] += value
+                print(f"✅ Worker {rank} finished: {num_samples} samples")
+            elif kind == "error":
+                failed[rank] = payload[0]
+        if time.time() - last_report >= args.report_every:
+            last_report = time.time()
+            report_progress(live, start_time, work_queue, num_rows, num_workers - len(finished) - len(failed))
+
+    for process in processes:
+        process.join()
+    report_progress(live, start_time, work_queue, num_rows, 0)
+    work_queue.close()
+
+    # 6. Global summary
+    results = final.results()
+    print("=" * 60)
+    print("🎯 Sample-weighted global results:")
+    print("=" * 60)
+    for metric, value in results.items():
+        print(f"{metric:>10}: {value:.4f}")
+    print("=" * 60)
+    print(f"Total samples: {final.count}")
+    print(f"Wall time: {format_duration(time.time() - start_time)}")
+    with open(output_json, "w", encoding="utf-8") as f:
+        json.dump({
+            "num_samples": final.count,
+            "num_shards": len(finished),
+            "metric_sums": final.sums,
+            "metrics": results,
+        }, f, indent=2)
+    print(f"Summary saved to: {output_json}")
+
+    for rank, error in sorted(failed.items()):
+        print(f"❌ Worker {rank} failed (see {os.path.join(args.log_dir, f'gpu_{rank}.out')}):\n{error}")
+    return not failed and final.count > 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing and counter hooks for the hot paths of the hit-rate evaluators
+run_evaluation times tokenization, every generate() call (split into prefill
+and decode steps), each SID constraint call, token-to-item mapping and metric
+updates into an EvalHooks object. At the end of every batch the batch record
+is handed to the configured sinks: a JSONL file with one line per batch, or a
+Prometheus text file (node_exporter textfile collector format) rewritten with
+running totals. All helpers accept hooks=None and then cost nothing.
+
+Stage names: tokenize, {think,sid}_prefill, {think,sid}_decode (decode steps,
+which include the constraint time), constraint, map_items, think_detokenize,
+rerank and metrics; counters: {think,sid}_generate_calls, {think,sid}_steps,
+{think,sid}_rows (beam rows scored) and constraint_calls.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+
+
+class EvalHooks:
+    """Per-batch stage seconds and counters, flushed to sinks by end_batch()
+
+    With sync_cuda (default: when CUDA is available) the device is
+    synchronized at every timing boundary so GPU work is attributed to the
+    stage that queued it; this costs a little throughput, so hooks are only
+    created when a timing file is requested.
+
+    Stages may be recorded from several threads (--pipeline); a batch record
+    then holds whatever was recorded since the previous end_batch(), so stages
+    of overlapping batches are attributed approximately.
+    """
+
+    def __init__(self, sinks=(), labels=None, sync_cuda=None):
+        self.sinks = list(sinks)
+        self.labels = dict(labels or {})
+        self.sync_cuda = torch.cuda.is_available() if sync_cuda is None else sync_cuda
+        self.batch_seconds = defaultdict(float)
+        self.batch_counts = defaultdict(int)
+        self.total_seconds = defaultdict(float)
+        self.total_counts = defaultdict(int)
+        self.num_batches = 0
+        self.num_samples = 0
+        self._generate_start = None
+        self._first_step = None
+        self.lock = threading.Lock()
+
+    def now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.batch_seconds[name] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.batch_counts[name] += n
+
+    @contextmanager
+    def stage(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add_time(name, self.now() - start)
+
+    @contextmanager
+    def generate(self, name):
+        """Time one generate() call as {name}_prefill (until the first decode step) and {name}_decode"""
+        start = self.now()
+        self._generate_start = start
+        self._first_step = None
+        try:
+            yield
+        finally:
+            end = self.now()
+            first_step = self._first_step if self._first_step is not None else end
+            self.add_time(f"{name}_prefill", first_step - start)
+            self.add_time(f"{name}_decode", end - first_step)
+            self.count(f"{name}_generate_calls")
+            self._generate_start = None
+
+    def step(self, name, num_rows):
+        """Called by StepMarker at every decode step of a generate() call"""
+        if self._generate_start is not None and self._first_step is None:
+            self._first_step = self.now()
+        self.count(f"{name}_steps")
+        self.count(f"{name}_rows", num_rows)
+
+    def end_batch(self, step, batch_size):
+        """Emit the batch record to every sink and fold it into the totals"""
+        with self.lock:
+            record = {
+                **self.labels,
+                "step": step,
+                "batch_size": batch_size,
+                "seconds": dict(self.batch_seconds),
+                "counts": dict(self.batch_counts),
+            }
+            for name, seconds in self.batch_seconds.items():
+                self.total_seconds[name] += seconds
+            for name, n in self.batch_counts.items():
+                self.total_counts[name] += n
+            self.num_batches += 1
+            self.num_samples += batch_size
+            self.batch_seconds.clear()
+            self.batch_counts.clear()
+        for sink in self.sinks:
+            sink.write_batch(record, self)
+        return record
+
+    def summary(self):
+        return {
+            **self.labels,
+            "batches": self.num_batches,
+            "samples": self.num_samples,
+            "seconds": dict(self.total_seconds),
+            "counts": dict(self.total_counts),
+        }
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close(self)
+
+
+class StepMarker(LogitsProcessor):
+    """Identity logits processor that reports each decode step to the hooks"""
+
+    def __init__(self, hooks, name):
+        self.hooks = hooks
+        self.name = name
+
+    def __call__(self, input_ids, scores):
+        self.hooks.step(self.name, input_ids.shape[0])
+        return scores
+
+
+class TimedLogitsProcessor(LogitsProcessor):
+    """Times every call of a wrapped logits processor (e.g. the SID constraint)"""
+
+    def __init__(self, processor, hooks, name="constraint"):
+        self.processor = processor
+        self.hooks = hooks
+        self.name = name
+
+    def __call__(self, input_ids, scores):
+        start = self.hooks.now()
+        scores = self.processor(input_ids, scores)
+        self.hooks.add_time(self.name, self.hooks.now() - start)
+        self.hooks.count(f"{self.name}_calls")
+        return scores
+
+
+def timed(hooks, name):
+    """hooks.stage(name), or a no-op context without hooks"""
+    return hooks.stage(name) if hooks is not None else nullcontext()
+
+
+def timed_generate(hooks, name):
+    return hooks.generate(name) if hooks is not None else nullcontext()
+
+
+def logits_processors(hooks, name, *processors):
+    """LogitsProcessorList for one generate() call, with step and constraint timing when hooked"""
+    if hooks is None:
+        return LogitsProcessorList(processors)
+    return LogitsProcessorList([StepMarker(hooks, name)] + [TimedLogitsProcessor(p, hooks) for p in processors])
+
+
+class JSONLSink:
+    """One JSON line per batch, then a summary line on close"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8", buffering=1)
+
+    def write_batch(self, record, hooks):
+        self.file.write(json.dumps({"event": "batch", **record}) + "\n")
+
+    def close(self, hooks):
+        self.file.write(json.dumps({"event": "summary", **hooks.summary()}) + "\n")
+        self.file.close()
+
+
+class PrometheusSink:
+    """Running totals in Prometheus text format, atomically rewritten after every batch"""
+
+    def __init__(self, path, prefix="onerec_eval"):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.prefix = prefix
+        self.last_batch = {}
+
+    def _labels(self, hooks, **extra):
+        labels = {**{k: str(v) for k, v in hooks.labels.items()}, **extra}
+        if not labels:
+            return ""
+        escaped = (
+            k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for k, v in sorted(labels.items())
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def _render(self, hooks):
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_stage_seconds_total Seconds spent per evaluation stage",
+            f"# TYPE {p}_stage_seconds_total counter",
+        ]
+        lines += [f"{p}_stage_seconds_total{self._labels(hooks, stage=name)} {value:.6f}"
+                  for name, value in sorted(hooks.total_seconds.items())]
+        lines += [
+            f"# HELP {p}_events_total Counted evaluation events (generate calls, decode steps, constraint calls)",
+            f"# TYPE {p}_events_total counter",
+        ]
+        lines += [f"{p}_events_total{self._labels(hooks, event=name)} {value}"
+                  for name, value in sorted(hooks.total_counts.items())]
+        lines += [
+            f"# HELP {p}_last_batch_stage_seconds Seconds per stage in the most recent batch",
+            f"# TYPE {p}_last_batch_stage_seconds gauge",
+        ]
+        lines += [f"{p}_last_batch_stage_seconds{self._labels(hooks, stage=name)} {value:.6f}"
+                  for name, value in sorted(self.last_batch.items())]
+        lines += [
+            f"# TYPE {p}_batches_total counter",
+            f"{p}_batches_total{self._labels(hooks)} {hooks.num_batches}",
+            f"# TYPE {p}_samples_total counter",
+            f"{p}_samples_total{self._labels(hooks)} {hooks.num_samples}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_batch(self, record, hooks):
+        self.last_batch = record["seconds"]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self._render(hooks))
+        os.replace(tmp_path, self.path)
+
+    def close(self, hooks):
+        pass
+
+
+SINKS = {"jsonl": JSONLSink, "prometheus": PrometheusSink}
+
+
+def create_hooks(timing_file, timing_format="jsonl", **labels):
+    """EvalHooks writing to timing_file, or None when no file is requested"""
+    if not timing_file:
+        return None
+    return EvalHooks([SINKS[timing_format](timing_file)], labels=labels)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+CPU/GPU pipelining for the evaluation loop (--pipeline)
+A Prefetcher thread collates, tokenizes and pins batch N+1 while the main
+thread runs generate() for batch N, and a PostProcessor thread ranks, logs and
+records batch N-1 at the same time. Both sides run strictly in order (one
+prefetch thread, one post-processing thread), so results, metrics and log
+contents match the serial loop; only the interleaving of log lines differs.
+The main thread keeps all model calls and random number generation.
+"""
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+
+class Prefetcher:
+    """Iterate `iterable` on a background thread, applying `prepare` to every item
+
+    At most `depth` prepared items wait ahead of the consumer. Exceptions from
+    the iterable or prepare are re-raised in the consuming thread.
+    """
+
+    def __init__(self, iterable, prepare=None, depth=1):
+        self.iterable = iterable
+        self.prepare = prepare
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="eval-prefetch", daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Give up when the consumer stopped early instead of blocking forever
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for item in self.iterable:
+                if self.prepare is not None:
+                    item = self.prepare(item)
+                if not self._put((item, None)):
+                    return
+        except BaseException as e:
+            self._put((_END, e))
+            return
+        self._put((_END, None))
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self.queue.get()
+                if error is not None:
+                    raise error
+                if item is _END:
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class PostProcessor:
+    """Run per-batch post-processing in submission order, one batch behind generation
+
+    submit() first waits for the previous batch (re-raising its error), so at
+    most one batch is post-processed while the next one generates. Disabled,
+    every call runs inline, which is exactly the serial loop.
+    """
+
+    def __init__(self, enabled=True):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval-post") if enabled else None
+        self.pending = None
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            fn(*args, **kwargs)
+            return
+        self.wait()
+        self.pending = self.executor.submit(fn, *args, **kwargs)
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn after all submitted batches, on the post-processing thread, and wait for it"""
+        if self.executor is None:
+            return fn(*args, **kwargs)
+        return self.executor.submit(fn, *args, **kwargs).result()
+
+    def close(self):
+        if self.executor is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-aware sub-batch planning for beam search generation
+Estimates the memory of generate() from the model config (KV cache over
+prompt + new tokens for every beam, per-step logits, prefill activations) and
+splits a batch into contiguous sub-batches that fit a memory budget. The beam
+width is never changed, so metrics like hit@10 keep their definition.
+generate_in_sub_batches runs a plan for the hit-rate and CoT evaluators.
+
+The planner only needs a config, so plans can be checked on CPU with a fake
+budget:
+    python3 generation_planner.py --model_path MODEL --budget_gb 4 --num_beams 10 --prompt_lengths 900 1200 400
+"""
+
+import argparse
+
+GB = 1024 ** 3
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Print the generation sub-batch plan for a fake memory budget")
+    parser.add_argument("--model_path", type=str, required=True, help="Model path providing the config")
+    parser.add_argument("--budget_gb", type=float, required=True, help="Memory budget for generation in GiB")
+    parser.add_argument("--num_beams", type=int, default=10, help="Beams per prompt")
+    parser.add_argument("--max_new_tokens", type=int, default=8, help="New tokens per beam")
+    parser.add_argument("--dtype_bytes", type=int, default=2, help="Bytes per model activation element")
+    parser.add_argument("--prompt_lengths", type=int, nargs="+", required=True, help="Prompt token lengths of one batch")
+    return parser.parse_args()
+
+
+def format_bytes(num_bytes):
+    if num_bytes >= GB:
+        return f"{num_bytes / GB:.2f} GB"
+    return f"{num_bytes / 1024 ** 2:.1f} MB"
+
+
+def is_oom_error(error):
+    """True for CUDA out-of-memory errors; other CUDA failures (device asserts, NCCL) are not recoverable"""
+    import torch
+
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+
+class GenerationMemoryPlanner:
+    """Split batches so that estimated generate() memory stays within budget_bytes"""
+
+    def __init__(self, config, dtype_bytes, budget_bytes):
+        text_config = config.get_text_config() if hasattr(config, "get_text_config") else config
+        num_heads = text_config.num_attention_heads
+        self.num_layers = text_config.num_hidden_layers
+        self.num_kv_heads = getattr(text_config, "num_key_value_heads", None) or num_heads
+        self.head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // num_heads
+        self.hidden_size = text_config.hidden_size
+        self.intermediate_size = getattr(text_config, "intermediate_size", None) or 4 * self.hidden_size
+        self.vocab_size = text_config.vocab_size
+        self.dtype_bytes = dtype_bytes
+        self.budget_bytes = budget_bytes
+
+    @classmethod
+    def from_model(cls, model, budget_gb=0.0, memory_fraction=0.85):
+        """Budget is budget_gb if given, else a fraction of the free CUDA memory (None on CPU)"""
+        import torch
+
+        if budget_gb > 0:
+            budget_bytes = int(budget_gb * GB)
+        elif torch.cuda.is_available() and model.device.type == "cuda":
+            free_bytes, _ = torch.cuda.mem_get_info(model.device)
+            budget_bytes = int(free_bytes * memory_fraction)
+        else:
+            budget_bytes = None
+        return cls(model.config, model.dtype.itemsize, budget_bytes)
+
+    @property
+    def kv_bytes_per_token(self):
+        return 2 * self.num_layers * self.num_kv_heads * self.head_dim * self.dtype_bytes
+
+    def row_bytes(self, prompt_len, max_new_tokens, num_beams):
+        """Estimated peak bytes for one prompt expanded to num_beams beams"""
+        kv_cache = num_beams * (prompt_len + max_new_tokens) * self.kv_bytes_per_token
+        # Float32 scores plus the log-softmax / processed copies kept per step
+        logits = 3 * num_beams * self.vocab_size * 4
+        # Prefill runs over the beam-expanded prompt, one layer of activations at a time
+        prefill = num_beams * prompt_len * (4 * self.hidden_size + 2 * self.intermediate_size) * self.dtype_bytes
+        return kv_cache + logits + prefill
+
+    def plan(self, prompt_lengths, max_new_tokens, num_beams):
+        """Contiguous (start, stop) sub-batches; each pads to its own longest prompt"""
+        if self.budget_bytes is None or not prompt_lengths:
+            return [(0, len(prompt_lengths))]
+        sub_batches = []
+        start = 0
+        longest = 0
+        for i, length in enumerate(prompt_lengths):
+            candidate = max(longest, length)
+            if i > start and (i - start + 1) * self.row_bytes(candidate, max_new_tokens, num_beams) > self.budget_bytes:
+                sub_batches.append((start, i))
+                start = i
+                candidate = length
+            longest = candidate
+        sub_batches.append((start, len(prompt_lengths)))
+        return sub_batches
+
+    def describe(self, plan, prompt_lengths, max_new_tokens, num_beams):
+        sizes = [stop - start for start, stop in plan]
+        peak = max(
+            (stop - start) * self.row_bytes(max(prompt_lengths[start:stop]), max_new_tokens, num_beams)
+            for start, stop in plan
+        ) if prompt_lengths else 0
+        budget = format_bytes(self.budget_bytes) if self.budget_bytes is not None else "unbounded"
+        return (f"{len(prompt_lengths)} prompts × {num_beams} beams → sub-batches {sizes} "
+                f"(est. peak {format_bytes(peak)}, budget {budget})")
+
+
+def generate_in_sub_batches(model, enc, plan, generate_kwargs, sid_logits_processor, logger, hooks=None,
+                            return_keys=False):
+    """Beam search over each planned (start, stop) sub-batch of enc
+
+    Each sub-batch drops its all-padding columns. A sub-batch that still runs
+    out of memory is split in half and retried, down to a single prompt.
+    Returns the trie item index of every candidate (-1 if it is not a catalog
+    SID) and sequence scores in batch order, plus with return_keys the
+    SIDLogitsProcessor.unmatched_keys of every candidate.
+    """
+    import numpy as np
+    import torch
+    from eval_hooks import logits_processors, timed, timed_generate
+
+    items = []
+    scores_list = []
+    keys = []
+    pending = list(plan)
+    while pending:
+        start, stop = pending.pop(0)
+        attention_mask = enc["attention_mask"][start:stop]
+        first_column = int(attention_mask.sum(dim=0).nonzero()[0]) if attention_mask.any() else 0
+        call_kwargs = dict(generate_kwargs)
+        call_kwargs["input_ids"] = enc["input_ids"][start:stop, first_column:]
+        call_kwargs["attention_mask"] = attention_mask[:, first_column:]
+        
+        # Add SID constrained generation
+        call_kwargs["logits_processor"] = logits_processors(hooks, "sid", sid_logits_processor.reset())
+        
+        try:
+            with timed_generate(hooks, "sid"):
+                output = model.generate(**call_kwargs)
+        except RuntimeError as e:
+            if not is_oom_error(e) or stop - start == 1:
+                raise
+            mid = (start + stop) // 2
+            logger.warning(f"CUDA OOM with {stop - start} prompts × {generate_kwargs['num_beams']} beams "
+                           f"despite the plan. Retrying as sub-batches of {mid - start} and {stop - mid}.")
+            pending[:0] = [(start, mid), (mid, stop)]
+            torch.cuda.empty_cache()
+            continue
+        
+        # Map the generated tail straight to item ids; the prompt is never decoded
+        new_tokens = output["sequences"][:, call_kwargs["input_ids"].shape[1]:]
+        with timed(hooks, "map_items"):
+            items.append(sid_logits_processor.generated_items(new_tokens))
+            if return_keys:
+                keys.extend(sid_logits_processor.unmatched_keys(
+                    new_tokens, items[-1], call_kwargs.get("pad_token_id", model.generation_config.pad_token_id)
+                ))
+        scores = output.get("sequences_scores", None)
+        if scores is not None:
+            scores_list.extend(float(s) for s in scores.detach().cpu().tolist())
+        else:
+            scores_list.extend([0.0] * len(output["sequences"]))
+    items = np.concatenate(items) if items else np.zeros(0, dtype=np.int64)
+    if return_keys:
+        return items, scores_list, keys
+    return items, scores_list
+
+
+def main():
+    args = parse_args()
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(args.model_path)
+    planner = GenerationMemoryPlanner(config, args.dtype_bytes, int(args.budget_gb * GB))
+    plan = planner.plan(args.prompt_lengths, args.max_new_tokens, args.num_beams)
+    print(f"KV cache per token: {planner.kv_bytes_per_token / 1024:.1f} KiB")
+    print(f"Plan: {planner.describe(plan, args.prompt_lengths, args.max_new_tokens, args.num_beams)}")
+    for start, stop in plan:
+        print(f"  rows {start}-{stop - 1}: lengths {args.prompt_lengths[start:stop]}")
+
+
+if __name__ == "__main__":
+    main()
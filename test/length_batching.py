@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Length-aware batching for evaluation prompts
+Rows are sorted by prompt token length so each batch pads to a similar length,
+and batches can be sized by a padded-token budget instead of a fixed row count.
+Metrics are order-independent running sums, so batches may run in any order;
+result parts are read back in the original order by sample index (result_sink).
+"""
+
+import numpy as np
+
+
+def length_sorted_batches(indices, lengths, batch_size, max_batch_tokens=0):
+    """Split indices into batches of similar length, longest batch first
+
+    With max_batch_tokens > 0 a batch grows while rows * longest prompt stays
+    within the budget (at least one row per batch); otherwise batches hold
+    batch_size rows. Running the longest prompts first surfaces OOM early.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if len(indices) == 0:
+        return []
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64)[indices], kind="stable")
+    sorted_indices = indices[order].tolist()
+    sorted_lengths = np.asarray(lengths, dtype=np.int64)[indices[order]].tolist()
+
+    if max_batch_tokens <= 0:
+        return [sorted_indices[i:i + batch_size] for i in range(0, len(sorted_indices), batch_size)]
+
+    batches = []
+    batch = []
+    batch_max = 0
+    for index, length in zip(sorted_indices, sorted_lengths):
+        longest = max(batch_max, length)
+        if batch and (len(batch) + 1) * longest > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+            longest = length
+        batch.append(index)
+        batch_max = longest
+    batches.append(batch)
+    return batches
+
+
+def padding_ratio(batches, lengths):
+    """Fraction of padded prompt tokens over all batches"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    padded = sum(len(batch) * int(lengths[batch].max()) for batch in batches if len(batch))
+    real = sum(int(lengths[batch].sum()) for batch in batches if len(batch))
+    return 1.0 - real / padded if padded else 0.0
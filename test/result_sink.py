@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only per-sample result sink for the hit-rate evaluators
+Every evaluated sample's ranked candidates, scores and hit vector are written
+to parquet part files in a results directory. Parts are only ever added, never
+rewritten, so a killed run loses at most one unflushed buffer, and --resume can
+skip every sample index already present in the directory. Length-bucketed and
+work-queue runs finish samples out of order; each part is sorted by sample
+index and load_results returns the original sample order.
+"""
+
+import glob
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+RESULT_SCHEMA = pa.schema([
+    ("sample_index", pa.int64()),
+    ("user_id", pa.string()),
+    ("target", pa.string()),
+    ("candidates", pa.list_(pa.string())),
+    ("scores", pa.list_(pa.float64())),
+    ("hits", pa.list_(pa.int8())),
+])
+
+
+def list_result_parts(results_dir):
+    return sorted(glob.glob(os.path.join(results_dir, "*.parquet")))
+
+
+def load_results(results_dir, columns=None):
+    """Read all result parts of a directory into one pyarrow Table, ordered by sample index
+
+    The sort is stable, so samples recorded twice keep the order of their parts.
+    """
+    columns = columns or RESULT_SCHEMA.names
+    parts = list_result_parts(results_dir)
+    if not parts:
+        return RESULT_SCHEMA.empty_table().select(columns)
+    read_columns = columns if "sample_index" in columns else ["sample_index", *columns]
+    table = pa.concat_tables([pq.read_table(part, columns=read_columns, schema=RESULT_SCHEMA) for part in parts])
+    return table.take(pc.sort_indices(table, [("sample_index", "ascending")])).select(columns)
+
+
+def rank_candidates(candidates, scores):
+    """Order candidates by descending score, keeping generation order on ties"""
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+    return [candidates[i] for i in order], [float(scores[i]) for i in order]
+
+
+class ResultSink:
+    """Buffer per-sample records and flush them as new parquet parts
+
+    Parts are named <prefix>-part-<n>.parquet and written through a temporary
+    file plus rename, so a crash never leaves a truncated part behind.
+    """
+
+    def __init__(self, results_dir, prefix, flush_every=64):
+        self.results_dir = results_dir
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.buffer = {name: [] for name in RESULT_SCHEMA.names}
+        os.makedirs(results_dir, exist_ok=True)
+        existing = glob.glob(os.path.join(results_dir, f"{prefix}-part-*.parquet"))
+        self.next_part = 1 + max(
+            (int(os.path.basename(p)[len(prefix) + 6:-8]) for p in existing), default=-1
+        )
+
+    def completed(self, start=0, stop=None):
+        """Sample indices in [start, stop) already present, with their hit vectors"""
+        table = load_results(self.results_dir, columns=["sample_index", "hits"])
+        done = {}
+        for index, hits in zip(table.column("sample_index").to_pylist(), table.column("hits").to_pylist()):
+            if index >= start and (stop is None or index < stop):
+                done[index] = hits
+        return done
+
+    def add(self, sample_index, user_id, target, candidates, scores, hits):
+        """Record one sample; candidates and scores must already be ranked"""
+        self.buffer["sample_index"].append(int(sample_index))
+        self.buffer["user_id"].append(str(user_id))
+        self.buffer["target"].append(target)
+        self.buffer["candidates"].append(list(candidates))
+        self.buffer["scores"].append([float(s) for s in scores])
+        self.buffer["hits"].append([int(h) for h in hits])
+        if len(self.buffer["sample_index"]) >= self.flush_every:
+            self.flush()
+
+    def add_batch(self, sample_indices, user_ids, targets, candidates, scores, hits, k):
+        """Record a batch of k candidates per sample; hits[b] is sample b's ranked hit vector"""
+        for b, sample_index in enumerate(sample_indices):
+            ranked, ranked_scores = rank_candidates(candidates[b * k:(b + 1) * k], scores[b * k:(b + 1) * k])
+            self.add(sample_index, user_ids[b], targets[b], ranked, ranked_scores, hits[b])
+
+    def flush(self):
+        if not self.buffer["sample_index"]:
+            return
+        table = pa.Table.from_pydict(self.buffer, schema=RESULT_SCHEMA)
+        table = table.take(pc.sort_indices(table, [("sample_index", "ascending")]))
+        path = os.path.join(self.results_dir, f"{self.prefix}-part-{self.next_part:05d}.parquet")
+        tmp_path = path + ".tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        self.next_part += 1
+        self.buffer = {name: [] for name in RESULT_SCHEMA.names}
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Step-wise SID constrained beam search over a pluggable next-token scorer
+Like vLLM's own LLM.beam_search, every step submits each live beam as a
+one-token request, but only the tokens the SID trie allows after the beam's
+prefix are scored. Beam bookkeeping follows transformers' beam search
+(num_beams running beams, top 2 * num_beams continuations, finished
+hypotheses scored by sum of log-probs over generated length, early stopping
+once num_beams hypotheses are done).
+
+Both scorers return full-vocabulary log-probs of the allowed tokens, the
+scores SIDLogitsProcessor leaves in HF generate(), so backends rank beams alike.
+
+Scorers:
+    VLLMStepScorer  vLLM engine with prefix caching, trie mask per request (vllm_trie_mask.py)
+    HFStepScorer    plain transformers forward passes, runs on CPU
+"""
+
+import importlib.util
+
+import numpy as np
+import torch
+
+# Score of padding candidates when fewer than num_beams hypotheses exist (as in transformers)
+MISSING_SCORE = -1e9
+
+
+def vllm_available():
+    return importlib.util.find_spec("vllm") is not None and torch.cuda.is_available()
+
+
+def trie_max_fanout(trie):
+    """Most children of any trie node, i.e. the most log-probs one step needs"""
+    return max(int(np.diff(trie.child_offsets).max(initial=0)), 1)
+
+
+class HFStepScorer:
+    """Next-token log-probs from full forward passes of a transformers model
+
+    Every step recomputes the whole sequence without a KV cache, so this is
+    meant for checking the constraint logic on CPU, not for speed.
+    """
+
+    def __init__(self, model, pad_token_id):
+        self.model = model
+        self.pad_token_id = pad_token_id
+
+    @torch.no_grad()
+    def __call__(self, sequences, allowed):
+        max_len = max(len(seq) for seq in sequences)
+        input_ids = torch.full((len(sequences), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+        for i, seq in enumerate(sequences):
+            input_ids[i, max_len - len(seq):] = torch.tensor(seq, dtype=torch.long)
+            attention_mask[i, max_len - len(seq):] = 1
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+        logits = self.model(
+            input_ids=input_ids.to(self.model.device),
+            attention_mask=attention_mask.to(self.model.device),
+            position_ids=position_ids.to(self.model.device),
+        ).logits[:, -1, :].float()
+        log_probs = torch.log_softmax(logits, dim=-1).cpu().numpy()
+        return [log_probs[i, tokens] for i, tokens in enumerate(allowed)]
+
+
+class VLLMStepScorer:
+    """Next-token log-probs of the allowed tokens from a vLLM engine
+
+    vLLM's allowed_token_ids masks before the log-softmax, which would
+    renormalize over the allowed tokens (a forced step would score 0).
+    TrieStepLogitsProcessor masks after it instead, and the engine reports
+    those processed logits, i.e. full-vocabulary log-probs.
+    """
+
+    def __init__(self, model_path, max_logprobs, tensor_parallel_size=1, gpu_memory_utilization=0.9, seed=42):
+        from vllm import LLM, SamplingParams
+        from vllm.inputs import TokensPrompt
+        from vllm_trie_mask import ALLOWED_TOKENS_ARG, TrieStepLogitsProcessor
+
+        self.SamplingParams = SamplingParams
+        self.TokensPrompt = TokensPrompt
+        self.allowed_tokens_arg = ALLOWED_TOKENS_ARG
+        self.llm = LLM(
+            model=model_path,
+            tensor_parallel_size=tensor_parallel_size,
+            gpu_memory_utilization=gpu_memory_utilization,
+            enable_prefix_caching=True,
+            max_logprobs=max_logprobs,
+            logprobs_mode="processed_logits",
+            logits_processors=[TrieStepLogitsProcessor],
+            seed=seed,
+            trust_remote_code=True,
+        )
+
+    def __call__(self, sequences, allowed):
+        prompts = [self.TokensPrompt(prompt_token_ids=list(seq)) for seq in sequences]
+        params = [
+            self.SamplingParams(max_tokens=1, temperature=0.0, logprobs=len(tokens), detokenize=False,
+                                extra_args={self.allowed_tokens_arg: tokens.tolist()})
+            for tokens in allowed
+        ]
+        outputs = self.llm.generate(prompts, params, use_tqdm=False)
+        results = []
+        for output, tokens in zip(outputs, allowed):
+            step = output.outputs[0].logprobs[0]
+            results.append(np.array([step[t].logprob if t in step else -np.inf for t in tokens.tolist()]))
+        return results
+
+
+class TrieBeamSearch:
+    """Beam search restricted to the SIDs of a SIDLogitsProcessor's trie
+
+    Prompts must contain the processor's separator (e.g. end with
+    "</think>\\n"); lead tokens still missing after it are forced first.
+    """
+
+    def __init__(self, scorer, sid_logits_processor):
+        self.scorer = scorer
+        self.processor = sid_logits_processor
+        self.trie = sid_logits_processor.trie
+        self.eos_token_id = sid_logits_processor.eos_token_id
+
+    def _sid_start(self, prompt):
+        """Lead tokens still to force and the trie node reached by tokens already in the prompt"""
+        sep = self.processor.sep_tokens
+        lead = self.processor.lead_tokens
+        sep_end = -1
+        for i in range(len(prompt) - len(sep), -1, -1):
+            if list(prompt[i:i + len(sep)]) == sep:
+                sep_end = i + len(sep)
+                break
+        if sep_end < 0:
+            raise ValueError("Prompt does not contain the SID separator; the trie constraint cannot start")
+        tail = list(prompt[sep_end:])
+        if len(tail) <= len(lead):
+            if tail != lead[:len(tail)]:
+                raise ValueError("Prompt ends with tokens that differ from the SID lead tokens")
+            return lead[len(tail):], self.trie.ROOT
+        return [], self.trie.walk(tail[len(lead):])
+
+    def _allowed(self, forced, node, step):
+        if step < len(forced):
+            return np.asarray([forced[step]], dtype=np.int64)
+        if node < 0 or self.trie.is_terminal(node):
+            return np.asarray([self.eos_token_id], dtype=np.int64)
+        return self.trie.children(node)
+
+    def generate(self, prompts, num_beams, max_new_tokens):
+        """num_beams candidates per prompt, best first
+
+        Returns trie item ids (-1 if a candidate is not a catalog SID) and
+        length-normalized scores, flattened prompt-major like generate().
+        """
+        starts = [self._sid_start(prompt) for prompt in prompts]
+        # (score, generated tokens, trie node); extra beams start at -1e9 so step 1 expands one beam
+        running = [[(0.0 if b == 0 else MISSING_SCORE, (), node) for b in range(num_beams)]
+                   for _, node in starts]
+        finished = [[] for _ in prompts]
+
+        for step in range(max_new_tokens):
+            # One request per distinct (prompt, prefix); duplicated beams share it
+            requests = {}
+            for p, beams in enumerate(running):
+                if len(finished[p]) >= num_beams:
+                    continue
+                for _, tokens, node in beams:
+                    requests.setdefault((p, tokens), self._allowed(starts[p][0], node, step))
+            if not requests:
+                break
+            keys = list(requests)
+            step_log_probs = self.scorer([list(prompts[p]) + list(tokens) for p, tokens in keys],
+                                         [requests[key] for key in keys])
+            step_log_probs = dict(zip(keys, step_log_probs))
+
+            last_step = step == max_new_tokens - 1
+            for p, beams in enumerate(running):
+                if len(finished[p]) >= num_beams:
+                    continue
+                candidates = []
+                for score, tokens, node in beams:
+                    allowed = requests[(p, tokens)]
+                    for token, log_prob in zip(allowed.tolist(), step_log_probs[(p, tokens)].tolist()):
+                        if np.isfinite(log_prob):
+                            candidates.append((score + log_prob, tokens, node, token))
+                candidates.sort(key=lambda c: c[0], reverse=True)
+                candidates = candidates[:2 * num_beams]
+
+                next_beams = []
+                for rank, (score, tokens, node, token) in enumerate(candidates):
+                    new_tokens = tokens + (token,)
+                    if token == self.eos_token_id or last_step:
+                        # Only the top num_beams continuations may finish, as in transformers
+                        if rank < num_beams:
+                            finished[p].append((score / len(new_tokens), new_tokens))
+                        continue
+                    if len(next_beams) < num_beams:
+                        in_lead = len(new_tokens) <= len(starts[p][0])
+                        next_node = node if in_lead else self.trie.step(node, token)
+                        next_beams.append((score, new_tokens, next_node))
+                running[p] = next_beams
+                finished[p] = sorted(finished[p], key=lambda h: h[0], reverse=True)[:num_beams]
+
+        items = []
+        scores = []
+        for p, hypotheses in enumerate(finished):
+            num_lead = len(starts[p][0])
+            sid_tokens = [list(tokens[num_lead:]) for _, tokens in hypotheses]
+            width = max((len(t) for t in sid_tokens), default=0)
+            padded = np.full((len(sid_tokens), max(width, 1)), self.eos_token_id, dtype=np.int64)
+            for i, t in enumerate(sid_tokens):
+                padded[i, :len(t)] = t
+            prompt_items = self.trie.match_items(padded).tolist() if hypotheses else []
+            prompt_items += [-1] * (num_beams - len(hypotheses))
+            items.extend(prompt_items)
+            scores.extend([score for score, _ in hypotheses] + [MISSING_SCORE] * (num_beams - len(hypotheses)))
+        return np.asarray(items, dtype=np.int64), scores
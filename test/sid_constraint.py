@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched SID constrained decoding as a transformers LogitsProcessor
+Replaces the per-beam prefix_allowed_tokens_fn callback: trie state for every
+row of the [batch*beams, vocab] scores is computed with tensor ops and applied
+with one fill of the constrained rows plus a scatter of the allowed scores
+"""
+
+import numpy as np
+import torch
+from transformers import LogitsProcessor
+
+# Row states besides a trie node index
+NO_MATCH = -1
+LEAD = -2
+UNCONSTRAINED = -3
+
+
+class SIDLogitsProcessor(LogitsProcessor):
+    """Restrict generation after a separator to SIDs stored in a SIDTrie
+
+    Rows that have not produced the separator are left unconstrained. After
+    the separator, lead_tokens are forced one by one (e.g. the newline after
+    </think>), then the SID prefix is walked down the trie. Completed SIDs may
+    only emit EOS; prefixes outside the catalog emit EOS, or are left
+    unconstrained when fallback_allow_all is set.
+
+    The processor keeps per-generation state, so reset() it before each
+    generate() call.
+    """
+
+    def __init__(self, trie, sep_tokens, eos_token_id, lead_tokens=(), fallback_allow_all=False):
+        self.trie = trie
+        self.sep_tokens = list(sep_tokens)
+        self.lead_tokens = list(lead_tokens)
+        self.eos_token_id = eos_token_id
+        self.fallback_allow_all = fallback_allow_all
+        self.max_sid_length = trie.max_length
+        self.device = None
+        self.reset()
+
+    def _to_device(self, device):
+        """Move trie arrays to the scores device once"""
+        if self.device == device:
+            return
+        self.device = device
+        self.sep = torch.tensor(self.sep_tokens, dtype=torch.long, device=device)
+        self.lead = torch.tensor(self.lead_tokens, dtype=torch.long, device=device)
+        self.edge_keys = torch.from_numpy(self.trie.edge_keys).to(device)
+        self.child_offsets = torch.from_numpy(self.trie.child_offsets).to(device)
+        self.child_tokens = torch.from_numpy(self.trie.child_tokens).to(device)
+        self.child_nodes = torch.from_numpy(self.trie.child_nodes).to(device)
+        self.node_item = torch.from_numpy(self.trie.node_item).to(device)
+
+    def reset(self):
+        """Forget per-generation state; call before every generate()"""
+        self._prompt_len = None
+        self._prompt_sep_end = None
+        return self
+
+    def _last_separator_end(self, input_ids, offset):
+        """Index right after the last separator within input_ids (shifted by offset), or -1"""
+        num_rows, seq_len = input_ids.shape
+        m = len(self.sep_tokens)
+        if m == 0 or seq_len < m:
+            return torch.full((num_rows,), -1, dtype=torch.long, device=input_ids.device)
+        match = (input_ids.unfold(1, m, 1) == self.sep).all(-1)
+        positions = torch.arange(match.shape[1], device=input_ids.device)
+        last = torch.where(match, positions, -1).max(-1).values
+        return torch.where(last >= 0, last + m + offset, -1)
+
+    def find_separator_end(self, input_ids):
+        """Index right after the last separator in each row, or -1
+
+        The prompt is scanned once, on the first step of a generation. Beams of
+        one prompt share its separator offset, so it survives beam reordering;
+        later steps only scan the generated tail, independent of prompt length.
+        """
+        num_rows, seq_len = input_ids.shape
+        if (self._prompt_sep_end is None or len(self._prompt_sep_end) != num_rows
+                or seq_len < self._prompt_len):
+            self._prompt_len = seq_len
+            self._prompt_sep_end = self._last_separator_end(input_ids, 0)
+            return self._prompt_sep_end
+        tail_start = max(self._prompt_len - len(self.sep_tokens) + 1, 0)
+        tail_sep_end = self._last_separator_end(input_ids[:, tail_start:], tail_start)
+        return torch.where(tail_sep_end >= 0, tail_sep_end, self._prompt_sep_end)
+
+    def walk(self, input_ids, sid_start, sid_len):
+        """Trie node reached by each row's SID prefix, or NO_MATCH outside the catalog"""
+        num_rows, seq_len = input_ids.shape
+        node = torch.zeros(num_rows, dtype=torch.long, device=input_ids.device)
+        for j in range(min(self.max_sid_length, int(sid_len.max()))):
+            active = sid_len > j
+            token = input_ids.gather(1, (sid_start + j).clamp(0, seq_len - 1).unsqueeze(1)).squeeze(1)
+            key = node * self.trie.key_stride + token
+            idx = torch.searchsorted(self.edge_keys, key).clamp(max=len(self.edge_keys) - 1)
+            valid = (token >= 0) & (token < self.trie.key_stride)
+            found = valid & (self.edge_keys[idx] == key) & (node >= 0)
+            node = torch.where(active, torch.where(found, self.child_nodes[idx], NO_MATCH), node)
+        return torch.where(sid_len > self.max_sid_length, NO_MATCH, node)
+
+    def generated_items(self, new_tokens):
+        """Trie item index of the SID in each row of generated tokens, or -1
+
+        new_tokens holds only the tokens generated after a prompt that ends
+        with the separator; a leading run of lead_tokens is skipped.
+        """
+        tokens = new_tokens.detach().cpu().numpy() if torch.is_tensor(new_tokens) else np.asarray(new_tokens)
+        items = self.trie.match_items(tokens)
+        num_lead = len(self.lead_tokens)
+        if num_lead and tokens.shape[1] > num_lead:
+            has_lead = (tokens[:, :num_lead] == np.asarray(self.lead_tokens)).all(axis=1)
+            if has_lead.any():
+                items = np.where(has_lead, self.trie.match_items(tokens[:, num_lead:]), items)
+        return items
+
+    def unmatched_keys(self, new_tokens, items, pad_token_id=None):
+        """Per row: None for a catalog item, else its generated tokens without trailing EOS / padding
+
+        Tells apart distinct non-catalog candidates that all map to item -1.
+        """
+        tokens = new_tokens.detach().cpu().tolist() if torch.is_tensor(new_tokens) else np.asarray(new_tokens).tolist()
+        trailing = {self.eos_token_id, pad_token_id}
+        keys = []
+        for row, item in zip(tokens, np.asarray(items).tolist()):
+            if item >= 0:
+                keys.append(None)
+                continue
+            end = len(row)
+            while end > 0 and row[end - 1] in trailing:
+                end -= 1
+            keys.append(tuple(row[:end]))
+        return keys
+
+    def row_states(self, input_ids):
+        """Per-row decode state: trie node, NO_MATCH, LEAD or UNCONSTRAINED"""
+        num_rows, seq_len = input_ids.shape
+        num_lead = len(self.lead_tokens)
+
+        sep_end = self.find_separator_end(input_ids)
+        has_sep = sep_end >= 0
+        gen_len = torch.where(has_sep, seq_len - sep_end, 0)
+        in_lead = has_sep & (gen_len < num_lead)
+        in_sid = has_sep & ~in_lead
+
+        sid_len = torch.where(in_sid, gen_len - num_lead, 0)
+        state = self.walk(input_ids, sep_end + num_lead, sid_len)
+        if self.fallback_allow_all:
+            state = torch.where(state < 0, UNCONSTRAINED, state)
+        state = torch.where(in_lead, LEAD, state)
+        state = torch.where(has_sep, state, UNCONSTRAINED)
+        return state, gen_len
+
+    def __call__(self, input_ids, scores):
+        self._to_device(scores.device)
+        state, gen_len = self.row_states(input_ids)
+
+        # Unconstrained rows (e.g. still thinking) are never touched, so a
+        # step in which no row is constrained costs nothing beyond the state walk
+        rows = torch.nonzero(state != UNCONSTRAINED).squeeze(1)
+        if len(rows) == 0:
+            return scores
+        state = state[rows]
+        gen_len = gen_len[rows]
+
+        local = torch.arange(len(rows), device=scores.device)
+
+        # Collect the (row, token) pairs that stay allowed; constrained rows
+        # allow at most a few hundred tokens, so no [rows, vocab] mask is built
+        pair_rows = []
+        pair_tokens = []
+
+        in_lead = state == LEAD
+        pair_rows.append(local[in_lead])
+        pair_tokens.append(self.lead[gen_len[in_lead]])
+
+        safe_state = state.clamp(min=0)
+        finished = (state == NO_MATCH) | ((state >= 0) & (self.node_item[safe_state] >= 0))
+        pair_rows.append(local[finished])
+        pair_tokens.append(torch.full_like(pair_rows[-1], self.eos_token_id))
+
+        # Expand the CSR children of every interior node into its row
+        interior = (state >= 0) & ~finished
+        interior_rows = local[interior]
+        if len(interior_rows):
+            interior_nodes = state[interior_rows]
+            starts = self.child_offsets[interior_nodes]
+            counts = self.child_offsets[interior_nodes + 1] - starts
+            edge_rows = torch.repeat_interleave(interior_rows, counts)
+            first_edge = torch.repeat_interleave(starts - (torch.cumsum(counts, 0) - counts), counts)
+            edges = first_edge + torch.arange(len(edge_rows), device=scores.device)
+            pair_rows.append(edge_rows)
+            pair_tokens.append(self.child_tokens[edges])
+
+        pair_rows = rows[torch.cat(pair_rows)]
+        pair_tokens = torch.cat(pair_tokens)
+        kept = scores[pair_rows, pair_tokens]
+        if len(rows) == scores.shape[0]:
+            scores.fill_(-float("inf"))
+        else:
+            scores.index_fill_(0, rows, -float("inf"))
+        scores[pair_rows, pair_tokens] = kept
+        return scores
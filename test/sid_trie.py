@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array-backed prefix trie over SID token sequences for constrained generation
+Nodes are numbered breadth-first and their children are stored in CSR layout,
+so a catalog of millions of items fits in a handful of flat integer arrays
+"""
+
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+TRIE_FORMAT_VERSION = 1
+TRIE_TYPE = "prefix"
+
+
+class SIDTrie:
+    """Prefix trie keyed on full SID token prefixes
+
+    child_offsets[n]:child_offsets[n + 1] indexes the children of node n in
+    child_tokens / child_nodes (children sorted by token id). node_item[n] is
+    the index into sids of the item completed at node n, or -1.
+    """
+
+    ROOT = 0
+
+    def __init__(self, child_offsets, child_tokens, child_nodes, node_item, sids, metadata=None, edge_keys=None):
+        self.child_offsets = np.asarray(child_offsets, dtype=np.int64)
+        self.child_tokens = np.asarray(child_tokens, dtype=np.int64)
+        self.child_nodes = np.asarray(child_nodes, dtype=np.int64)
+        self.node_item = np.asarray(node_item, dtype=np.int64)
+        self.sids = list(sids)
+        self.metadata = dict(metadata or {})
+
+        # Sorted (parent, token) keys allow vectorized child lookup with searchsorted
+        self.key_stride = int(self.child_tokens.max()) + 1 if len(self.child_tokens) else 1
+        if edge_keys is not None:
+            # Already derived elsewhere (e.g. shared by the evaluation driver)
+            self.edge_keys = np.asarray(edge_keys, dtype=np.int64)
+        else:
+            parents = np.repeat(np.arange(self.num_nodes, dtype=np.int64), np.diff(self.child_offsets))
+            self.edge_keys = parents * self.key_stride + self.child_tokens
+
+    @property
+    def num_nodes(self):
+        return len(self.child_offsets) - 1
+
+    @property
+    def num_items(self):
+        return len(self.sids)
+
+    @property
+    def max_length(self):
+        return int(self.metadata.get("max_length", 0))
+
+    @classmethod
+    def build(cls, sid_token_sequences, sids=None, metadata=None):
+        """Build the trie from SID token sequences (duplicates are merged)"""
+        if sids is None:
+            sids = [None] * len(sid_token_sequences)
+        unique = {}
+        for seq, sid in zip(sid_token_sequences, sids):
+            unique.setdefault(tuple(int(t) for t in seq), sid)
+        seqs = sorted(unique)
+        sorted_sids = [unique[seq] for seq in seqs]
+
+        child_offsets = [0]
+        child_tokens = []
+        child_nodes = []
+        node_item = [-1]
+        depth_counts = []
+
+        # Each queued node covers the contiguous range of sorted sequences sharing its prefix
+        queue = deque([(cls.ROOT, 0, len(seqs), 0)])
+        while queue:
+            node, lo, hi, depth = queue.popleft()
+            i = lo
+            if i < hi and len(seqs[i]) == depth:
+                node_item[node] = i
+                i += 1
+            while i < hi:
+                token = seqs[i][depth]
+                j = i
+                while j < hi and seqs[j][depth] == token:
+                    j += 1
+                child = len(node_item)
+                node_item.append(-1)
+                child_tokens.append(token)
+                child_nodes.append(child)
+                if len(depth_counts) <= depth:
+                    depth_counts.append(0)
+                depth_counts[depth] += 1
+                queue.append((child, i, j, depth + 1))
+                i = j
+            child_offsets.append(len(child_tokens))
+
+        metadata = dict(metadata or {})
+        metadata["max_length"] = max((len(seq) for seq in seqs), default=0)
+        metadata["depth_counts"] = depth_counts
+        return cls(child_offsets, child_tokens, child_nodes, node_item, sorted_sids, metadata)
+
+    def children(self, node):
+        """Token ids that may follow the prefix ending at node"""
+        return self.child_tokens[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def step(self, node, token):
+        """Child of node reached by token, or -1 if the prefix leaves the catalog"""
+        lo, hi = self.child_offsets[node], self.child_offsets[node + 1]
+        idx = lo + np.searchsorted(self.child_tokens[lo:hi], token)
+        if idx < hi and self.child_tokens[idx] == token:
+            return int(self.child_nodes[idx])
+        return -1
+
+    def walk(self, tokens, node=ROOT):
+        """Follow tokens from node, returning the final node or -1"""
+        for token in tokens:
+            node = self.step(node, token)
+            if node < 0:
+                return -1
+        return node
+
+    def is_terminal(self, node):
+        return self.node_item[node] >= 0
+
+    def match_items(self, tokens):
+        """Index into sids of the SID each row of a [rows, length] token array starts with, or -1
+
+        All rows are walked together via edge_keys; tokens after a completed
+        SID (EOS, padding) are ignored.
+        """
+        tokens = np.asarray(tokens, dtype=np.int64).reshape(len(tokens), -1)
+        num_rows, length = tokens.shape
+        node = np.zeros(num_rows, dtype=np.int64)
+        items = np.full(num_rows, -1, dtype=np.int64)
+        if len(self.edge_keys) == 0:
+            return items
+        for j in range(min(self.max_length, length)):
+            token = tokens[:, j]
+            key = node * self.key_stride + token
+            idx = np.searchsorted(self.edge_keys, key).clip(max=len(self.edge_keys) - 1)
+            found = (node >= 0) & (token >= 0) & (token < self.key_stride) & (self.edge_keys[idx] == key)
+            node = np.where(found, self.child_nodes[idx], -1)
+            items = np.where((items < 0) & (node >= 0), self.node_item[node.clip(min=0)], items)
+        return items
+
+    def save(self, path):
+        """Serialize to a versioned, pickle-free npz archive"""
+        metadata = dict(self.metadata)
+        metadata["trie_type"] = TRIE_TYPE
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                format_version=np.int64(TRIE_FORMAT_VERSION),
+                child_offsets=self.child_offsets,
+                child_tokens=self.child_tokens,
+                child_nodes=self.child_nodes,
+                node_item=self.node_item,
+                sids=np.array([sid or "" for sid in self.sids], dtype=str),
+                metadata=np.array(json.dumps(metadata)),
+            )
+
+    @classmethod
+    def load(cls, path):
+        try:
+            archive = np.load(path, allow_pickle=False)
+        except (ValueError, OSError) as e:
+            raise ValueError(
+                f"Cannot read trie file {path} (format v{TRIE_FORMAT_VERSION} expected). "
+                f"Please regenerate it with precompute_global_trie.py."
+            ) from e
+        with archive:
+            version = int(archive["format_version"]) if "format_version" in archive.files else None
+            if version != TRIE_FORMAT_VERSION:
+                raise ValueError(
+                    f"Unsupported trie format version {version} in {path}, expected {TRIE_FORMAT_VERSION}. "
+                    f"Please regenerate the trie file."
+                )
+            return cls(
+                archive["child_offsets"],
+                archive["child_tokens"],
+                archive["child_nodes"],
+                archive["node_item"],
+                archive["sids"].tolist(),
+                json.loads(str(archive["metadata"])),
+            )
@@ -6,6 +6,7 @@ Supports parquet file data loading and comprehensive evaluation metrics
 """
 
 import argparse
+import copy
 import json
 import os
 import sys
@@ -23,8 +24,21 @@ import re
 from collections import defaultdict
 from typing import List, Dict, Any, Callable
 
-
-def parse_args():
+from aggregate_metrics import write_shard_metrics
+from eval_hooks import create_hooks, timed
+from eval_pipeline import PostProcessor, Prefetcher
+from topk_metrics import ItemIndex, MetricAccumulator, topk_hit_matrix
+from generation_planner import GenerationMemoryPlanner, format_bytes, generate_in_sub_batches
+from length_batching import length_sorted_batches, padding_ratio
+from result_sink import ResultSink
+from sid_beam_search import HFStepScorer, TrieBeamSearch, VLLMStepScorer, trie_max_fanout, vllm_available
+from sid_constraint import SIDLogitsProcessor
+from sid_trie import SIDTrie
+from token_cache import TokenCache, pad_left
+from work_queue import QueueBatchSampler, WorkQueue
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Two-stage Model Hit Rate Test with Beam Search")
 
     parser.add_argument("--seed", type=int, default=42, help="Random seed")
@@ -41,10 +55,23 @@ def parse_args():
 
     parser.add_argument("--test_batch_size", type=int, default=1, help="Test batch size")
     parser.add_argument("--num_beams", type=int, default=20, help="Number of beams for beam search")
+    parser.add_argument("--backend", type=str, choices=["hf", "vllm"], default="hf",
+                        help="generation backend: HF generate(), or trie beam search on vLLM (HF forward passes without vLLM/CUDA)")
+    parser.add_argument("--vllm_tensor_parallel_size", type=int, default=1, help="tensor parallel size of the vLLM engine")
+    parser.add_argument("--vllm_gpu_memory_utilization", type=float, default=0.9,
+                        help="fraction of GPU memory the vLLM engine may use")
+    parser.add_argument("--length_bucketing", action="store_true", default=False,
+                        help="batch prompts of similar token length together (results are read back in the original sample order)")
+    parser.add_argument("--max_batch_tokens", type=int, default=0,
+                        help="padded prompt-token budget per batch instead of a fixed --test_batch_size, implies --length_bucketing")
     parser.add_argument("--sample_num", type=int, default=-1,
                         help="test sample number, -1 represents using all test data")
     parser.add_argument("--sample_offset", type=int, default=0,
                         help="sample offset for multi-GPU parallel processing")
+    parser.add_argument("--token_cache_dir", type=str, default=None,
+                        help="directory of pre-tokenized prompt caches (see token_cache.py), built on a miss")
+    parser.add_argument("--work_queue", type=str, default=None,
+                        help="SQLite work queue (see work_queue.py) to claim row chunks from instead of --sample_offset/--sample_num")
     parser.add_argument("--gpu_id", type=int, default=0,
                         help="GPU ID for logging purposes")
     parser.add_argument("--metrics", type=str, default="hit@1,hit@5,hit@10,ndcg@5,ndcg@10",
@@ -54,6 +81,10 @@ def parse_args():
 
     parser.add_argument("--max_new_tokens", type=int, default=50,
                         help="maximum number of new tokens to generate")
+    parser.add_argument("--gen_memory_budget_gb", type=float, default=0.0,
+                        help="memory budget for generate() sub-batch planning, 0 uses a fraction of free CUDA memory")
+    parser.add_argument("--gen_memory_fraction", type=float, default=0.85,
+                        help="fraction of free CUDA memory available to generate() when no budget is given")
     parser.add_argument("--temperature", type=float, default=0.7, help="temperature for generation")
     parser.add_argument("--top_p", type=float, default=0.9, help="top_p for generation")
 
@@ -67,10 +98,24 @@ def parse_args():
     parser.add_argument("--log_file", type=str,
                         default="./logs/two_stage_test.log",
                         help="all output log file path")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="JSON file for this shard's sample count and metric sums (see aggregate_metrics.py)")
+    parser.add_argument("--results_dir", type=str, default=None,
+                        help="directory for append-only per-sample result parquet parts")
+    parser.add_argument("--results_flush_every", type=int, default=64,
+                        help="samples buffered before a result part is written")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="skip samples already present in --results_dir")
     parser.add_argument("--global_trie_file", type=str, default=None,
                         help="Pre-computed global trie file for parallel evaluation")
+    parser.add_argument("--timing_file", type=str, default=None,
+                        help="per-batch stage timings and counters (see eval_hooks.py); off when unset")
+    parser.add_argument("--timing_format", type=str, choices=["jsonl", "prometheus"], default="jsonl",
+                        help="timing file format: one JSON line per batch, or a Prometheus text file of running totals")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="tokenize the next batch and post-process the previous one on threads while generating")
     
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def set_seed(seed):
@@ -105,6 +150,10 @@ def setup_logging(log_file):
     return logger
 
 
+# Bump when the prompt template changes; keys the pre-tokenized prompt cache
+PROMPT_TEMPLATE_VERSION = "sid_direct_v1"
+
+
 def format_chat_prompt(user_content):
     """Format input as chat format prompt"""
     system_message = "You are a professional recommendation expert who needs to recommend the next possible purchase for users based on their purchase history. Please predict the most likely next product that the user will purchase based on the user's historical purchase information."
@@ -121,14 +170,20 @@ def format_chat_prompt(user_content):
     return chat_prompt
 
 
-def load_merged_model(model_path, additional_lora_path=None, logger=None):
-    """Load pre-merged model and tokenizer, optionally with additional LoRA"""
-    logger.info(f"Loading merged model from: {model_path}")
-    
+def load_tokenizer(model_path):
+    """Tokenizer set up for batched generation"""
     tokenizer = AutoTokenizer.from_pretrained(model_path)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
     tokenizer.padding_side = "left"  # Set left padding for generation
+    return tokenizer
+
+
+def load_merged_model(model_path, additional_lora_path=None, logger=None):
+    """Load pre-merged model and tokenizer, optionally with additional LoRA"""
+    logger.info(f"Loading merged model from: {model_path}")
+    
+    tokenizer = load_tokenizer(model_path)
     
     # Force GPU usage - direct approach without device_map
     if torch.cuda.is_available():
@@ -228,6 +283,27 @@ class ParquetTestDataset(Dataset):
         for col in required_cols:
             if col not in self.df.columns:
                 raise ValueError(f"Required column '{col}' not found in parquet file. Available: {list(self.df.columns)}")
+        
+        # Index rows by their position in the parquet file, so results stay identifiable across shards and restarts
+        self.df.index = pd.RangeIndex(sample_offset, sample_offset + len(self.df))
+        self.token_cache = None
+    
+    def skip_samples(self, sample_indices):
+        """Drop samples whose parquet row index is in sample_indices"""
+        self.df = self.df[~self.df.index.isin(list(sample_indices))]
+    
+    def attach_token_cache(self, token_cache):
+        """Serve pre-tokenized prompts (indexed by parquet row) alongside the text columns"""
+        if len(token_cache) < self.df.index.max() + 1:
+            raise ValueError(f"Token cache has {len(token_cache)} rows, parquet row {self.df.index.max()} requested")
+        self.token_cache = token_cache
+    
+    def prompt_lengths(self, tokenizer, format_prompt):
+        """Token length of every row's formatted prompt"""
+        if self.token_cache is not None:
+            return self.token_cache.lengths[self.df.index.to_numpy()]
+        prompts = [format_prompt(text) for text in self.df['description']]
+        return np.array([len(ids) for ids in tokenizer(prompts)["input_ids"]], dtype=np.int64)
     
     def __len__(self):
         return len(self.df)
@@ -237,107 +313,42 @@ class ParquetTestDataset(Dataset):
         return {
             'input_ids': row['description'],
             'labels': row['groundtruth'],
-            'user_id': row.get('user_id', f'user_{idx}')
+            'user_id': row.get('user_id', f'user_{idx}'),
+            'sample_index': int(self.df.index[idx]),
+            'prompt_ids': self.token_cache[self.df.index[idx]] if self.token_cache is not None else None
         }
     
-    def get_prefix_allowed_tokens_fn(self, tokenizer, global_trie_file=None):
-        """Create prefix allowed tokens function for SID constrained generation based on all items in test set"""
-        
-        if not global_trie_file:
-            raise ValueError("Global trie file path must be provided")
-        
-        if not os.path.exists(global_trie_file):
-            raise FileNotFoundError(f"Global trie file not found: {global_trie_file}. Please run precompute_global_trie.py first.")
-        
-        # Load pre-computed exact trie
-        self.logger.info(f"Loading pre-computed exact trie from: {global_trie_file}")
-        import pickle
-        with open(global_trie_file, 'rb') as f:
-            trie_data = pickle.load(f)
-        
-        # Verify this is an exact trie
-        trie_type = trie_data.get('trie_type', None)
-        if trie_type != 'exact':
-            raise ValueError(f"Expected exact trie file, but got trie_type='{trie_type}'. Please regenerate the trie file.")
+    def get_sid_logits_processor(self, tokenizer, global_trie_file=None, trie=None):
+        """Create a batched logits processor for SID constrained generation based on all items in test set"""
         
-        # Load exact trie structure
-        allowed_tokens = trie_data['exact_trie']
-        valid_sids = trie_data['valid_sids']
-        search_space_size = trie_data.get('search_space_size', 0)
-        max_length = trie_data.get('max_length', 0)
+        if trie is not None:
+            # Shared by the evaluation driver (see eval_driver.py)
+            self.logger.info("Using prefix trie shared by the evaluation driver")
+        else:
+            if not global_trie_file:
+                raise ValueError("Global trie file path must be provided")
+
+            if not os.path.exists(global_trie_file):
+                raise FileNotFoundError(f"Global trie file not found: {global_trie_file}. Please run precompute_global_trie.py first.")
+
+            # Load pre-computed prefix trie
+            self.logger.info(f"Loading pre-computed prefix trie from: {global_trie_file}")
+            trie = SIDTrie.load(global_trie_file)
         
-        self.logger.info(f"Loaded exact trie:")
-        self.logger.info(f"  Total unique SIDs: {len(valid_sids)}")
-        self.logger.info(f"  Search space size: {search_space_size:,} (exact match only)")
-        self.logger.info(f"  Trie depth: {max_length}")
+        self.logger.info(f"Loaded prefix trie:")
+        self.logger.info(f"  Total unique SIDs: {trie.num_items}")
+        self.logger.info(f"  Search space size: {trie.num_items:,} (catalog items only)")
+        self.logger.info(f"  Trie depth: {trie.max_length}")
+        self.logger.info(f"  Trie nodes: {trie.num_nodes:,}")
         
-        for pos in range(min(6, max_length)):
-            num_tokens = len(allowed_tokens.get(pos, {}))
-            self.logger.info(f"  Position {pos}: {num_tokens} possible tokens")
+        eos_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
         
         # Get "</think>" separator - looking for the end of think block
         sep = tokenizer("</think>", add_special_tokens=False)["input_ids"]
+        # First token after </think> should be newline, then the SID pattern
+        newline_tokens = tokenizer.encode('\n', add_special_tokens=False)
         
-        def find_last_sublist(lst, sub):
-            """Find the last occurrence of sublist in list"""
-            if not sub:
-                return None
-            n, m = len(lst), len(sub)
-            for start in range(n - m, -1, -1):
-                if lst[start:start + m] == sub:
-                    return start
-            return None
-        
-        def prefix_allowed_tokens_fn(batch_id, sentence):
-            """Return allowed tokens based on current generation position using exact or component trie"""
-            sentence = sentence.tolist()
-            
-            # Find "</think>" position
-            pos = find_last_sublist(sentence, sep)
-            if pos is None:
-                # Before "</think>", allow all tokens
-                return list(tokenizer.get_vocab().values())
-            
-            # Calculate position after "</think>"
-            pos_after_sep = pos + len(sep)
-            generated_after_sep = sentence[pos_after_sep:]
-            
-            # Determine current SID token position
-            current_pos = len(generated_after_sep)
-            
-            # Handle newline after </think> then SID pattern
-            if current_pos == 0:
-                # First token after </think> should be newline
-                newline_tokens = tokenizer.encode('\n', add_special_tokens=False)
-                return newline_tokens
-            else:
-                # After newline, apply SID constraints
-                sid_pos = current_pos - 1
-                
-                # Use exact trie: check what tokens are allowed at this position
-                if sid_pos == 0:
-                    # First SID token position - should be <|sid_begin|>
-                    if 0 in allowed_tokens:
-                        allowed = list(allowed_tokens[0].keys())
-                        return allowed
-                    else:
-                        eos_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
-                        return [eos_id]
-                else:
-                    # Look up what's allowed based on previous token
-                    if len(generated_after_sep) > sid_pos:
-                        prev_token = generated_after_sep[sid_pos]  # Current token at this position
-                        prev_pos = sid_pos - 1
-                        
-                        if prev_pos in allowed_tokens and prev_token in allowed_tokens[prev_pos]:
-                            allowed = allowed_tokens[prev_pos][prev_token]
-                            return allowed
-                    
-                    # Fallback to EOS if no valid continuation
-                    eos_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
-                    return [eos_id]
-        
-        return prefix_allowed_tokens_fn
+        return SIDLogitsProcessor(trie, sep, eos_id, lead_tokens=newline_tokens)
 
 
 class TestCollator:
@@ -362,7 +373,12 @@ class TestCollator:
         
         return {
             "inputs": batch_prompts,
-            "targets": targets
+            "targets": targets,
+            "user_ids": [d["user_id"] for d in batch],
+            "sample_indices": [d["sample_index"] for d in batch],
+            # Pre-tokenized prompts from the token cache, padded like the tokenizer would
+            "encoded": pad_left([d["prompt_ids"] for d in batch], self.tokenizer.pad_token_id)
+                       if batch[0]["prompt_ids"] is not None else None
         }
 
 
@@ -384,156 +400,253 @@ def extract_all_sids_from_text(text):
     matches = re.findall(sid_pattern, text)
     return matches
 
-def get_topk_results(predictions, scores, targets, k, all_items=None):
-    """Extract top-k results from predictions"""
-    results = []
-    B = len(targets)
-    predictions = [_.split("</think>")[-1] for _ in predictions]
-    predictions = [_.strip().replace(" ", "") for _ in predictions]
-    
-    # Extract only SID parts from both predictions and targets
-    predictions = [extract_sid_from_text(pred) for pred in predictions]
-    
-    if all_items is not None:
-        for i, seq in enumerate(predictions):
-            if seq not in all_items:
-                scores[i] = -1000
-    
-    for b in range(B):
-        batch_seqs = predictions[b * k: (b + 1) * k]
-        batch_scores = scores[b * k: (b + 1) * k]
-        
-        pairs = [(seq, score) for seq, score in zip(batch_seqs, batch_scores)]
-        sorted_pairs = sorted(pairs, key=lambda x: x[1], reverse=True)
-        
-        # Extract SID from target as well
-        target_item = extract_sid_from_text(targets[b])
-        
-        one_results = []
-        for pred_seq, pred_score in sorted_pairs:
-            if pred_seq == target_item:
-                one_results.append(1)
-            else:
-                one_results.append(0)
-        
-        results.append(one_results)
-    
-    return results
-
-
-def hit_k(topk_results, k):
-    """Calculate hit@k metric"""
-    hit = 0.0
-    for row in topk_results:
-        if len(row) >= k and max(row[:k]) == 1:
-            hit += 1
-    return hit / len(topk_results)
-
-
-def ndcg_k(topk_results, k):
-    """Calculate ndcg@k metric"""
-    ndcg = 0.0
-    for row in topk_results:
-        dcg = 0.0
-        for i in range(min(k, len(row))):
-            if row[i] == 1:
-                dcg += 1.0 / np.log2(i + 2)
-        idcg = 1.0 / np.log2(2)  # Best case: hit at position 1
-        ndcg += dcg / idcg
-    return ndcg / len(topk_results)
-
-
-def get_metrics_results(topk_results, metrics):
-    """Calculate evaluation metrics"""
-    res = {}
-    for m in metrics:
-        if m.lower().startswith("hit"):
-            k = int(m.split("@")[1])
-            res[m] = hit_k(topk_results, k)
-        elif m.lower().startswith("ndcg"):
-            k = int(m.split("@")[1])
-            res[m] = ndcg_k(topk_results, k)
-        else:
-            raise NotImplementedError(f"Metric {m} not implemented")
-    
-    return res
-
-
-def extract_assistant_response(generated_text):
-    """Extract assistant response from generated text"""
-    # Try to extract content after </think>
-    if "</think>" in generated_text:
-        response_part = generated_text.split("</think>")[-1].strip()
-        # Extract only the SID part using the existing function
-        return extract_sid_from_text(response_part)
-    
-    # Fallback to assistant pattern
-    if "<|im_start|>assistant" in generated_text:
-        parts = generated_text.split("<|im_start|>assistant")
-        if len(parts) > 1:
-            assistant_response = parts[1]
-            if "<|im_end|>" in assistant_response:
-                assistant_response = assistant_response.split("<|im_end|>")[0]
-            # Extract only the SID part from the assistant response
-            return extract_sid_from_text(assistant_response.strip())
-    
-    # Final fallback - try to extract SID from the entire text
-    return extract_sid_from_text(generated_text)
-
-
-def run_evaluation(args):
+def run_evaluation(args, trie=None, progress_queue=None):
     """Main evaluation function"""
     set_seed(args.seed)
     logger = setup_logging(args.log_file)
     logger.info(f"🚀 Starting Two-stage Model Hit Rate Evaluation [GPU {args.gpu_id}]")
     logger.info(f"Args: {vars(args)}")
     
-    # 1. Load merged model
+    # 1. Load merged model (the vLLM engine loads its own copy)
     logger.info("=" * 60)
-    logger.info("Loading merged model...")
-    final_model, tokenizer = load_merged_model(
-        args.merged_model_path, 
-        args.additional_lora_path, 
-        logger
-    )
-    final_model.eval()
+    if args.backend == "vllm" and vllm_available():
+        if args.additional_lora_path:
+            raise ValueError("--additional_lora_path is not supported with --backend vllm, merge the LoRA first")
+        logger.info("Loading tokenizer for the vLLM backend...")
+        final_model = None
+        tokenizer = load_tokenizer(args.merged_model_path)
+    else:
+        if args.backend == "vllm":
+            logger.warning("⚠️ vLLM or CUDA not available, running the trie beam search with HF forward passes")
+        logger.info("Loading merged model...")
+        final_model, tokenizer = load_merged_model(
+            args.merged_model_path, 
+            args.additional_lora_path, 
+            logger
+        )
+        final_model.eval()
     
     # 2. Load test dataset
     logger.info("📊 Loading test dataset...")
     if not os.path.exists(args.test_parquet_file):
         raise FileNotFoundError(f"Parquet file not found: {args.test_parquet_file}")
     
-    test_dataset = ParquetTestDataset(args.test_parquet_file, args.sample_num, args.sample_offset, logger)
-    prefix_allowed_tokens_fn = test_dataset.get_prefix_allowed_tokens_fn(tokenizer, args.global_trie_file)
+    if args.work_queue:
+        # Rows are handed out in chunks by the work queue, so the whole file is loaded
+        test_dataset = ParquetTestDataset(args.test_parquet_file, logger=logger)
+    else:
+        test_dataset = ParquetTestDataset(args.test_parquet_file, args.sample_num, args.sample_offset, logger)
+    sid_logits_processor = test_dataset.get_sid_logits_processor(tokenizer, args.global_trie_file, trie)
     logger.info(f"Using parquet file: {args.test_parquet_file}")
     if args.global_trie_file:
         logger.info(f"✅ Global trie file: {args.global_trie_file}")
     logger.info("✅ SID constrained generation enabled")
     
+    if args.token_cache_dir:
+        token_cache = TokenCache.open_or_build(
+            args.token_cache_dir, args.test_parquet_file, tokenizer, format_chat_prompt, PROMPT_TEMPLATE_VERSION, logger
+        )
+        test_dataset.attach_token_cache(token_cache)
+    
+    # Per-sample results sink; with --resume, samples already written are skipped
+    result_sink = None
+    resumed_results = {}
+    if args.results_dir:
+        result_sink = ResultSink(args.results_dir, f"gpu{args.gpu_id}", args.results_flush_every)
+        logger.info(f"💾 Writing per-sample results to: {args.results_dir}")
+        if args.resume and args.work_queue:
+            # Done samples are skipped (and counted) by whichever worker claims their chunk
+            resumed_results = result_sink.completed()
+            logger.info(f"♻️ Resuming: {len(resumed_results)} samples already done")
+        elif args.resume:
+            resumed_results = result_sink.completed(args.sample_offset, args.sample_offset + len(test_dataset))
+            test_dataset.skip_samples(resumed_results)
+            logger.info(f"♻️ Resuming: {len(resumed_results)} samples already done, {len(test_dataset)} remaining")
+    elif args.resume:
+        raise ValueError("--resume requires --results_dir")
+    
     collator = TestCollator(args, tokenizer)
-    test_loader = DataLoader(
-        test_dataset,
-        batch_size=args.test_batch_size,
-        collate_fn=collator,
-        shuffle=False,
-        num_workers=0,  # Use 0 for compatibility
-        pin_memory=True
-    )
+    
+    # Optional length bucketing: batches of similar prompt length pad less
+    make_batches = None
+    if args.length_bucketing or args.max_batch_tokens > 0:
+        prompt_lengths = test_dataset.prompt_lengths(tokenizer, format_chat_prompt)
+        
+        def make_batches(indices):
+            return length_sorted_batches(indices, prompt_lengths, args.test_batch_size, args.max_batch_tokens)
+        
+        positions = np.arange(len(test_dataset))
+        fixed = [positions[i:i + args.test_batch_size] for i in range(0, len(positions), args.test_batch_size)]
+        logger.info(f"📏 Length bucketing enabled (max batch tokens: {args.max_batch_tokens or 'off'})")
+        logger.info(f"  Prompt padding: {padding_ratio(fixed, prompt_lengths):.1%} in file order → "
+                    f"{padding_ratio(make_batches(positions), prompt_lengths):.1%} bucketed")
+    
+    queue_sampler = None
+    if args.work_queue:
+        work_queue = WorkQueue(args.work_queue)
+        queue_sampler = QueueBatchSampler(
+            work_queue, args.test_batch_size, f"gpu{args.gpu_id}-{os.getpid()}",
+            skip=resumed_results, before_complete=result_sink.flush if result_sink is not None else None,
+            make_batches=make_batches, defer_complete=args.pipeline
+        )
+        test_loader = DataLoader(
+            test_dataset,
+            batch_sampler=queue_sampler,
+            collate_fn=collator,
+            num_workers=0,
+            pin_memory=True
+        )
+        logger.info(f"📋 Claiming row chunks from work queue: {args.work_queue}")
+    elif make_batches is not None:
+        test_loader = DataLoader(
+            test_dataset,
+            batch_sampler=make_batches(np.arange(len(test_dataset))),
+            collate_fn=collator,
+            num_workers=0,
+            pin_memory=True
+        )
+    else:
+        test_loader = DataLoader(
+            test_dataset,
+            batch_size=args.test_batch_size,
+            collate_fn=collator,
+            shuffle=False,
+            num_workers=0,  # Use 0 for compatibility
+            pin_memory=True
+        )
     
     logger.info(f"📈 Test data size: {len(test_dataset)}")
     
+    # Optional per-batch stage timings (tokenize, generate prefill/decode, constraint, metrics)
+    hooks = create_hooks(args.timing_file, args.timing_format, gpu=args.gpu_id)
+    if hooks is not None:
+        logger.info(f"⏱️ Writing {args.timing_format} stage timings to: {args.timing_file}")
+    
+    trie_search = None
+    if args.backend == "vllm":
+        if final_model is None:
+            logger.info("🚀 Starting vLLM engine...")
+            scorer = VLLMStepScorer(
+                args.merged_model_path, trie_max_fanout(sid_logits_processor.trie),
+                args.vllm_tensor_parallel_size, args.vllm_gpu_memory_utilization, args.seed
+            )
+        else:
+            scorer = HFStepScorer(final_model, tokenizer.pad_token_id)
+        trie_search = TrieBeamSearch(scorer, sid_logits_processor)
+        logger.info(f"🌲 Trie beam search backend: {type(scorer).__name__}")
+    else:
+        planner = GenerationMemoryPlanner.from_model(final_model, args.gen_memory_budget_gb, args.gen_memory_fraction)
+        if planner.budget_bytes is not None:
+            logger.info(f"🧮 Generation memory planner: KV cache {planner.kv_bytes_per_token / 1024:.1f} KiB/token, "
+                        f"budget {format_bytes(planner.budget_bytes)}")
+        else:
+            logger.info("🧮 Generation memory planner: no budget on CPU, batches run whole")
+    
     # 3. Start evaluation
     metrics = args.metrics.split(",")
-    all_topk_results = []  # 累积所有样本的topk结果
-    total = 0
+    # Running metric sums over ranked hit vectors; SIDs are compared as trie item ids
+    accumulator = MetricAccumulator(metrics)
+    if queue_sampler is None:
+        accumulator.update_rows(resumed_results.values())
+    item_index = ItemIndex(sid_logits_processor.trie.sids)
     
     logger.info("🚀 Starting evaluation...")
     
     import time
     start_time = time.time()
     
+    def tokenize_batch(batch, tokenizer=tokenizer):
+        """Encode the batch prompts unless the token cache already did"""
+        if batch["encoded"] is None:
+            with timed(hooks, "tokenize"):
+                batch["encoded"] = tokenizer(
+                    batch["inputs"],
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                    max_length=tokenizer.model_max_length
+                )
+        return batch
+    
+    def postprocess_batch(step, batch, think_texts, candidate_items, scores_list, num_beams):
+        """Log, rank and record one generated batch"""
+        inputs_texts = batch["inputs"]
+        targets = batch["targets"]
+        bs = len(targets)
+        
+        # Print generations if requested
+        if args.print_generations:
+            for i in range(bs):
+                start = i * num_beams
+                end = start + num_beams
+                cands = item_index.to_sids(candidate_items[start:end])
+                cand_scores = scores_list[start:end]
+                
+                logger.info(f"----- SAMPLE {batch['sample_indices'][i]} -----")
+                if args.enable_cot and think_texts[i]:
+                    logger.info(f"THINK: {think_texts[i]}")
+                
+                # Show the complete prompt
+                logger.info(f"PROMPT: {inputs_texts[i]}")
+                
+                logger.info("RESPONSE_CANDIDATES:")
+                for j, (c, sc) in enumerate(zip(cands, cand_scores)):
+                    logger.info(f"  Rank {j+1}: score={sc:.4f} → {c}")
+                logger.info(f"TARGET: {targets[i]}")
+                logger.info("-" * 50)
+        
+        # Rank candidates and mark hits (no filtering needed since the exact trie constrains generation)
+        with timed(hooks, "metrics"):
+            hits = topk_hit_matrix(
+                candidate_items.reshape(bs, num_beams),
+                np.asarray(scores_list, dtype=np.float64).reshape(bs, num_beams),
+                item_index.lookup([extract_sid_from_text(t) for t in targets])
+            )
+            accumulator.update(hits)
+        if hooks is not None:
+            hooks.end_batch(step, bs)
+        if progress_queue is not None:
+            progress_queue.put(("batch", args.gpu_id, hits))
+        if result_sink is not None:
+            result_sink.add_batch(
+                batch["sample_indices"], batch["user_ids"], targets,
+                item_index.to_sids(candidate_items), scores_list, hits, num_beams
+            )
+        if queue_sampler is not None and queue_sampler.defer_complete:
+            queue_sampler.complete_evaluated(step + 1)
+        
+        # Progress report every 50 steps
+        if (step + 1) % 50 == 0:
+            # Calculate metrics on accumulated results so far
+            temp_metrics_results = accumulator.results()
+            logger.info("=" * 50)
+            logger.info(f"📊 PROGRESS REPORT - Step {step+1}/{len(test_loader)}")
+            logger.info(f"💾 Processed samples: {accumulator.count}")
+            logger.info("📈 Current Metrics:")
+            for metric, value in temp_metrics_results.items():
+                logger.info(f"  {metric:>10}: {value:.4f}")
+            logger.info("=" * 50)
+    
+    # With --pipeline, batch N+1 is tokenized (and pinned) on a prefetch thread and
+    # batch N-1 post-processed on another while batch N generates; both run in order
+    batches = test_loader
+    post = PostProcessor(enabled=args.pipeline)
+    if args.pipeline:
+        # The prefetch thread gets its own tokenizer; fast tokenizers are not safe to share across threads
+        prefetch_tokenizer = copy.deepcopy(tokenizer)
+        pin = final_model is not None and final_model.device.type == "cuda"
+        
+        def prepare(batch):
+            batch = tokenize_batch(batch, prefetch_tokenizer)
+            if pin:
+                batch["encoded"] = {k: v.pin_memory() for k, v in batch["encoded"].items()}
+            return batch
+        
+        batches = Prefetcher(test_loader, prepare)
+        logger.info("🔀 Pipelined evaluation: prefetching and post-processing batches on threads")
+    
     with torch.no_grad():
-        progress_bar = tqdm(test_loader, desc="Testing")
+        progress_bar = tqdm(batches, desc="Testing")
         for step, batch in enumerate(progress_bar):
             inputs_texts = batch["inputs"]
             targets = batch["targets"]
@@ -541,7 +654,7 @@ def run_evaluation(args):
             
             # Calculate progress information
             current_step = step + 1
-            total_steps = len(test_loader)
+            total_steps = len(batches)
             elapsed = time.time() - start_time
             if current_step > 0:
                 avg_time = elapsed / current_step
@@ -566,122 +679,55 @@ def run_evaluation(args):
 
             # === Generate SID directly (no CoT, no Response: prefix) ===
             # Use the formatted prompt as-is, which ends with </think>\n
-            response_inputs_texts = inputs_texts
-            
-            # Encode inputs
-            enc = tokenizer(
-                response_inputs_texts,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=tokenizer.model_max_length
-            )
-            enc = {k: v.to(final_model.device) for k, v in enc.items()}
-            
-            # Debug: Check tensor devices in Response stage  
-            logger.info(f"🔍 Response stage device info:")
-            logger.info(f"  Input tensor device: {enc['input_ids'].device}")
-            logger.info(f"  Model device: {next(final_model.parameters()).device}")
-            
-            # Beam search generation
+            # Encode inputs (already tokenized when a token cache is attached or the batch was prefetched)
+            enc = tokenize_batch(batch)["encoded"]
             num_beams = args.num_beams
-            while True:
-                try:
-                    generate_kwargs = {
-                        "input_ids": enc["input_ids"],
-                        "attention_mask": enc.get("attention_mask", None),
-                        "max_new_tokens": args.max_new_tokens,
-                        "num_beams": num_beams,
-                        "num_return_sequences": num_beams,
-                        "output_scores": True,
-                        "return_dict_in_generate": True,
-                        "early_stopping": True,
-                        "temperature": args.temperature,
-                        "top_p": args.top_p,
-                    }
-                    
-                    # Add SID constrained generation
-                    if prefix_allowed_tokens_fn is not None:
-                        generate_kwargs["prefix_allowed_tokens_fn"] = prefix_allowed_tokens_fn
-                    
-                    output = final_model.generate(**generate_kwargs)
-                    break
-                except RuntimeError as e:
-                    err = str(e).lower()
-                    if "out of memory" in err or "cuda" in err:
-                        logger.warning(f"CUDA OOM with beam={num_beams}. Reducing beam size.")
-                        num_beams -= 1
-                        if num_beams < 1:
-                            raise RuntimeError("Beam search OOM even with beam=1") from e
-                        torch.cuda.empty_cache()
-                    else:
-                        raise
-            
-            # Decode output
-            output_ids = output["sequences"]
-            scores = output.get("sequences_scores", None)
-            decoded = tokenizer.batch_decode(
-                output_ids,
-                skip_special_tokens=False,
-                clean_up_tokenization_spaces=False,
-            )
-            
-            # Process scores (always needed for metrics calculation)
-            if scores is not None:
-                if hasattr(scores, 'detach'):
-                    scores_list = [float(s) for s in scores.detach().cpu().tolist()]
-                else:
-                    scores_list = [float(s) for s in scores]
+            if trie_search is not None:
+                # Step-wise trie beam search on unpadded prompt token ids
+                prompt_ids = [ids[mask.bool()].tolist() for ids, mask in zip(enc["input_ids"], enc["attention_mask"])]
+                with timed(hooks, "trie_search"):
+                    candidate_items, scores_list = trie_search.generate(prompt_ids, num_beams, args.max_new_tokens)
             else:
-                scores_list = [0.0] * len(decoded)
-            
-            # Print generations if requested
-            if args.print_generations:
-                for i in range(bs):
-                    start = i * num_beams
-                    end = start + num_beams
-                    cands = decoded[start:end]
-                    cand_scores = scores_list[start:end]
-                    
-                    logger.info(f"----- SAMPLE {step*bs + i} -----")
-                    if args.enable_cot and think_texts[i]:
-                        logger.info(f"THINK: {think_texts[i]}")
-                    
-                    # Show the complete prompt
-                    logger.info(f"PROMPT: {inputs_texts[i]}")
-                    
-                    logger.info("RESPONSE_CANDIDATES:")
-                    for j, (c, sc) in enumerate(zip(cands, cand_scores)):
-                        response = extract_assistant_response(c)
-                        logger.info(f"  Rank {j+1}: score={sc:.4f} → {response}")
-                    logger.info(f"TARGET: {targets[i]}")
-                    logger.info("-" * 50)
-            
-            # Calculate topk results (no additional filtering needed since exact trie already constrains generation)
-            topk_res = get_topk_results(
-                decoded, scores_list, 
-                targets, num_beams,
-                all_items=None
-            )
-            
-            # Accumulate all topk results (extend instead of sum)
-            all_topk_results.extend(topk_res)
-            total += bs
+                enc = {k: v.to(final_model.device, non_blocking=True) for k, v in enc.items()}
+                
+                # Debug: Check tensor devices in Response stage  
+                logger.info(f"🔍 Response stage device info:")
+                logger.info(f"  Input tensor device: {enc['input_ids'].device}")
+                logger.info(f"  Model device: {next(final_model.parameters()).device}")
+                
+                # Beam search generation in planned sub-batches; the beam width stays fixed
+                prompt_lengths = enc["attention_mask"].sum(dim=1).tolist()
+                plan = planner.plan(prompt_lengths, args.max_new_tokens, num_beams)
+                logger.info(f"🧮 Generation plan: {planner.describe(plan, prompt_lengths, args.max_new_tokens, num_beams)}")
+                
+                generate_kwargs = {
+                    "max_new_tokens": args.max_new_tokens,
+                    "num_beams": num_beams,
+                    "num_return_sequences": num_beams,
+                    "output_scores": True,
+                    "return_dict_in_generate": True,
+                    "early_stopping": True,
+                    "temperature": args.temperature,
+                    "top_p": args.top_p,
+                }
+                candidate_items, scores_list = generate_in_sub_batches(
+                    final_model, enc, plan, generate_kwargs, sid_logits_processor, logger, hooks
+                )
             
-            # Progress report every 50 steps
-            if (step + 1) % 50 == 0:
-                # Calculate metrics on accumulated results so far
-                temp_metrics_results = get_metrics_results(all_topk_results, metrics)
-                logger.info("=" * 50)
-                logger.info(f"📊 PROGRESS REPORT - Step {step+1}/{len(test_loader)}")
-                logger.info(f"💾 Processed samples: {total}")
-                logger.info("📈 Current Metrics:")
-                for metric, value in temp_metrics_results.items():
-                    logger.info(f"  {metric:>10}: {value:.4f}")
-                logger.info("=" * 50)
+            post.submit(postprocess_batch, step, batch, think_texts, candidate_items, scores_list, num_beams)
+    
+    post.close()
+    if queue_sampler is not None:
+        queue_sampler.complete_evaluated()
+        accumulator.update_rows(resumed_results[i] for i in queue_sampler.skipped)
+        work_queue.close()
+    total = accumulator.count
+    
+    if result_sink is not None:
+        result_sink.close()
     
     # 4. Final results - calculate metrics on all accumulated results
-    final_metrics_results = get_metrics_results(all_topk_results, metrics)
+    final_metrics_results = accumulator.results()
     
     logger.info("=" * 60)
     logger.info("🎯 Final Hit Rate Results:")
@@ -690,6 +736,19 @@ def run_evaluation(args):
         logger.info(f"{metric:>10}: {value:.4f}")
     logger.info("=" * 60)
     
+    if args.metrics_file:
+        write_shard_metrics(
+            args.metrics_file, total, accumulator.sums,
+            gpu_id=args.gpu_id, sample_offset=args.sample_offset,
+            merged_model_path=args.merged_model_path, test_parquet_file=args.test_parquet_file
+        )
+        logger.info(f"💾 Shard metrics saved to: {args.metrics_file}")
+    if progress_queue is not None:
+        progress_queue.put(("done", args.gpu_id, total, accumulator.sums))
+    if hooks is not None:
+        hooks.close()
+        logger.info(f"⏱️ Stage timings saved to: {args.timing_file}")
+    
     # 5. Test summary
     logger.info("\n📊 Test Summary:")
     logger.info(f"Merged model: {args.merged_model_path}")
@@ -699,6 +758,7 @@ def run_evaluation(args):
     logger.info(f"Total samples: {total}")
     logger.info(f"Batch size: {args.test_batch_size}")
     logger.info(f"Beam size: {args.num_beams}")
+    logger.info(f"Backend: {args.backend}")
     logger.info(f"CoT enabled: {args.enable_cot}")
     if args.enable_cot:
         logger.info(f"Think max tokens: {args.think_max_tokens}")
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
 import json
 import os
 import sys
@@ -19,6 +20,18 @@ import re
 from collections import defaultdict
 from typing import List, Dict, Any, Callable
 
+from aggregate_metrics import write_shard_metrics
+from eval_hooks import create_hooks, logits_processors, timed, timed_generate
+from eval_pipeline import PostProcessor, Prefetcher
+from generation_planner import GenerationMemoryPlanner, format_bytes, generate_in_sub_batches, is_oom_error
+from length_batching import length_sorted_batches, padding_ratio
+from result_sink import ResultSink
+from sid_constraint import SIDLogitsProcessor
+from sid_trie import SIDTrie
+from token_cache import TokenCache, pad_left
+from topk_metrics import ItemIndex, MetricAccumulator, topk_hit_matrix
+from work_queue import QueueBatchSampler, WorkQueue
+
 
 def extract_all_sids_from_text(text):
     import re
@@ -36,7 +49,7 @@ def extract_sid_from_text(text):
     return text.strip()
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Optimized CoT Model Hit Rate Test")
 
     parser.add_argument("--seed", type=int, default=42, help="Random seed")
@@ -53,10 +66,18 @@ def parse_args():
 
     parser.add_argument("--test_batch_size", type=int, default=1, help="Test batch size")
     parser.add_argument("--num_beams", type=int, default=20, help="Number of beams for beam search")
+    parser.add_argument("--length_bucketing", action="store_true", default=False,
+                        help="batch prompts of similar token length together (results are read back in the original sample order)")
+    parser.add_argument("--max_batch_tokens", type=int, default=0,
+                        help="padded prompt-token budget per batch instead of a fixed --test_batch_size, implies --length_bucketing")
     parser.add_argument("--sample_num", type=int, default=-1,
                         help="test sample number, -1 represents using all test data")
     parser.add_argument("--sample_offset", type=int, default=0,
                         help="sample offset for multi-GPU parallel processing")
+    parser.add_argument("--token_cache_dir", type=str, default=None,
+                        help="directory of pre-tokenized prompt caches (see token_cache.py), built on a miss")
+    parser.add_argument("--work_queue", type=str, default=None,
+                        help="SQLite work queue (see work_queue.py) to claim row chunks from instead of --sample_offset/--sample_num")
     parser.add_argument("--gpu_id", type=int, default=0,
                         help="GPU ID for logging purposes")
     parser.add_argument("--metrics", type=str, default="hit@1,hit@5,hit@10,ndcg@5,ndcg@10",
@@ -80,16 +101,40 @@ def parse_args():
                         help="number of thinking samples to generate")
     parser.add_argument("--num_beams_per_sample", type=int, default=4,
                         help="number of beams for each thinking sample")
+    parser.add_argument("--reuse_think_cache", action="store_true", default=False,
+                        help="continue SID beam search from the think-stage KV cache instead of re-prefilling the prompt")
+    parser.add_argument("--share_prompt_cache", action="store_true", default=False,
+                        help="prefill the system prefix once and each think prompt once, then fork its KV cache across thinking samples")
+    parser.add_argument("--sid_batch_size", type=int, default=0,
+                        help="max (sample, thinking) prompts tokenized per SID beam search chunk, 0 packs the whole batch")
+    parser.add_argument("--gen_memory_budget_gb", type=float, default=0.0,
+                        help="memory budget for SID generate() sub-batch planning, 0 uses a fraction of free CUDA memory")
+    parser.add_argument("--gen_memory_fraction", type=float, default=0.85,
+                        help="fraction of free CUDA memory available to SID generate() when no budget is given")
 
     parser.add_argument("--print_generations", action="store_true", default=False,
                         help="print prompts, think, and response candidates")
     parser.add_argument("--log_file", type=str,
                         default="./logs/cot_optimized_test.log",
                         help="all output log file path")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="JSON file for this shard's sample count and metric sums (see aggregate_metrics.py)")
+    parser.add_argument("--results_dir", type=str, default=None,
+                        help="directory for append-only per-sample result parquet parts")
+    parser.add_argument("--results_flush_every", type=int, default=64,
+                        help="samples buffered before a result part is written")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="skip samples already present in --results_dir")
     parser.add_argument("--global_trie_file", type=str, default=None,
                         help="Pre-computed global trie file for parallel evaluation")
+    parser.add_argument("--timing_file", type=str, default=None,
+                        help="per-batch stage timings and counters (see eval_hooks.py); off when unset")
+    parser.add_argument("--timing_format", type=str, choices=["jsonl", "prometheus"], default="jsonl",
+                        help="timing file format: one JSON line per batch, or a Prometheus text file of running totals")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="tokenize the next batch and post-process the previous one on threads while generating")
     
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def set_seed(seed):
@@ -124,6 +169,10 @@ def setup_logging(log_file):
     return logger
 
 
+# Bump when the think prompt template changes; keys the pre-tokenized prompt cache
+THINK_PROMPT_TEMPLATE_VERSION = "cot_think_v1"
+
+
 def format_chat_prompt_think_stage(user_content):
     system_message = "You are a professional recommendation expert who needs to recommend the next possible purchase for users based on their purchase history. Please predict the most likely next product that the user will purchase based on the user's historical purchase information."
     
@@ -253,6 +302,27 @@ class ParquetTestDataset(Dataset):
         for col in required_cols:
             if col not in self.df.columns:
                 raise ValueError(f"Required column '{col}' not found in parquet file. Available: {list(self.df.columns)}")
+        
+        # Index rows by their position in the parquet file, so results stay identifiable across shards and restarts
+        self.df.index = pd.RangeIndex(sample_offset, sample_offset + len(self.df))
+        self.token_cache = None
+    
+    def skip_samples(self, sample_indices):
+        """Drop samples whose parquet row index is in sample_indices"""
+        self.df = self.df[~self.df.index.isin(list(sample_indices))]
+    
+    def attach_token_cache(self, token_cache):
+        """Serve pre-tokenized prompts (indexed by parquet row) alongside the text columns"""
+        if len(token_cache) < self.df.index.max() + 1:
+            raise ValueError(f"Token cache has {len(token_cache)} rows, parquet row {self.df.index.max()} requested")
+        self.token_cache = token_cache
+    
+    def prompt_lengths(self, tokenizer, format_prompt):
+        """Token length of every row's formatted prompt"""
+        if self.token_cache is not None:
+            return self.token_cache.lengths[self.df.index.to_numpy()]
+        prompts = [format_prompt(text) for text in self.df['description']]
+        return np.array([len(ids) for ids in tokenizer(prompts)["input_ids"]], dtype=np.int64)
     
     def __len__(self):
         return len(self.df)
@@ -262,43 +332,35 @@ class ParquetTestDataset(Dataset):
         return {
             'input_ids': row['description'],
             'labels': row['groundtruth'],
-            'user_id': row.get('user_id', f'user_{idx}')
+            'user_id': row.get('user_id', f'user_{idx}'),
+            'sample_index': int(self.df.index[idx]),
+            'prompt_ids': self.token_cache[self.df.index[idx]] if self.token_cache is not None else None
         }
     
-    def get_prefix_allowed_tokens_fn(self, tokenizer, global_trie_file=None):
-        """Create prefix allowed tokens function for SID constrained generation based on exact trie"""
-        
-        if not global_trie_file:
-            raise ValueError("Global trie file path must be provided")
-        
-        if not os.path.exists(global_trie_file):
-            raise FileNotFoundError(f"Global trie file not found: {global_trie_file}. Please run precompute_global_trie.py first.")
+    def get_sid_logits_processor(self, tokenizer, global_trie_file=None, trie=None):
+        """Create a batched logits processor for SID constrained generation based on the prefix trie"""
         
-        # Load pre-computed exact trie
-        self.logger.info(f"Loading pre-computed exact trie from: {global_trie_file}")
-        import pickle
-        with open(global_trie_file, 'rb') as f:
-            trie_data = pickle.load(f)
-        
-        # Verify this is an exact trie
-        trie_type = trie_data.get('trie_type', None)
-        if trie_type != 'exact':
-            raise ValueError(f"Expected exact trie file, but got trie_type='{trie_type}'. Please regenerate the trie file.")
-        
-        # Load exact trie structure
-        allowed_tokens = trie_data['exact_trie']
-        valid_sids = trie_data['valid_sids']
-        search_space_size = trie_data.get('search_space_size', 0)
-        max_length = trie_data.get('max_length', 0)
+        if trie is not None:
+            # Shared by the evaluation driver (see eval_driver.py)
+            self.logger.info("Using prefix trie shared by the evaluation driver")
+        else:
+            if not global_trie_file:
+                raise ValueError("Global trie file path must be provided")
+
+            if not os.path.exists(global_trie_file):
+                raise FileNotFoundError(f"Global trie file not found: {global_trie_file}. Please run precompute_global_trie.py first.")
+
+            # Load pre-computed prefix trie
+            self.logger.info(f"Loading pre-computed prefix trie from: {global_trie_file}")
+            trie = SIDTrie.load(global_trie_file)
         
-        self.logger.info(f"Loaded exact trie for CoT:")
-        self.logger.info(f"  Total unique SIDs: {len(valid_sids)}")
-        self.logger.info(f"  Search space size: {search_space_size:,} (exact match only)")
-        self.logger.info(f"  Trie depth: {max_length}")
+        self.logger.info(f"Loaded prefix trie for CoT:")
+        self.logger.info(f"  Total unique SIDs: {trie.num_items}")
+        self.logger.info(f"  Search space size: {trie.num_items:,} (catalog items only)")
+        self.logger.info(f"  Trie depth: {trie.max_length}")
+        self.logger.info(f"  Trie nodes: {trie.num_nodes:,}")
         
-        for pos in range(min(6, max_length)):
-            num_tokens = len(allowed_tokens.get(pos, {}))
-            self.logger.info(f"  Position {pos}: {num_tokens} possible tokens")
+        eos_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else 0
         
         # Get "</think>" separator with newline (to match our prompt format)
         sep = tokenizer("</think>\n", add_special_tokens=False)["input_ids"]
@@ -307,54 +369,8 @@ class ParquetTestDataset(Dataset):
         self.logger.info(f"  </think>\\n tokens: {sep}")
         self.logger.info(f"  Direct SID generation after </think>\\n")
         
-        def find_last_sublist(lst, sub):
-            """Find the last occurrence of sublist in list"""
-            if not sub:
-                return None
-            n, m = len(lst), len(sub)
-            for start in range(n - m, -1, -1):
-                if lst[start:start + m] == sub:
-                    return start
-            return None
-        
-        def prefix_allowed_tokens_fn(batch_id, sentence):
-            """Return allowed tokens based on current generation position using exact trie"""
-            sentence = sentence.tolist()
-            
-            # Find "</think>" position
-            pos = find_last_sublist(sentence, sep)
-            if pos is None:
-                # Before "</think>", allow all tokens
-                return list(tokenizer.get_vocab().values())
-            
-            # Calculate position after "</think>" - directly apply SID constraints
-            pos_after_sep = pos + len(sep)
-            generated_after_sep = sentence[pos_after_sep:]
-            sid_pos = len(generated_after_sep)
-            
-            # Use exact trie: check what tokens are allowed at this SID position
-            if sid_pos == 0:
-                # First SID token position - should be <|sid_begin|>
-                if 0 in allowed_tokens:
-                    allowed = list(allowed_tokens[0].keys())
-                    return allowed
-                else:
-                    # Allow all tokens if trie is not properly set up
-                    return list(tokenizer.get_vocab().values())
-            else:
-                # Look up what's allowed based on previous SID tokens
-                if sid_pos > 0 and len(generated_after_sep) >= sid_pos:
-                    prev_token = generated_after_sep[sid_pos - 1]
-                    prev_pos = sid_pos - 1
-                    
-                    if prev_pos in allowed_tokens and prev_token in allowed_tokens[prev_pos]:
-                        allowed = allowed_tokens[prev_pos][prev_token]
-                        return allowed
-                
-                # Fallback to allow all tokens if no valid continuation found
-                return list(tokenizer.get_vocab().values())
-        
-        return prefix_allowed_tokens_fn
+        # Prefixes outside the catalog fall back to allowing all tokens
+        return SIDLogitsProcessor(trie, sep, eos_id, fallback_allow_all=True)
 
 
 class TestCollator:
@@ -373,11 +389,83 @@ class TestCollator:
         
         return {
             "user_contents": user_contents,
-            "targets": targets
+            "targets": targets,
+            "user_ids": [d["user_id"] for d in batch],
+            "sample_indices": [d["sample_index"] for d in batch],
+            "prompt_ids": [d["prompt_ids"] for d in batch] if batch[0]["prompt_ids"] is not None else None
         }
 
 
-def batch_generate_thinking_optimized(model, tokenizer, user_contents, args, logger):
+def repeat_cache_rows(past_key_values, repeats):
+    """Repeat every cached row `repeats` times, matching generate()'s input expansion"""
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(
+        tuple(t.repeat_interleave(repeats, dim=0) for t in layer)
+        for layer in past_key_values
+    )
+
+
+class SharedPromptCache:
+    """KV cache of the system prefix shared by every think prompt
+
+    The prefix is prefilled once per process. Prompts are laid out as
+    [system prefix, left padding, user turn], so the prefix occupies the same
+    columns in every row and its cache can be copied to any batch size; position
+    ids follow the attention mask, so the padding gap does not shift positions.
+    """
+
+    def __init__(self, model, tokenizer, logger):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix = format_chat_prompt_think_stage("").split("<|im_start|>user")[0]
+        self.prefix_ids = tokenizer(self.prefix, return_tensors="pt")["input_ids"].to(model.device)
+        with torch.no_grad():
+            self.past_key_values = model(input_ids=self.prefix_ids, use_cache=True).past_key_values
+        logger.info(f"♻️ Shared system prefix cache: {self.prefix_ids.shape[1]} tokens")
+
+    def prefill(self, prompts, num_samples):
+        """Prefill each prompt once and fork its cache num_samples times
+
+        Returns input_ids / attention_mask for the repeated prompts and a cache
+        covering all but their last token, ready to be passed to generate().
+        """
+        for prompt in prompts:
+            if not prompt.startswith(self.prefix):
+                raise ValueError("Think prompt does not start with the shared system prefix")
+        enc = self.tokenizer(
+            [prompt[len(self.prefix):] for prompt in prompts],
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False
+        )
+        num_rows = len(prompts)
+        prefix_len = self.prefix_ids.shape[1]
+        input_ids = torch.cat([self.prefix_ids.expand(num_rows, -1), enc["input_ids"].to(self.model.device)], dim=1)
+        attention_mask = torch.cat([
+            torch.ones(num_rows, prefix_len, dtype=torch.long, device=self.model.device),
+            enc["attention_mask"].to(self.model.device)
+        ], dim=1)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        past_key_values = repeat_cache_rows(copy.deepcopy(self.past_key_values), num_rows)
+        past_key_values = self.model(
+            input_ids=input_ids[:, prefix_len:-1],
+            attention_mask=attention_mask[:, :-1],
+            position_ids=position_ids[:, prefix_len:-1],
+            past_key_values=past_key_values,
+            use_cache=True
+        ).past_key_values
+
+        past_key_values = repeat_cache_rows(past_key_values, num_samples)
+        return (input_ids.repeat_interleave(num_samples, dim=0),
+                attention_mask.repeat_interleave(num_samples, dim=0),
+                past_key_values)
+
+
+def batch_generate_thinking_optimized(model, tokenizer, user_contents, args, logger, prompt_cache=None,
+                                      think_prompt_ids=None, hooks=None):
     logger.info("🚀 Optimized batch thinking generation started...")
 
     all_think_prompts = []
@@ -391,32 +479,58 @@ def batch_generate_thinking_optimized(model, tokenizer, user_contents, args, log
     
     logger.info(f"📊 Batch thinking: {len(all_think_prompts)} prompts for {len(user_contents)} samples × {args.num_thinking_samples} thinking samples")
 
-    enc_think_batch = tokenizer(
-        all_think_prompts,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=tokenizer.model_max_length
-    )
-    enc_think_batch = {k: v.to(model.device) for k, v in enc_think_batch.items()}
+    past_key_values = None
+    if prompt_cache is not None:
+        # Every thinking sample of a prompt shares its prefill; only the sampled tokens differ
+        unique_prompts = all_think_prompts[::args.num_thinking_samples]
+        with timed(hooks, "think_shared_prefill"):
+            input_ids, attention_mask, past_key_values = prompt_cache.prefill(unique_prompts, args.num_thinking_samples)
+        enc_think_batch = {"input_ids": input_ids, "attention_mask": attention_mask}
+        logger.info(f"♻️ Prefilled {len(unique_prompts)} unique think prompts once for {len(all_think_prompts)} rows")
+    elif think_prompt_ids is not None:
+        # Pre-tokenized think prompts from the token cache
+        enc_think_batch = pad_left(
+            [ids for ids in think_prompt_ids for _ in range(args.num_thinking_samples)], tokenizer.pad_token_id
+        )
+        enc_think_batch = {k: v.to(model.device) for k, v in enc_think_batch.items()}
+    else:
+        with timed(hooks, "tokenize"):
+            enc_think_batch = tokenizer(
+                all_think_prompts,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=tokenizer.model_max_length
+            )
+        enc_think_batch = {k: v.to(model.device) for k, v in enc_think_batch.items()}
+
+    # When the SID stage continues from the think cache, stop each row at </think>
+    eos_token_id = None
+    if args.reuse_think_cache:
+        eos_token_id = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("</think>")]
 
     logger.info("🤔 Generating all thinking samples in parallel...")
-    think_outputs = model.generate(
-        input_ids=enc_think_batch["input_ids"],
-        attention_mask=enc_think_batch.get("attention_mask", None),
-        max_new_tokens=args.think_max_tokens,
-        num_beams=1,
-        do_sample=True,
-        temperature=args.think_temperature,
-        top_p=args.think_top_p,
-        return_dict_in_generate=True,
-        output_scores=False,
-        early_stopping=False,
-        use_cache=True,
-        output_hidden_states=False
-    )
+    with timed_generate(hooks, "think"):
+        think_outputs = model.generate(
+            input_ids=enc_think_batch["input_ids"],
+            attention_mask=enc_think_batch.get("attention_mask", None),
+            past_key_values=past_key_values,
+            eos_token_id=eos_token_id,
+            max_new_tokens=args.think_max_tokens,
+            num_beams=1,
+            do_sample=True,
+            temperature=args.think_temperature,
+            top_p=args.think_top_p,
+            return_dict_in_generate=True,
+            output_scores=False,
+            early_stopping=False,
+            use_cache=True,
+            output_hidden_states=False,
+            logits_processor=logits_processors(hooks, "think")
+        )
 
-    think_decoded_all = tokenizer.batch_decode(think_outputs["sequences"], skip_special_tokens=True)
+    with timed(hooks, "think_detokenize"):
+        think_decoded_all = tokenizer.batch_decode(think_outputs["sequences"], skip_special_tokens=True)
 
     all_thinking_contents = [[] for _ in range(len(user_contents))]
     
@@ -426,27 +540,52 @@ def batch_generate_thinking_optimized(model, tokenizer, user_contents, args, log
     
     logger.info(f"✅ Batch thinking generation completed: {len(user_contents)} samples × {args.num_thinking_samples} thinking samples")
     
-    return all_thinking_contents
-
-
-def generate_sid_standard(model, tokenizer, user_content, thinking_content,
-                        prefix_allowed_tokens_fn, args, logger):
-    sid_prompt = format_chat_prompt_sid_stage(user_content, thinking_content)
+    think_state = None
+    if args.reuse_think_cache:
+        think_state = {
+            "sequences": think_outputs["sequences"],
+            "prompt_attention_mask": enc_think_batch["attention_mask"],
+            "past_key_values": think_outputs["past_key_values"],
+        }
     
-    enc_sid = tokenizer(
-        [sid_prompt],
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
-        max_length=tokenizer.model_max_length
+    return all_thinking_contents, think_state
+
+
+def generate_sid_from_think_cache(model, tokenizer, think_state, sid_logits_processor, args, logger, hooks=None):
+    """Continue SID beam search from the think-stage KV cache instead of re-prefilling
+
+    Each row keeps the think tokens generated before its first </think> (or EOS);
+    the remaining generated positions are masked out, and "</think>\\n" is appended
+    to every row so the SID starts right after the separator. Position ids are
+    derived from the attention mask, so masked gaps do not shift positions.
+    """
+    sequences = think_state["sequences"]
+    prompt_mask = think_state["prompt_attention_mask"]
+    prompt_len = prompt_mask.shape[1]
+    generated = sequences[:, prompt_len:]
+    num_rows, num_generated = generated.shape
+
+    stop_ids = torch.tensor(
+        [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("</think>")],
+        device=sequences.device
     )
-    enc_sid = {k: v.to(model.device) for k, v in enc_sid.items()}
+    is_stop = torch.isin(generated, stop_ids)
+    first_stop = torch.where(is_stop.any(dim=1), is_stop.int().argmax(dim=1), num_generated)
+    keep = torch.arange(num_generated, device=sequences.device).unsqueeze(0) < first_stop.unsqueeze(1)
+
+    suffix = tokenizer("</think>\n", add_special_tokens=False, return_tensors="pt")["input_ids"].to(sequences.device)
+    suffix = suffix.expand(num_rows, -1)
+    input_ids = torch.cat([sequences, suffix], dim=1)
+    attention_mask = torch.cat([prompt_mask, keep.long(), torch.ones_like(suffix)], dim=1)
 
     num_beams = args.num_beams_per_sample
-    
+    past_key_values = repeat_cache_rows(think_state["past_key_values"], num_beams)
+    logger.info(f"♻️ SID generation from think cache: {num_rows} rows × {num_beams} beams, {input_ids.shape[1]} cached positions")
+
     generate_kwargs = {
-        "input_ids": enc_sid["input_ids"],
-        "attention_mask": enc_sid.get("attention_mask", None),
+        "input_ids": input_ids,
+        "attention_mask": attention_mask,
+        "past_key_values": past_key_values,
         "max_new_tokens": args.sid_max_tokens,
         "num_beams": num_beams,
         "num_return_sequences": num_beams,
@@ -455,159 +594,127 @@ def generate_sid_standard(model, tokenizer, user_content, thinking_content,
         "early_stopping": True,
         "use_cache": True,
     }
-    
-    # Add SID constrained generation
-    if prefix_allowed_tokens_fn is not None:
-        generate_kwargs["prefix_allowed_tokens_fn"] = prefix_allowed_tokens_fn
-    
-    try:
+    generate_kwargs["logits_processor"] = logits_processors(hooks, "sid", sid_logits_processor.reset())
+
+    with timed_generate(hooks, "sid"):
         output = model.generate(**generate_kwargs)
-        
-    except RuntimeError as e:
-        err = str(e).lower()
-        if "out of memory" in err or "cuda" in err:
-            logger.warning(f"CUDA OOM with beam={num_beams}. Reducing beam size.")
-            num_beams -= 1
-            if num_beams < 1:
-                raise RuntimeError("Beam search OOM even with beam=1") from e
-            torch.cuda.empty_cache()
-            generate_kwargs["num_beams"] = num_beams
-            generate_kwargs["num_return_sequences"] = num_beams
-            output = model.generate(**generate_kwargs)
-        else:
-            raise
-    
-    return output, num_beams
+
+    # Only the SID tail is needed downstream; map its tokens straight to item ids
+    new_tokens = output["sequences"][:, input_ids.shape[1]:]
+    with timed(hooks, "map_items"):
+        items = sid_logits_processor.generated_items(new_tokens)
+        keys = sid_logits_processor.unmatched_keys(new_tokens, items, model.generation_config.pad_token_id)
+    scores = output.get("sequences_scores", None)
+    if scores is not None:
+        scores_list = [float(s) for s in scores.detach().cpu().tolist()]
+    else:
+        scores_list = [0.0] * len(items)
+    return items, scores_list, keys
+
+
+def batch_generate_sid(model, tokenizer, user_contents, all_thinking_contents,
+                       sid_logits_processor, planner, args, logger, hooks=None):
+    """Constrained SID beam search for every (sample, thinking) prompt in planned sub-batches
+
+    Prompts are tokenized up to --sid_batch_size at a time and each chunk runs
+    as the sub-batches the memory planner gives it. Returns candidate trie item
+    ids (-1 if not a catalog SID), scores and unmatched keys ordered sample-major,
+    then thinking sample, then beam, as expected by process_unique_top10_candidates.
+    """
+    sid_prompts = []
+    for sample_idx, user_content in enumerate(user_contents):
+        for thinking_content in all_thinking_contents[sample_idx]:
+            sid_prompts.append(format_chat_prompt_sid_stage(user_content, thinking_content))
+
+    num_beams = args.num_beams_per_sample
+    chunk_size = args.sid_batch_size if args.sid_batch_size > 0 else len(sid_prompts)
+    logger.info(f"📊 Batch SID generation: {len(sid_prompts)} prompts × {num_beams} beams, up to {chunk_size} prompts per call")
+
+    generate_kwargs = {
+        "max_new_tokens": args.sid_max_tokens,
+        "num_beams": num_beams,
+        "num_return_sequences": num_beams,
+        "output_scores": True,
+        "return_dict_in_generate": True,
+        "early_stopping": True,
+        "use_cache": True,
+    }
+
+    all_items = []
+    all_scores = []
+    all_keys = []
+    for start in range(0, len(sid_prompts), chunk_size):
+        chunk_prompts = sid_prompts[start:start + chunk_size]
+        with timed(hooks, "tokenize"):
+            enc_sid = tokenizer(
+                chunk_prompts,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=tokenizer.model_max_length
+            )
+        enc_sid = {k: v.to(model.device) for k, v in enc_sid.items()}
+
+        # Keep the beam width (and so the candidate layout) fixed; split the batch instead
+        prompt_lengths = enc_sid["attention_mask"].sum(dim=1).tolist()
+        plan = planner.plan(prompt_lengths, args.sid_max_tokens, num_beams)
+        logger.info(f"🧮 Generation plan: {planner.describe(plan, prompt_lengths, args.sid_max_tokens, num_beams)}")
+
+        items_batch, scores_batch, keys_batch = generate_in_sub_batches(
+            model, enc_sid, plan, generate_kwargs, sid_logits_processor, logger, hooks, return_keys=True
+        )
+        all_items.append(items_batch)
+        all_scores.extend(scores_batch)
+        all_keys.extend(keys_batch)
+
+    return np.concatenate(all_items) if all_items else np.zeros(0, dtype=np.int64), all_scores, all_keys
 
 
-def process_unique_top10_candidates(predictions, scores, effective_num_beams):
-    batch_size = len(predictions) // effective_num_beams
-    new_predictions = []
+def process_unique_top10_candidates(items, scores, effective_num_beams, keys):
+    """Per sample, keep the 10 best-scoring unique candidates (max score over duplicates)
+
+    Catalog candidates are unique by item id; non-catalog ones (-1) by their
+    unmatched key, so distinct generations keep a slot each. Samples with fewer
+    unique candidates repeat the last one with a growing penalty.
+    Returns a [batch_size, 10] item id array and the matching flat score list.
+    """
+    items = np.asarray(items, dtype=np.int64)
+    batch_size = len(items) // effective_num_beams
+    new_items = np.empty((batch_size, 10), dtype=np.int64)
     new_scores = []
 
     for b in range(batch_size):
         start = b * effective_num_beams
         end = start + effective_num_beams
 
-        batch_preds = predictions[start:end]
-        batch_scores = scores[start:end]
-
-        sid_to_score = {}
-        for pred, score in zip(batch_preds, batch_scores):
-            sid_part = pred.split("</think>")[-1].strip().replace(" ", "")
-            sid = extract_sid_from_text(sid_part)
-
-            if sid in sid_to_score:
-                sid_to_score[sid] = max(sid_to_score[sid], score)
+        candidate_scores = {}
+        for item, key, score in zip(items[start:end].tolist(), keys[start:end], scores[start:end]):
+            candidate = item if item >= 0 else key
+            if candidate in candidate_scores:
+                candidate_scores[candidate] = (item, max(candidate_scores[candidate][1], score))
             else:
-                sid_to_score[sid] = score
+                candidate_scores[candidate] = (item, score)
 
-        sorted_items = sorted(sid_to_score.items(), key=lambda x: x[1], reverse=True)
-        top10_items = sorted_items[:10]
+        top10_items = sorted(candidate_scores.values(), key=lambda x: x[1], reverse=True)[:10]
+        sample_items = [item for item, _ in top10_items]
+        sample_scores = [score for _, score in top10_items]
 
-        sample_preds = []
-        sample_scores = []
-
-        for sid, score in top10_items:
-            if batch_preds:
-                prefix = batch_preds[0].split("</think>")[0] + "</think>"
-                full_pred = prefix + "\n" + sid
-            else:
-                full_pred = sid
-            sample_preds.append(full_pred)
-            sample_scores.append(score)
-
-        while len(sample_preds) < 10:
-            if sample_preds:
-                sample_preds.append(sample_preds[-1])
-                penalty = (len(sample_preds) - len(top10_items)) * 0.1
+        while len(sample_items) < 10:
+            if sample_items:
+                sample_items.append(sample_items[-1])
+                penalty = (len(sample_items) - len(top10_items)) * 0.1
                 sample_scores.append(sample_scores[-1] - penalty)
             else:
-                sample_preds.append("")
+                sample_items.append(-1)
                 sample_scores.append(-1000.0)
-        
-        new_predictions.extend(sample_preds)
-        new_scores.extend(sample_scores)
-    
-    return new_predictions, new_scores
 
+        new_items[b] = sample_items
+        new_scores.extend(sample_scores)
 
-def get_topk_results(predictions, scores, targets, k, all_items=None):
-    """Extract top-k results from predictions"""
-    results = []
-    B = len(targets)
-    predictions = [_.split("</think>")[-1] for _ in predictions]
-    predictions = [_.strip().replace(" ", "") for _ in predictions]
-    
-    # Extract only SID parts from both predictions and targets
-    predictions = [extract_sid_from_text(pred) for pred in predictions]
-    
-    if all_items is not None:
-        for i, seq in enumerate(predictions):
-            if seq not in all_items:
-                scores[i] = -1000
-    
-    for b in range(B):
-        batch_seqs = predictions[b * k: (b + 1) * k]
-        batch_scores = scores[b * k: (b + 1) * k]
-        
-        pairs = [(seq, score) for seq, score in zip(batch_seqs, batch_scores)]
-        sorted_pairs = sorted(pairs, key=lambda x: x[1], reverse=True)
-        
-        # Extract SID from target as well
-        target_item = extract_sid_from_text(targets[b])
-        
-        one_results = []
-        for pred_seq, pred_score in sorted_pairs:
-            if pred_seq == target_item:
-                one_results.append(1)
-            else:
-                one_results.append(0)
-        
-        results.append(one_results)
-    
-    return results
-
-
-def hit_k(topk_results, k):
-    """Calculate hit@k metric"""
-    hit = 0.0
-    for row in topk_results:
-        if len(row) >= k and max(row[:k]) == 1:
-            hit += 1
-    return hit / len(topk_results)
-
-
-def ndcg_k(topk_results, k):
-    """Calculate ndcg@k metric"""
-    ndcg = 0.0
-    for row in topk_results:
-        dcg = 0.0
-        for i in range(min(k, len(row))):
-            if row[i] == 1:
-                dcg += 1.0 / np.log2(i + 2)
-        idcg = 1.0 / np.log2(2)  # Best case: hit at position 1
-        ndcg += dcg / idcg
-    return ndcg / len(topk_results)
-
-
-def get_metrics_results(topk_results, metrics):
-    """Calculate evaluation metrics"""
-    res = {}
-    for m in metrics:
-        if m.lower().startswith("hit"):
-            k = int(m.split("@")[1])
-            res[m] = hit_k(topk_results, k)
-        elif m.lower().startswith("ndcg"):
-            k = int(m.split("@")[1])
-            res[m] = ndcg_k(topk_results, k)
-        else:
-            raise NotImplementedError(f"Metric {m} not implemented")
-    
-    return res
+    return new_items, new_scores
 
 
-def run_evaluation(args):
+def run_evaluation(args, trie=None, progress_queue=None):
     """Main evaluation function with CoT reasoning"""
     set_seed(args.seed)
     logger = setup_logging(args.log_file)
@@ -634,6 +741,9 @@ def run_evaluation(args):
     logger.info(f"  Thinking Samples per Input: {args.num_thinking_samples}")
     logger.info(f"  Beams per Thinking Sample: {args.num_beams_per_sample}")
     logger.info(f"  Total Initial Candidates: {args.num_thinking_samples * args.num_beams_per_sample}")
+    logger.info(f"  SID Prompts per Generate Call: {args.sid_batch_size if args.sid_batch_size > 0 else 'whole batch'}")
+    logger.info(f"  Reuse Think KV Cache: {args.reuse_think_cache}")
+    logger.info(f"  Share Think Prompt Cache: {args.share_prompt_cache}")
     logger.info(f"  Final Unique Top-K: 10")
 
     logger.info("⚙️ Generation Parameters:")
@@ -665,37 +775,224 @@ def run_evaluation(args):
     if not os.path.exists(args.test_parquet_file):
         raise FileNotFoundError(f"Parquet file not found: {args.test_parquet_file}")
     
-    test_dataset = ParquetTestDataset(args.test_parquet_file, args.sample_num, args.sample_offset, logger)
-    prefix_allowed_tokens_fn = test_dataset.get_prefix_allowed_tokens_fn(tokenizer, args.global_trie_file)
+    if args.work_queue:
+        # Rows are handed out in chunks by the work queue, so the whole file is loaded
+        test_dataset = ParquetTestDataset(args.test_parquet_file, logger=logger)
+    else:
+        test_dataset = ParquetTestDataset(args.test_parquet_file, args.sample_num, args.sample_offset, logger)
+    sid_logits_processor = test_dataset.get_sid_logits_processor(tokenizer, args.global_trie_file, trie)
     logger.info(f"Using parquet file: {args.test_parquet_file}")
     if args.global_trie_file:
         logger.info(f"✅ Global trie file: {args.global_trie_file}")
     logger.info("✅ CoT-Enhanced + SID constrained generation enabled")
     
+    prompt_cache = SharedPromptCache(final_model, tokenizer, logger) if args.share_prompt_cache else None
+    
+    if args.token_cache_dir:
+        token_cache = TokenCache.open_or_build(
+            args.token_cache_dir, args.test_parquet_file, tokenizer, format_chat_prompt_think_stage, THINK_PROMPT_TEMPLATE_VERSION, logger
+        )
+        test_dataset.attach_token_cache(token_cache)
+    
+    # Per-sample results sink; with --resume, samples already written are skipped
+    result_sink = None
+    resumed_results = {}
+    if args.results_dir:
+        result_sink = ResultSink(args.results_dir, f"gpu{args.gpu_id}", args.results_flush_every)
+        logger.info(f"💾 Writing per-sample results to: {args.results_dir}")
+        if args.resume and args.work_queue:
+            # Done samples are skipped (and counted) by whichever worker claims their chunk
+            resumed_results = result_sink.completed()
+            logger.info(f"♻️ Resuming: {len(resumed_results)} samples already done")
+        elif args.resume:
+            resumed_results = result_sink.completed(args.sample_offset, args.sample_offset + len(test_dataset))
+            test_dataset.skip_samples(resumed_results)
+            logger.info(f"♻️ Resuming: {len(resumed_results)} samples already done, {len(test_dataset)} remaining")
+    elif args.resume:
+        raise ValueError("--resume requires --results_dir")
+    
     collator = TestCollator(args, tokenizer)
-    test_loader = DataLoader(
-        test_dataset,
-        batch_size=args.test_batch_size,
-        collate_fn=collator,
-        shuffle=False,
-        num_workers=0,
-        pin_memory=True
-    )
+    
+    # Optional length bucketing: batches of similar prompt length pad less
+    make_batches = None
+    if args.length_bucketing or args.max_batch_tokens > 0:
+        prompt_lengths = test_dataset.prompt_lengths(tokenizer, format_chat_prompt_think_stage)
+        
+        def make_batches(indices):
+            return length_sorted_batches(indices, prompt_lengths, args.test_batch_size, args.max_batch_tokens)
+        
+        positions = np.arange(len(test_dataset))
+        fixed = [positions[i:i + args.test_batch_size] for i in range(0, len(positions), args.test_batch_size)]
+        logger.info(f"📏 Length bucketing enabled (max batch tokens: {args.max_batch_tokens or 'off'})")
+        logger.info(f"  Prompt padding: {padding_ratio(fixed, prompt_lengths):.1%} in file order → "
+                    f"{padding_ratio(make_batches(positions), prompt_lengths):.1%} bucketed")
+    
+    queue_sampler = None
+    if args.work_queue:
+        work_queue = WorkQueue(args.work_queue)
+        queue_sampler = QueueBatchSampler(
+            work_queue, args.test_batch_size, f"gpu{args.gpu_id}-{os.getpid()}",
+            skip=resumed_results, before_complete=result_sink.flush if result_sink is not None else None,
+            make_batches=make_batches, defer_complete=args.pipeline
+        )
+        test_loader = DataLoader(
+            test_dataset,
+            batch_sampler=queue_sampler,
+            collate_fn=collator,
+            num_workers=0,
+            pin_memory=True
+        )
+        logger.info(f"📋 Claiming row chunks from work queue: {args.work_queue}")
+    elif make_batches is not None:
+        test_loader = DataLoader(
+            test_dataset,
+            batch_sampler=make_batches(np.arange(len(test_dataset))),
+            collate_fn=collator,
+            num_workers=0,
+            pin_memory=True
+        )
+    else:
+        test_loader = DataLoader(
+            test_dataset,
+            batch_size=args.test_batch_size,
+            collate_fn=collator,
+            shuffle=False,
+            num_workers=0,
+            pin_memory=True
+        )
     
     logger.info(f"📈 Test data size: {len(test_dataset)}")
     
+    # Optional per-batch stage timings (tokenize, think/SID prefill and decode, constraint, metrics)
+    hooks = create_hooks(args.timing_file, args.timing_format, gpu=args.gpu_id)
+    if hooks is not None:
+        logger.info(f"⏱️ Writing {args.timing_format} stage timings to: {args.timing_file}")
+
+    planner = GenerationMemoryPlanner.from_model(final_model, args.gen_memory_budget_gb, args.gen_memory_fraction)
+    if planner.budget_bytes is not None:
+        logger.info(f"🧮 Generation memory planner: KV cache {planner.kv_bytes_per_token / 1024:.1f} KiB/token, "
+                    f"budget {format_bytes(planner.budget_bytes)}")
+    else:
+        logger.info("🧮 Generation memory planner: no budget on CPU, batches run whole")
+
     # 3. Start evaluation
     metrics = args.metrics.split(",")
-    all_topk_results = []
-    total = 0
+    accumulator = MetricAccumulator(metrics)
+    if queue_sampler is None:
+        accumulator.update_rows(resumed_results.values())
+    item_index = ItemIndex(sid_logits_processor.trie.sids)
     
     logger.info("🚀 Starting CoT-Enhanced evaluation...")
     
     import time
     start_time = time.time()
     
+    def postprocess_batch(step, batch, all_thinking_contents, all_items, all_scores, all_keys):
+        """Rerank, log and record one generated batch"""
+        user_contents = batch["user_contents"]
+        targets = batch["targets"]
+        bs = len(targets)
+        
+        # For evaluation, we need to reshape to match original expectation
+        scores_list = all_scores
+        effective_num_beams = args.num_thinking_samples * args.num_beams_per_sample
+
+        logger.info(f"🔄 Applying unique deduplication and Top-10 selection...")
+        with timed(hooks, "rerank"):
+            candidate_items, scores_list = process_unique_top10_candidates(
+                all_items, scores_list, effective_num_beams, all_keys
+            )
+        effective_num_beams = 10
+        logger.info(f"✅ After deduplication: {candidate_items.size} total candidates (10 per sample)")
+        
+        # Print generations if requested
+        if args.print_generations:
+            for i in range(bs):
+                start = i * effective_num_beams
+                end = start + effective_num_beams
+                cands = item_index.to_sids(candidate_items[i])
+                cand_scores = scores_list[start:end]
+                
+                logger.info(f"----- CoT-ENHANCED SAMPLE {batch['sample_indices'][i]} -----")
+                logger.info(f"USER INPUT COMPLETE:")
+                logger.info(f"{user_contents[i]}")
+                logger.info(f"")
+
+                display_thinking_count = min(5, args.num_thinking_samples)
+                for thinking_idx in range(display_thinking_count):
+                    logger.info(f"THINKING {thinking_idx+1}/{args.num_thinking_samples}:")
+                    logger.info(f"{all_thinking_contents[i][thinking_idx]}")
+                    logger.info(f"")
+                
+                if args.num_thinking_samples > 5:
+                    logger.info(f"... (and {args.num_thinking_samples - 5} more thinking samples)")
+                    logger.info(f"")
+                
+                logger.info("UNIQUE TOP-10 SID_CANDIDATES:")
+                for j, (c, sc) in enumerate(zip(cands, cand_scores)):
+                    logger.info(f"  Rank {j+1}: score={sc:.4f} → {c}")
+                logger.info(f"")
+                logger.info(f"TARGET:")
+                logger.info(f"{targets[i]}")
+                logger.info("-" * 80)
+        
+        # Rank the top-10 candidates and mark hits
+        with timed(hooks, "metrics"):
+            hits = topk_hit_matrix(
+                candidate_items,
+                np.asarray(scores_list, dtype=np.float64).reshape(bs, effective_num_beams),
+                item_index.lookup([extract_sid_from_text(t) for t in targets])
+            )
+            accumulator.update(hits)
+        if hooks is not None:
+            hooks.end_batch(step, bs)
+        if progress_queue is not None:
+            progress_queue.put(("batch", args.gpu_id, hits))
+        if result_sink is not None:
+            result_sink.add_batch(
+                batch["sample_indices"], batch["user_ids"], targets,
+                item_index.to_sids(candidate_items.ravel()), scores_list, hits, effective_num_beams
+            )
+        
+        if queue_sampler is not None and queue_sampler.defer_complete:
+            queue_sampler.complete_evaluated(step + 1)
+        
+        # Progress report every 20 steps
+        if (step + 1) % 20 == 0:
+            temp_metrics_results = accumulator.results()
+            logger.info("=" * 50)
+            logger.info(f"📊 CoT-ENHANCED PROGRESS REPORT - Step {step+1}/{len(test_loader)}")
+            logger.info(f"💾 Processed samples: {accumulator.count}")
+            logger.info("📈 Current Metrics:")
+            for metric, value in temp_metrics_results.items():
+                logger.info(f"  {metric:>10}: {value:.4f}")
+            logger.info("=" * 50)
+    
+    # With --pipeline, batch N+1 is tokenized on a prefetch thread and batch N-1
+    # reranked and recorded on another while batch N generates; both run in order
+    batches = test_loader
+    post = PostProcessor(enabled=args.pipeline)
+    if args.pipeline:
+        # The prefetch thread gets its own tokenizer; fast tokenizers are not safe to share across threads
+        prefetch_tokenizer = copy.deepcopy(tokenizer)
+        
+        def prepare(batch):
+            # Think prompts are padded per batch on the main thread, like token cache rows
+            if batch["prompt_ids"] is None and prompt_cache is None:
+                with timed(hooks, "tokenize"):
+                    encoded = prefetch_tokenizer(
+                        [format_chat_prompt_think_stage(u) for u in batch["user_contents"]],
+                        truncation=True,
+                        max_length=prefetch_tokenizer.model_max_length
+                    )
+                batch["prompt_ids"] = [np.asarray(ids, dtype=np.int64) for ids in encoded["input_ids"]]
+            return batch
+        
+        batches = Prefetcher(test_loader, prepare)
+        logger.info("🔀 Pipelined evaluation: prefetching and post-processing batches on threads")
+    
     with torch.no_grad():
-        progress_bar = tqdm(test_loader, desc="CoT Testing")
+        progress_bar = tqdm(batches, desc="CoT Testing")
         for step, batch in enumerate(progress_bar):
             user_contents = batch["user_contents"]
             targets = batch["targets"]
@@ -703,7 +1000,7 @@ def run_evaluation(args):
             
             # Calculate progress information
             current_step = step + 1
-            total_steps = len(test_loader)
+            total_steps = len(batches)
             elapsed = time.time() - start_time
             if current_step > 0:
                 avg_time = elapsed / current_step
@@ -722,124 +1019,50 @@ def run_evaluation(args):
                 progress_info = f"CoT-Enhanced Testing: {progress_pct*100:3.0f}%|{bar}| {current_step}/{total_steps} [{elapsed_str}<{remaining_str}, {avg_time:.2f}s/it]"
                 logger.info(progress_info)
 
-            all_thinking_contents = batch_generate_thinking_optimized(
-                final_model, tokenizer, user_contents, args, logger
+            all_thinking_contents, think_state = batch_generate_thinking_optimized(
+                final_model, tokenizer, user_contents, args, logger, prompt_cache,
+                think_prompt_ids=batch["prompt_ids"], hooks=hooks
             )
 
             logger.info(f"🎯 Stage 2: Direct SID generation after </think> for all thinking samples...")
             
-            all_decoded = []
-            all_scores = []
-            
-            for sample_idx in range(bs):
-                sample_decoded = []
-                sample_scores = []
-                
-                for thinking_idx in range(args.num_thinking_samples):
-                    thinking_content = all_thinking_contents[sample_idx][thinking_idx]
-
-                    output, num_beams = generate_sid_standard(
-                        final_model, tokenizer,
-                        user_contents[sample_idx], thinking_content,
-                        prefix_allowed_tokens_fn, args, logger
+            all_items = None
+            if think_state is not None:
+                try:
+                    all_items, all_scores, all_keys = generate_sid_from_think_cache(
+                        final_model, tokenizer, think_state, sid_logits_processor, args, logger, hooks
                     )
-                    
-                    # Decode output for this thinking sample
-                    output_ids = output["sequences"]
-                    scores = output.get("sequences_scores", None)
-                    decoded_batch = tokenizer.batch_decode(output_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
-                    
-                    if thinking_idx == 0 and sample_idx == 0 and len(decoded_batch) > 0:
-                        logger.info(f"🔍 DEBUG: First decoded sample (length={len(decoded_batch[0])})")
-                        logger.info(f"🔍 DEBUG: First 500 chars: {decoded_batch[0][:500]}")
-                    
-                    # Process scores for this thinking sample
-                    if scores is not None:
-                        if hasattr(scores, 'detach'):
-                            scores_batch = [float(s) for s in scores.detach().cpu().tolist()]
-                        else:
-                            scores_batch = [float(s) for s in scores]
-                    else:
-                        scores_batch = [0.0] * len(decoded_batch)
-                    
-                    sample_decoded.extend(decoded_batch)
-                    sample_scores.extend(scores_batch)
-                
-                all_decoded.extend(sample_decoded)
-                all_scores.extend(sample_scores)
+                except RuntimeError as e:
+                    if not is_oom_error(e):
+                        raise
+                    logger.warning("CUDA OOM while reusing the think cache. Falling back to re-prefilled SID prompts.")
+                think_state = None
+                torch.cuda.empty_cache()
+            
+            if all_items is None:
+                all_items, all_scores, all_keys = batch_generate_sid(
+                    final_model, tokenizer, user_contents, all_thinking_contents,
+                    sid_logits_processor, planner, args, logger, hooks
+                )
             
-            # Now all_decoded contains all results: bs * num_thinking_samples * num_beams_per_sample
+            # Now all_items contains all results: bs * num_thinking_samples * num_beams_per_sample
             total_candidates = bs * args.num_thinking_samples * args.num_beams_per_sample
             logger.info(f"✅ Stage 2 completed: Generated {total_candidates} total candidates")
             
-            # For evaluation, we need to reshape to match original expectation
-            decoded = all_decoded
-            scores_list = all_scores
-            effective_num_beams = args.num_thinking_samples * args.num_beams_per_sample
-
-            logger.info(f"🔄 Applying unique deduplication and Top-10 selection...")
-            decoded, scores_list = process_unique_top10_candidates(
-                decoded, scores_list, effective_num_beams
-            )
-            effective_num_beams = 10
-            logger.info(f"✅ After deduplication: {len(decoded)} total candidates (10 per sample)")
-            
-            # Print generations if requested
-            if args.print_generations:
-                for i in range(bs):
-                    start = i * effective_num_beams
-                    end = start + effective_num_beams
-                    cands = decoded[start:end]
-                    cand_scores = scores_list[start:end]
-                    
-                    logger.info(f"----- CoT-ENHANCED SAMPLE {step*bs + i} -----")
-                    logger.info(f"USER INPUT COMPLETE:")
-                    logger.info(f"{user_contents[i]}")
-                    logger.info(f"")
-
-                    display_thinking_count = min(5, args.num_thinking_samples)
-                    for thinking_idx in range(display_thinking_count):
-                        logger.info(f"THINKING {thinking_idx+1}/{args.num_thinking_samples}:")
-                        logger.info(f"{all_thinking_contents[i][thinking_idx]}")
-                        logger.info(f"")
-                    
-                    if args.num_thinking_samples > 5:
-                        logger.info(f"... (and {args.num_thinking_samples - 5} more thinking samples)")
-                        logger.info(f"")
-                    
-                    logger.info("UNIQUE TOP-10 SID_CANDIDATES:")
-                    for j, (c, sc) in enumerate(zip(cands, cand_scores)):
-                        sid_result = extract_sid_from_text(c.split("</think>")[-1])
-                        logger.info(f"  Rank {j+1}: score={sc:.4f} → {sid_result}")
-                    logger.info(f"")
-                    logger.info(f"TARGET:")
-                    logger.info(f"{targets[i]}")
-                    logger.info("-" * 80)
-            
-            # Calculate topk results
-            topk_res = get_topk_results(
-                decoded, scores_list, 
-                targets, effective_num_beams,
-                all_items=None
-            )
-            
-            # Accumulate results
-            all_topk_results.extend(topk_res)
-            total += bs
-            
-            # Progress report every 20 steps
-            if (step + 1) % 20 == 0:
-                temp_metrics_results = get_metrics_results(all_topk_results, metrics)
-                logger.info("=" * 50)
-                logger.info(f"📊 CoT-ENHANCED PROGRESS REPORT - Step {step+1}/{len(test_loader)}")
-                logger.info(f"💾 Processed samples: {total}")
-                logger.info("📈 Current Metrics:")
-                for metric, value in temp_metrics_results.items():
-                    logger.info(f"  {metric:>10}: {value:.4f}")
-                logger.info("=" * 50)
+            post.submit(postprocess_batch, step, batch, all_thinking_contents, all_items, all_scores, all_keys)
+    
+    post.close()
+    if queue_sampler is not None:
+        queue_sampler.complete_evaluated()
+        accumulator.update_rows(resumed_results[i] for i in queue_sampler.skipped)
+        work_queue.close()
+    total = accumulator.count
+    
+    if result_sink is not None:
+        result_sink.close()
     
     # 4. Final results
-    final_metrics_results = get_metrics_results(all_topk_results, metrics)
+    final_metrics_results = accumulator.results()
     
     logger.info("=" * 60)
     logger.info("🎯 Final CoT Hit Rate Results:")
@@ -848,6 +1071,19 @@ def run_evaluation(args):
         logger.info(f"{metric:>10}: {value:.4f}")
     logger.info("=" * 60)
     
+    if args.metrics_file:
+        write_shard_metrics(
+            args.metrics_file, total, accumulator.sums,
+            gpu_id=args.gpu_id, sample_offset=args.sample_offset,
+            merged_model_path=args.merged_model_path, test_parquet_file=args.test_parquet_file
+        )
+        logger.info(f"💾 Shard metrics saved to: {args.metrics_file}")
+    if progress_queue is not None:
+        progress_queue.put(("done", args.gpu_id, total, accumulator.sums))
+    if hooks is not None:
+        hooks.close()
+        logger.info(f"⏱️ Stage timings saved to: {args.timing_file}")
+    
     # 5. Test summary
     logger.info("\n📊 CoT-Enhanced Test Summary:")
     logger.info(f"Merged model: {args.merged_model_path}")
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pre-tokenized, memory-mapped cache of chat-formatted test prompts
+Prompt token ids of every parquet row are stored in one flat int32 array plus
+an offsets index, under a directory keyed by the tokenizer, the prompt
+template and the parquet file. Evaluator processes memory-map the arrays, so
+rows are zero-copy slices and all workers share the same OS page cache.
+
+Build once before starting the workers (evaluators also build on a cache miss):
+    python3 token_cache.py --test_parquet_file test.parquet --model_path MODEL --template hitrate
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow.parquet as pq
+import torch
+
+TOKEN_CACHE_VERSION = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pre-tokenize test prompts into a memory-mapped cache")
+    parser.add_argument("--test_parquet_file", type=str, required=True, help="Test parquet file path")
+    parser.add_argument("--model_path", type=str, required=True, help="Model path providing the tokenizer")
+    parser.add_argument("--template", type=str, choices=["hitrate", "cot_think"], default="hitrate",
+                        help="Prompt template: hitrate (test_model_hitrate.py) or cot_think (test_model_hitrate_cot.py)")
+    parser.add_argument("--cache_dir", type=str, default="./token_cache", help="Cache root directory")
+    return parser.parse_args()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of everything that determines how the tokenizer maps text to ids"""
+    h = hashlib.sha256(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # Padding / truncation settings are call-time state, not part of the mapping
+        state = json.loads(backend.to_str())
+        state.pop("padding", None)
+        state.pop("truncation", None)
+        h.update(json.dumps(state, sort_keys=True).encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(str(tokenizer.model_max_length).encode())
+    return h.hexdigest()
+
+
+def cache_key(parquet_file, tokenizer, format_prompt, template_version):
+    """Directory name for one (parquet file, tokenizer, prompt template) combination"""
+    stat = os.stat(parquet_file)
+    h = hashlib.sha256()
+    h.update(f"v{TOKEN_CACHE_VERSION}|{template_version}|".encode())
+    # Editing the template text invalidates the cache even without a version bump
+    h.update(format_prompt("{user_content}").encode())
+    h.update(tokenizer_fingerprint(tokenizer).encode())
+    h.update(f"{os.path.abspath(parquet_file)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return f"{template_version}-{h.hexdigest()[:16]}"
+
+
+def pad_left(sequences, pad_token_id):
+    """Left-pad 1-D token arrays into input_ids / attention_mask tensors"""
+    max_len = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_len), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        if len(seq):
+            input_ids[i, max_len - len(seq):] = torch.from_numpy(np.asarray(seq, dtype=np.int64))
+            attention_mask[i, max_len - len(seq):] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+class TokenCache:
+    """Flat token array plus row offsets; row i is tokens[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        if self.metadata.get("format_version") != TOKEN_CACHE_VERSION:
+            raise ValueError(f"Unsupported token cache version in {path}: {self.metadata.get('format_version')}")
+        self.path = path
+        self.tokens = np.load(os.path.join(path, "tokens.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @classmethod
+    def build(cls, path, parquet_file, tokenizer, format_prompt, template_version, chunk_size=4096):
+        """Tokenize every row's formatted prompt and write the cache to path"""
+        descriptions = pq.read_table(parquet_file, columns=["description"]).column("description").to_pylist()
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        offsets = np.zeros(len(descriptions) + 1, dtype=np.int64)
+        chunks = []
+        for start in range(0, len(descriptions), chunk_size):
+            prompts = [format_prompt(text) for text in descriptions[start:start + chunk_size]]
+            encoded = tokenizer(prompts, truncation=True, max_length=tokenizer.model_max_length)["input_ids"]
+            offsets[start + 1:start + 1 + len(encoded)] = [len(ids) for ids in encoded]
+            chunks.append(np.fromiter((t for ids in encoded for t in ids), dtype=np.int32))
+        np.cumsum(offsets, out=offsets)
+
+        np.save(os.path.join(tmp_path, "tokens.npy"), np.concatenate(chunks) if chunks else np.zeros(0, np.int32))
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": TOKEN_CACHE_VERSION,
+                "template_version": template_version,
+                "parquet_file": os.path.abspath(parquet_file),
+                "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+                "num_rows": len(descriptions),
+                "num_tokens": int(offsets[-1]),
+            }, f, indent=2)
+
+        # Several workers may race to build the same cache; the first rename wins
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not os.path.exists(os.path.join(path, "meta.json")):
+                raise
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, cache_dir, parquet_file, tokenizer, format_prompt, template_version, logger=None):
+        path = os.path.join(cache_dir, cache_key(parquet_file, tokenizer, format_prompt, template_version))
+        if os.path.exists(os.path.join(path, "meta.json")):
+            cache = cls(path)
+            action = "Loaded"
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache = cls.build(path, parquet_file, tokenizer, format_prompt, template_version)
+            action = "Built"
+        if logger is not None:
+            logger.info(f"🗂️ {action} token cache: {path} ({len(cache)} rows, {len(cache.tokens):,} tokens)")
+        return cache
+
+
+def main():
+    args = parse_args()
+    from transformers import AutoTokenizer
+
+    if args.template == "hitrate":
+        from test_model_hitrate import PROMPT_TEMPLATE_VERSION, format_chat_prompt as format_prompt
+    else:
+        from test_model_hitrate_cot import THINK_PROMPT_TEMPLATE_VERSION as PROMPT_TEMPLATE_VERSION
+        from test_model_hitrate_cot import format_chat_prompt_think_stage as format_prompt
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    cache = TokenCache.open_or_build(args.cache_dir, args.test_parquet_file, tokenizer,
+                                     format_prompt, PROMPT_TEMPLATE_VERSION)
+    print(f"Token cache: {cache.path}")
+    print(f"  Rows: {len(cache)}, tokens: {len(cache.tokens):,}, max length: {int(cache.lengths.max(initial=0))}")
+
+
+if __name__ == "__main__":
+    main()
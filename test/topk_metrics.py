@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized top-k recommendation metrics shared by the hit-rate evaluators
+Candidate SIDs are interned as integer item ids, each batch becomes a
+[num_samples, k] hit matrix ranked by score, and hit@k / ndcg@k are kept as
+running sums so progress reports cost O(1) instead of a pass over all results.
+"""
+
+import numpy as np
+
+
+def parse_metric(metric):
+    """'hit@10' -> ('hit', 10)"""
+    name, _, k = metric.lower().partition("@")
+    if name not in ("hit", "ndcg") or not k.isdigit():
+        raise NotImplementedError(f"Metric {metric} not implemented")
+    return name, int(k)
+
+
+class ItemIndex:
+    """Integer ids for SID strings; catalog SIDs keep their trie item index
+
+    Strings outside the catalog are interned on first sight, so comparing ids
+    is exactly comparing the extracted strings.
+    """
+
+    def __init__(self, sids=()):
+        self.sids = list(sids)
+        self.item_ids = {sid: i for i, sid in enumerate(self.sids)}
+
+    def lookup(self, sids):
+        ids = np.empty(len(sids), dtype=np.int64)
+        for i, sid in enumerate(sids):
+            if sid not in self.item_ids:
+                self.item_ids[sid] = len(self.sids)
+                self.sids.append(sid)
+            ids[i] = self.item_ids[sid]
+        return ids
+
+    def to_sids(self, ids):
+        """SID strings of item ids; "" for -1 (no SID generated)"""
+        return [self.sids[i] if i >= 0 else "" for i in np.asarray(ids).tolist()]
+
+
+def topk_hit_matrix(candidate_ids, scores, target_ids):
+    """[num_samples, k] 0/1 matrix of candidates ranked by descending score
+
+    candidate_ids and scores are [num_samples, k]; ties keep generation order.
+    """
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), axis=1, kind="stable")
+    ranked = np.take_along_axis(candidate_ids, order, axis=1)
+    return (ranked == np.asarray(target_ids, dtype=np.int64)[:, None]).astype(np.int8)
+
+
+def metric_sums(hits, metrics):
+    """Per-metric sums over the rows of one [num_samples, width] hit matrix
+
+    hit@k counts rows with a hit in the first k columns; as before, rows with
+    fewer than k candidates never count. ndcg@k uses one relevant item (idcg = 1).
+    """
+    hits = np.asarray(hits)
+    num_rows, width = hits.shape
+    sums = {}
+    for metric in metrics:
+        name, k = parse_metric(metric)
+        if name == "hit":
+            sums[metric] = float(hits[:, :k].any(axis=1).sum()) if width >= k else 0.0
+        else:
+            discounts = 1.0 / np.log2(np.arange(min(k, width)) + 2)
+            sums[metric] = float((hits[:, :k] * discounts).sum())
+    return sums
+
+
+class MetricAccumulator:
+    """Running metric sums over hit matrices of any widths"""
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        for metric in self.metrics:
+            parse_metric(metric)
+        self.count = 0
+        self.sums = {metric: 0.0 for metric in self.metrics}
+
+    def update(self, hits):
+        hits = np.asarray(hits)
+        if len(hits) == 0:
+            return
+        for metric, value in metric_sums(hits, self.metrics).items():
+            self.sums[metric] += value
+        self.count += len(hits)
+
+    def update_rows(self, rows):
+        """Add hit vectors given as lists (e.g. stored results), grouped by length"""
+        by_width = {}
+        for row in rows:
+            by_width.setdefault(len(row), []).append(row)
+        for group in by_width.values():
+            self.update(np.asarray(group, dtype=np.int8).reshape(len(group), -1))
+
+    def results(self):
+        """Metric means; zeros before any sample"""
+        return {metric: (value / self.count if self.count else 0.0) for metric, value in self.sums.items()}
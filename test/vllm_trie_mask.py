@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+vLLM logits processor that applies one trie step after the log-softmax
+Each request names its allowed tokens in SamplingParams.extra_args; the row is
+turned into full-vocabulary log-probs first and everything else is masked
+after, so the allowed tokens keep the scores HF beam search gives them instead
+of being renormalized over the allowed set. Run the engine with
+logprobs_mode="processed_logits" to read the masked row back.
+
+Kept apart from sid_beam_search.py so that vLLM is only imported by the vLLM
+backend; the engine process imports this class by name.
+"""
+
+import torch
+from vllm.v1.sample.logits_processor import AdapterLogitsProcessor
+
+ALLOWED_TOKENS_ARG = "trie_allowed_token_ids"
+
+
+class AllowedTokenLogProbs:
+    """Request-level processor: full-vocabulary log-probs of the allowed tokens, -inf elsewhere"""
+
+    def __init__(self, allowed_token_ids):
+        self.allowed_token_ids = allowed_token_ids
+        self.allowed = None
+
+    def __call__(self, output_ids, logits):
+        if self.allowed is None or self.allowed.device != logits.device:
+            self.allowed = torch.tensor(self.allowed_token_ids, dtype=torch.long, device=logits.device)
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        masked = torch.full_like(logits, float("-inf"))
+        masked[self.allowed] = log_probs[self.allowed].to(logits.dtype)
+        return masked
+
+
+class TrieStepLogitsProcessor(AdapterLogitsProcessor):
+    """Batch-level adapter for AllowedTokenLogProbs, active for requests that pass ALLOWED_TOKENS_ARG"""
+
+    def is_argmax_invariant(self):
+        return False
+
+    def new_req_logits_processor(self, params):
+        extra_args = params.extra_args or {}
+        if ALLOWED_TOKENS_ARG not in extra_args:
+            return None
+        return AllowedTokenLogProbs(extra_args[ALLOWED_TOKENS_ARG])
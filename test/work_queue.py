@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite-backed work queue for multi-GPU evaluation
+The test parquet is split into small [start, stop) row chunks that worker
+processes claim one at a time until the queue drains, so a slow shard no longer
+holds back the whole run. Chunks left running by a killed run are requeued the
+next time the queue is initialized.
+
+Initialize once before starting the workers:
+    python3 work_queue.py --db ./queue.sqlite --test_parquet_file test.parquet --chunk_size 64
+"""
+
+import argparse
+import collections
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import pyarrow.parquet as pq
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Initialize the evaluation work queue")
+    parser.add_argument("--db", type=str, required=True, help="SQLite queue file")
+    parser.add_argument("--test_parquet_file", type=str, required=True, help="Test parquet file path")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Rows per work item")
+    return parser.parse_args()
+
+
+def parquet_num_rows(path):
+    """Row count from the parquet footer, without reading any data"""
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+class WorkQueue:
+    """Queue of row chunks shared by worker processes through one SQLite file
+
+    One instance may also be shared by threads of a process (e.g. chunks
+    claimed by a prefetch thread while the main thread reports progress).
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, num_rows, chunk_size):
+        """Create the queue, or reopen it and requeue chunks left running by dead workers"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        queue = cls(path)
+        conn = queue.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (chunk_id INTEGER PRIMARY KEY, start INTEGER, stop INTEGER, "
+                "status TEXT, worker TEXT, updated REAL)"
+            )
+            meta = dict(conn.execute("SELECT key, value FROM meta").fetchall())
+            if not meta:
+                conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                 [("num_rows", num_rows), ("chunk_size", chunk_size)])
+                conn.executemany(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?, NULL, ?)",
+                    [(i, start, min(start + chunk_size, num_rows), PENDING, time.time())
+                     for i, start in enumerate(range(0, num_rows, chunk_size))]
+                )
+            elif meta != {"num_rows": num_rows, "chunk_size": chunk_size}:
+                raise ValueError(
+                    f"Queue {path} was created for {meta}, not num_rows={num_rows}, chunk_size={chunk_size}. "
+                    f"Remove it to start a new evaluation."
+                )
+            else:
+                conn.execute("UPDATE chunks SET status = ?, worker = NULL WHERE status = ?", (PENDING, RUNNING))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return queue
+
+    def claim(self, worker):
+        """Take the next pending chunk as (chunk_id, start, stop), or None once drained"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT chunk_id, start, stop FROM chunks WHERE status = ? ORDER BY chunk_id LIMIT 1", (PENDING,)
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE chunks SET status = ?, worker = ?, updated = ? WHERE chunk_id = ?",
+                        (RUNNING, worker, time.time(), row[0])
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def complete(self, chunk_id):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE chunks SET status = ?, updated = ? WHERE chunk_id = ?", (DONE, time.time(), chunk_id)
+            )
+
+    def progress(self):
+        """Row counts per chunk status"""
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0}
+        with self.lock:
+            rows = self.conn.execute("SELECT status, SUM(stop - start) FROM chunks GROUP BY status").fetchall()
+        for status, num_rows in rows:
+            counts[status] = num_rows
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+class QueueBatchSampler:
+    """Batch sampler that claims chunks from a WorkQueue lazily, one at a time
+
+    Meant for a DataLoader with num_workers=0: the next batch is only requested
+    after the previous one was processed, so a chunk is marked done (after
+    before_complete, e.g. flushing a result sink) once all its batches are
+    evaluated. Row indices in skip are not yielded; those met in claimed chunks
+    are collected in self.skipped. make_batches, if given, groups the indices
+    of a chunk into batches (e.g. by prompt length) instead of fixed slices.
+
+    With defer_complete (batches prefetched ahead of evaluation), a chunk whose
+    batches were all yielded is only marked done by complete_evaluated() once
+    the consumer evaluated them.
+    """
+
+    def __init__(self, queue, batch_size, worker, skip=(), before_complete=None, make_batches=None,
+                 defer_complete=False):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.make_batches = make_batches
+        self.worker = worker
+        self.skip = set(skip)
+        self.skipped = []
+        self.before_complete = before_complete
+        self.num_batches = 0
+        self.defer_complete = defer_complete
+        # (chunk_id, batches yielded up to its end) of chunks waiting for complete_evaluated()
+        self.ended_chunks = collections.deque()
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.claim(self.worker)
+            if chunk is None:
+                return
+            chunk_id, start, stop = chunk
+            indices = [i for i in range(start, stop) if i not in self.skip]
+            self.skipped.extend(i for i in range(start, stop) if i in self.skip)
+            if self.make_batches is not None:
+                batches = self.make_batches(indices)
+            else:
+                batches = [indices[b:b + self.batch_size] for b in range(0, len(indices), self.batch_size)]
+            for batch in batches:
+                self.num_batches += 1
+                yield batch
+            if self.defer_complete:
+                self.ended_chunks.append((chunk_id, self.num_batches))
+            else:
+                self._complete(chunk_id)
+
+    def _complete(self, chunk_id):
+        if self.before_complete is not None:
+            self.before_complete()
+        self.queue.complete(chunk_id)
+
+    def complete_evaluated(self, num_evaluated=None):
+        """Mark done the ended chunks whose batches are among the first num_evaluated (all when None)"""
+        while self.ended_chunks and (num_evaluated is None or self.ended_chunks[0][1] <= num_evaluated):
+            chunk_id, _ = self.ended_chunks.popleft()
+            self._complete(chunk_id)
+
+    def __len__(self):
+        """Batches yielded so far plus an estimate for the rows still pending"""
+        return self.num_batches + math.ceil(self.queue.progress()[PENDING] / self.batch_size)
+
+
+def main():
+    args = parse_args()
+    num_rows = parquet_num_rows(args.test_parquet_file)
+    queue = WorkQueue.create(args.db, num_rows, args.chunk_size)
+    progress = queue.progress()
+    queue.close()
+    print(f"Work queue {args.db}: {num_rows} rows in chunks of {args.chunk_size} "
+          f"({progress[PENDING]} pending, {progress[DONE]} done)")
+
+
+if __name__ == "__main__":
+    main()
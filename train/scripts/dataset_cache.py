@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of tokenized training datasets, shared across ranks and runs
+A tokenized (and, with --packing, packed) split is saved as Arrow files under
+a directory keyed by the parquet file, the tokenizer, the chat template
+version and source, and the tokenization parameters. The main process builds
+a missing cache while the other ranks wait at a barrier; every rank then
+memory-maps the same Arrow files instead of re-reading and re-tokenizing the
+parquet. Multi-node runs need the cache directory on storage every node sees,
+or a cache built ahead on each node.
+
+Build ahead of a launch (e.g. on a CPU node) with:
+    python3 dataset_cache.py --trainer sid_rec --model_path MODEL --data_path train.parquet
+"""
+
+import argparse
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import shutil
+from contextlib import nullcontext
+
+from datasets import load_from_disk
+
+DATASET_CACHE_VERSION = 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tokenize a training parquet file into the dataset cache")
+    parser.add_argument("--trainer", type=str, choices=["sid_rec", "RA", "align"], required=True,
+                        help="Trainer whose template and tokenization to use (train_beauty_<trainer>.py)")
+    parser.add_argument("--model_path", type=str, required=True, help="Model path providing the tokenizer")
+    parser.add_argument("--data_path", type=str, required=True, help="Training or validation parquet file")
+    parser.add_argument("--cache_dir", type=str, default="./tokenized_cache", help="Cache root directory")
+    parser.add_argument("--packing_max_length", type=int, default=0,
+                        help="Cache the packed layout for --packing runs with this row length; 0 for unpacked")
+    return parser.parse_args()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of everything that determines how the tokenizer maps text to ids"""
+    h = hashlib.sha256(type(tokenizer).__name__.encode())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        # Padding / truncation settings are call-time state, not part of the mapping
+        state = json.loads(backend.to_str())
+        state.pop("padding", None)
+        state.pop("truncation", None)
+        h.update(json.dumps(state, sort_keys=True).encode())
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    h.update(str(tokenizer.model_max_length).encode())
+    h.update(str(tokenizer.pad_token_id).encode())
+    return h.hexdigest()
+
+
+def cache_key(data_path, tokenizer, template_version, functions=(), params=None):
+    """Directory name for one (data file, tokenizer, template, tokenization parameters) combination
+
+    functions are the functions and modules whose source builds the dataset.
+    """
+    stat = os.stat(data_path)
+    h = hashlib.sha256()
+    h.update(f"v{DATASET_CACHE_VERSION}|{template_version}|".encode())
+    # Editing the listed sources invalidates the cache even without a version bump; anything they
+    # read from elsewhere (other modules, the environment) still needs a template_version bump
+    for function in functions:
+        h.update(inspect.getsource(function).encode())
+    h.update(json.dumps(params or {}, sort_keys=True).encode())
+    h.update(tokenizer_fingerprint(tokenizer).encode())
+    h.update(f"{os.path.abspath(data_path)}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return f"{template_version}-{h.hexdigest()[:16]}"
+
+
+def load_or_build_dataset(cache_dir, data_path, tokenizer, template_version, build, functions=(), params=None,
+                          training_args=None):
+    """The cached dataset for data_path, calling build() and saving its result on a miss
+
+    With training_args the main process goes first and the other ranks load
+    its result after a barrier. Without cache_dir build() is just called.
+    """
+    if not cache_dir:
+        return build()
+    path = os.path.join(cache_dir, cache_key(data_path, tokenizer, template_version, functions, params))
+    is_main = training_args is None or training_args.process_index == 0
+    main_first = (training_args.main_process_first(local=False, desc=f"dataset cache {os.path.basename(path)}")
+                  if training_args is not None else nullcontext())
+    with main_first:
+        if not os.path.exists(os.path.join(path, "cache_meta.json")):
+            if not is_main:
+                raise FileNotFoundError(f"Dataset cache {path} was not built by the main process")
+            os.makedirs(cache_dir, exist_ok=True)
+            dataset = build()
+            tmp_path = f"{path}.tmp-{os.getpid()}"
+            dataset.save_to_disk(tmp_path)
+            with open(os.path.join(tmp_path, "cache_meta.json"), "w", encoding="utf-8") as f:
+                json.dump({
+                    "format_version": DATASET_CACHE_VERSION,
+                    "template_version": template_version,
+                    "data_path": os.path.abspath(data_path),
+                    "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+                    "params": params or {},
+                    "num_rows": len(dataset),
+                }, f, indent=2)
+            # Concurrent offline builds may race; the first rename wins
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                if not os.path.exists(os.path.join(path, "cache_meta.json")):
+                    raise
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            action = "Built"
+        else:
+            action = "Loaded"
+        # Arrow files are memory-mapped, so all ranks share the OS page cache
+        dataset = load_from_disk(path)
+    if is_main:
+        print(f"{action} dataset cache: {path} ({len(dataset)} rows)")
+    return dataset
+
+
+def main():
+    args = parse_args()
+    from transformers import AutoTokenizer
+
+    trainer = importlib.import_module(f"train_beauty_{args.trainer}")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    tokenizer.pad_token = tokenizer.eos_token
+    load_or_build_dataset(
+        args.cache_dir, args.data_path, tokenizer, trainer.TEMPLATE_VERSION,
+        lambda: trainer.build_tokenized_dataset(args.data_path, tokenizer, args.packing_max_length),
+        trainer.DATASET_CACHE_FUNCTIONS, {"packing_max_length": args.packing_max_length},
+    )
+
+
+if __name__ == "__main__":
+    main()
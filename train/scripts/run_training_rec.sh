@@ -8,6 +8,10 @@ TRAIN_DATA="../data/training_prediction_sid_data_train.parquet"
 VAL_DATA="../data/training_prediction_sid_data_val.parquet"
 
 USE_LORA=false
+# Pack several samples per 4096-token row (per_device_train_batch_size then counts packed rows)
+PACKING=false
+# Stream TRAIN_DATA (a parquet file or a directory of them) instead of tokenizing it up front; for large corpora
+STREAMING=false
 
 DEEPSPEED_CMD=(
     deepspeed
@@ -31,6 +35,14 @@ else
     DEEPSPEED_CMD+=(--use_lora False)
 fi
 
+if [ "${PACKING}" = "true" ]; then
+    DEEPSPEED_CMD+=(--packing True --packing_max_length 4096)
+fi
+
+if [ "${STREAMING}" = "true" ]; then
+    DEEPSPEED_CMD+=(--streaming True)
+fi
+
 DEEPSPEED_CMD+=(
     --per_device_train_batch_size 2
     --num_train_epochs 6
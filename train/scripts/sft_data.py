@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Shared SFT data helpers for the Beauty trainers
+Loss is computed from the first "<|im_start|>user" turn onwards; tokens
+before it (the system prompt) are masked with -100, and samples without a
+user turn are masked entirely. The turn start is found once per sample at
+tokenization time (the user_start column) by a vectorized token search, so
+the collator only pads and masks.
+
+With packing, several tokenized samples are concatenated into rows of up to
+max_length tokens. PackedDataCollator restarts position_ids at every sample
+and passes no attention_mask, so transformers attends block-diagonally
+(sdpa/eager masks, or varlen kernels with flash_attention_2) and no sample
+sees another; labels are masked per sample exactly as without packing.
+
+Training texts are built column-wise: format_chat_texts joins the template
+pieces with pyarrow string kernels over whole columns instead of an f-string
+per pandas row, producing the same text. chat_dataset_from_parquet can read
+the parquet file in record batches into an on-disk dataset, so the full
+table and all texts are never in memory together.
+"""
+
+import uuid
+from typing import Any, Dict, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import torch
+import transformers
+from datasets import Dataset
+from packaging import version
+
+# First release whose sdpa/eager causal masks split packed rows at position_ids resets
+PACKED_MASK_MIN_VERSION = "4.53.0"
+
+IGNORE_INDEX = -100
+USER_TURN_MARKER = "<|im_start|>user"
+
+# Parquet columns format_chat_texts / category_think read
+CHAT_COLUMNS = ("description", "groundtruth", "title", "categories")
+
+SYSTEM_MESSAGE = "You are a professional recommendation expert who needs to recommend the next possible purchase for users based on their purchase history. Please predict the most likely next product that the user will purchase based on the user's historical purchase information."
+
+
+def text_column(table, name):
+    """Column as strings, as an f-string formats each pandas object value (nulls as "None")"""
+    column = table.column(name)
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return pc.fill_null(column.cast(pa.large_string()), "None")
+    # Numbers, lists etc. go through pandas so e.g. ints with nulls still print as floats
+    return pa.array(column.to_pandas().map(str).tolist(), type=pa.large_string())
+
+
+def _literal(text):
+    return pa.scalar(text, type=pa.large_string())
+
+
+def category_think(table):
+    """RA think text: the item categories for rows with a title, empty otherwise"""
+    empty = _literal("\n\n")
+    if "title" not in table.column_names:
+        return empty
+    with_categories = pc.binary_join_element_wise(
+        _literal("\nThe user is likely to buy items in "), text_column(table, "categories"),
+        _literal(" category\n"), _literal(""),
+    )
+    return pc.if_else(pc.is_valid(table.column("title")), with_categories, empty)
+
+
+def format_chat_texts(table, system_message=SYSTEM_MESSAGE, think="\n\n"):
+    """Chat-template text of every row of a table with description and groundtruth columns
+
+    think is what goes between <think> and </think>, a string or one per row.
+    """
+    if isinstance(think, str):
+        think = _literal(think)
+    return pc.binary_join_element_wise(
+        _literal(f"<|im_start|>system\n{system_message}<|im_end|>\n<|im_start|>user\n"),
+        text_column(table, "description"),
+        _literal("<|im_end|>\n<|im_start|>assistant\n<think>"),
+        think,
+        _literal("</think>\n"),
+        text_column(table, "groundtruth"),
+        _literal("<|im_end|>\n"),
+        _literal(""),
+    )
+
+
+def chat_dataset_from_parquet(data_path, format_texts, sample_size=None, stream_batch_rows=0, local_rank=0):
+    """Dataset with a text column of format_texts(table) over the parquet file
+
+    With stream_batch_rows, the file is converted to an on-disk Arrow dataset
+    and formatted that many rows at a time, keeping host memory flat.
+    """
+    metadata = pq.read_metadata(data_path)
+    if local_rank == 0:
+        print(f"Data shape: ({metadata.num_rows}, {metadata.num_columns})")
+        print(f"Columns: {pq.read_schema(data_path).names}")
+    num_rows = metadata.num_rows
+    if sample_size is not None and num_rows > sample_size:
+        if local_rank == 0:
+            print(f"Sampling {sample_size} samples from {num_rows} total samples")
+        num_rows = sample_size
+
+    if not stream_batch_rows:
+        table = pq.read_table(data_path).slice(0, num_rows)
+        return Dataset.from_dict({"text": format_texts(table)})
+
+    dataset = Dataset.from_parquet(str(data_path))
+    if num_rows < len(dataset):
+        dataset = dataset.select(range(num_rows))
+    # A fresh fingerprint keeps this and the following maps off stale datasets caches,
+    # whose function hashing misses edits to the template code here
+    return dataset.with_format("arrow").map(
+        lambda table: pa.table({"text": format_texts(table)}),
+        batched=True,
+        batch_size=stream_batch_rows,
+        remove_columns=dataset.column_names,
+        load_from_cache_file=False,
+        new_fingerprint=uuid.uuid4().hex,
+        desc="Formatting",
+    ).with_format(None)
+
+
+def user_turn_marker_ids(tokenizer):
+    return tokenizer.encode(USER_TURN_MARKER, add_special_tokens=False)
+
+
+def find_user_turn_starts(sequences, marker_ids):
+    """Index of the first marker_ids occurrence in every token sequence, -1 if absent"""
+    starts = torch.full((len(sequences),), -1, dtype=torch.long)
+    m = len(marker_ids)
+    max_length = max((len(seq) for seq in sequences), default=0)
+    if m == 0 or max_length < m:
+        return starts
+    # Pad with -1, which no token id matches
+    padded = torch.full((len(sequences), max_length), -1, dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = torch.as_tensor(seq, dtype=torch.long)
+    marker = torch.as_tensor(marker_ids, dtype=torch.long)
+    matches = (padded.unfold(1, m, 1) == marker).all(dim=-1)
+    found = matches.any(dim=1)
+    starts[found] = matches[found].to(torch.uint8).argmax(dim=1)
+    return starts
+
+
+def add_user_turn_starts(tokenized, marker_ids):
+    """Store the user turn start of every tokenized row as the user_start column"""
+    tokenized["user_start"] = find_user_turn_starts(tokenized["input_ids"], marker_ids).tolist()
+    return tokenized
+
+
+def mask_before_user_turn(labels, starts):
+    """Set labels before each row's user turn (the whole row when it has none) to IGNORE_INDEX"""
+    positions = torch.arange(labels.shape[1])
+    masked = (positions[None, :] < starts[:, None]) | (starts[:, None] < 0)
+    return labels.masked_fill(masked, IGNORE_INDEX)
+
+
+class CustomDataCollator:
+    """Right-pads input_ids/attention_mask and masks labels before the user turn
+
+    Labels of padding positions keep the pad token id, as the trainers always
+    did. Features without a user_start column are searched at collate time.
+    """
+
+    def __init__(self, tokenizer, mlm=False):
+        self.tokenizer = tokenizer
+        self.mlm = mlm
+        self.marker_ids = user_turn_marker_ids(tokenizer)
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        input_ids = [feature["input_ids"] for feature in features]
+        max_length = max(len(ids) for ids in input_ids)
+
+        padded_input_ids = torch.full((len(features), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        padded_attention_mask = torch.zeros((len(features), max_length), dtype=torch.long)
+        for i, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            padded_input_ids[i, :n] = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            padded_attention_mask[i, :n] = torch.as_tensor(feature["attention_mask"], dtype=torch.long)
+
+        if "user_start" in features[0]:
+            starts = torch.as_tensor([feature["user_start"] for feature in features], dtype=torch.long)
+        else:
+            starts = find_user_turn_starts(input_ids, self.marker_ids)
+
+        return {
+            "input_ids": padded_input_ids,
+            "attention_mask": padded_attention_mask,
+            "labels": mask_before_user_turn(padded_input_ids.clone(), starts),
+        }
+
+
+def pack_sequences(examples, max_length):
+    """Greedily concatenate consecutive samples into rows of at most max_length tokens
+
+    Batched datasets.map function over unpadded input_ids (and user_start when
+    present); every row records the length of each sample it holds.
+    """
+    has_user_start = "user_start" in examples
+    packed = {"input_ids": [], "seq_lengths": []}
+    if has_user_start:
+        packed["user_start"] = []
+    row, lengths, starts = [], [], []
+    for i, ids in enumerate(examples["input_ids"]):
+        ids = ids[:max_length]
+        if row and len(row) + len(ids) > max_length:
+            packed["input_ids"].append(row)
+            packed["seq_lengths"].append(lengths)
+            if has_user_start:
+                packed["user_start"].append(starts)
+            row, lengths, starts = [], [], []
+        row.extend(ids)
+        lengths.append(len(ids))
+        if has_user_start:
+            starts.append(examples["user_start"][i])
+    if row:
+        packed["input_ids"].append(row)
+        packed["seq_lengths"].append(lengths)
+        if has_user_start:
+            packed["user_start"].append(starts)
+    return packed
+
+
+def prepare_model_for_packing(model):
+    """Check that attention will split packed rows and disable the KV cache
+
+    transformers only derives the per-sample mask from position_ids when no
+    attention_mask and no cache are passed, and the model builds a cache
+    whenever config.use_cache is set (training does not need one).
+    """
+    attn_implementation = getattr(model.config, "_attn_implementation", None)
+    is_flash = attn_implementation is not None and attn_implementation.startswith("flash_attention")
+    if not is_flash and version.parse(transformers.__version__) < version.parse(PACKED_MASK_MIN_VERSION):
+        raise ValueError(
+            f"Packing with attn_implementation={attn_implementation} needs transformers>={PACKED_MASK_MIN_VERSION} "
+            f"(found {transformers.__version__}); upgrade or use flash_attention_2"
+        )
+    model.config.use_cache = False
+
+
+class PackedDataCollator:
+    """Pads packed rows and builds per-sample position_ids and labels
+
+    Each sample's first token is never a target (it would be predicted from
+    the previous sample); with mask_user_turn, tokens before a sample's user
+    turn are masked too, and without it (alignment stage) pad-token labels
+    are masked like DataCollatorForLanguageModeling does. Padding at the end
+    of a row is never a target.
+    """
+
+    def __init__(self, tokenizer, mask_user_turn=True):
+        self.tokenizer = tokenizer
+        self.mask_user_turn = mask_user_turn
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        max_length = max(len(feature["input_ids"]) for feature in features)
+
+        input_ids = torch.full((len(features), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((len(features), max_length), dtype=torch.long)
+        labels = torch.full((len(features), max_length), IGNORE_INDEX, dtype=torch.long)
+        for i, feature in enumerate(features):
+            n = len(feature["input_ids"])
+            row_ids = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            lengths = torch.as_tensor(feature["seq_lengths"], dtype=torch.long)
+            segment_offsets = torch.cumsum(lengths, dim=0) - lengths
+            positions = torch.arange(n) - torch.repeat_interleave(segment_offsets, lengths)
+
+            row_labels = row_ids.clone()
+            masked = positions == 0
+            if self.mask_user_turn:
+                starts = torch.repeat_interleave(torch.as_tensor(feature["user_start"], dtype=torch.long), lengths)
+                masked |= (positions < starts) | (starts < 0)
+            else:
+                masked |= row_ids == self.tokenizer.pad_token_id
+            input_ids[i, :n] = row_ids
+            labels[i, :n] = row_labels.masked_fill(masked, IGNORE_INDEX)
+            position_ids[i, :n] = positions
+            # Row padding continues as its own sequence so it never joins the last sample
+            position_ids[i, n:] = torch.arange(max_length - n)
+
+        return {
+            "input_ids": input_ids,
+            "position_ids": position_ids,
+            "labels": labels,
+        }
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Streaming training data for corpora too large to materialize (--streaming)
+The training split is read lazily from one parquet file or a directory of
+them: row groups are visited in a seeded order that changes every epoch and
+rows are shuffled within windows of shuffle_window rows, so host memory holds
+about one row group and one window regardless of corpus size. Nothing is
+tokenized up front; texts are formatted in the DataLoader workers and
+TokenizingCollator tokenizes each batch there.
+
+Every rank produces the same global stream and accelerate's
+IterableDatasetShard keeps this rank's slice of every global batch
+(per_device_train_batch_size * world_size rows), so sharding is deterministic
+and ranks stay in step; only parquet decoding is repeated per rank. DataLoader
+workers take whole global batches round-robin, matching the order in which
+the DataLoader reads them back. An epoch is truncated to a whole number of
+optimizer steps.
+
+StreamPositionCallback writes the stream position into every checkpoint; a
+run resumed from that checkpoint starts reading at the position instead of
+tokenizing and discarding the batches it already trained on.
+"""
+
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers import TrainerCallback
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+STREAM_POSITION_NAME = "stream_position.json"
+
+
+def parquet_files(data_path):
+    """The parquet file, or the sorted *.parquet files of a directory"""
+    if os.path.isdir(data_path):
+        files = sorted(os.path.join(data_path, name) for name in os.listdir(data_path) if name.endswith(".parquet"))
+        if not files:
+            raise FileNotFoundError(f"No parquet files in {data_path}")
+        return files
+    return [data_path]
+
+
+class StreamingParquetDataset(IterableDataset):
+    """Rows of format_texts() over parquet row groups, as {"text": ...} dicts, in a seeded order
+
+    global_batch_size is per_device_train_batch_size * world_size; the stream
+    is cut to a multiple of global_batch_size * gradient_accumulation_steps
+    rows per epoch. shuffle_window=0 keeps file order.
+    """
+
+    def __init__(self, data_path, format_texts, global_batch_size, gradient_accumulation_steps=1, columns=None,
+                 shuffle_window=8192, seed=42):
+        self.files = parquet_files(data_path)
+        self.format_texts = format_texts
+        self.global_batch_size = global_batch_size
+        self.step_rows = global_batch_size * gradient_accumulation_steps
+        self.shuffle = shuffle_window > 0
+        self.window_rows = shuffle_window or 8192
+        self.seed = seed
+        self.epoch = 0
+        self.resume_epoch = None
+        self.resume_rows = 0
+
+        schema = pq.read_schema(self.files[0])
+        self.columns = [name for name in columns if name in schema.names] if columns is not None else None
+        # (file index, row group, rows) for every row group; metadata only
+        self.units = []
+        for file_index, path in enumerate(self.files):
+            metadata = pq.read_metadata(path)
+            for row_group in range(metadata.num_row_groups):
+                self.units.append((file_index, row_group, metadata.row_group(row_group).num_rows))
+        self.total_rows = sum(rows for _, _, rows in self.units)
+        self.num_rows = self.total_rows // self.step_rows * self.step_rows
+        if self.num_rows == 0:
+            raise ValueError(f"{data_path} has {self.total_rows} rows, fewer than one optimizer step "
+                             f"({self.step_rows} rows)")
+
+    def __len__(self):
+        return self.num_rows
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_position(self, epoch, rows):
+        """Start the given epoch after its first `rows` rows (a multiple of the optimizer step rows)"""
+        self.resume_epoch = epoch
+        self.resume_rows = rows
+
+    def position_at_step(self, global_step):
+        """(epoch, rows read in that epoch) after global_step optimizer steps"""
+        steps_per_epoch = self.num_rows // self.step_rows
+        return global_step // steps_per_epoch, global_step % steps_per_epoch * self.step_rows
+
+    def _unit_order(self, epoch):
+        if not self.shuffle:
+            return list(range(len(self.units)))
+        return np.random.default_rng([self.seed, epoch]).permutation(len(self.units)).tolist()
+
+    def _window_order(self, epoch, window, num_rows):
+        if not self.shuffle:
+            return np.arange(num_rows)
+        return np.random.default_rng([self.seed, epoch, window]).permutation(num_rows)
+
+    def _windows(self, epoch, first_window):
+        """(window index, table) for consecutive windows of the epoch's stream, from first_window on"""
+        position = first_window * self.window_rows
+        offset = 0
+        pending, pending_rows = [], 0
+        window = first_window
+        open_files = {}
+        for unit in self._unit_order(epoch):
+            if offset >= self.num_rows:
+                break
+            file_index, row_group, rows = self.units[unit]
+            start, end = max(position - offset, 0), min(rows, self.num_rows - offset)
+            offset += rows
+            if start >= end:
+                continue
+            if file_index not in open_files:
+                open_files[file_index] = pq.ParquetFile(self.files[file_index])
+            table = open_files[file_index].read_row_group(row_group, columns=self.columns)
+            pending.append(table.slice(start, end - start))
+            pending_rows += end - start
+            while pending_rows >= self.window_rows:
+                table = pa.concat_tables(pending)
+                yield window, table.slice(0, self.window_rows)
+                window += 1
+                pending = [table.slice(self.window_rows)]
+                pending_rows -= self.window_rows
+        if pending_rows:
+            yield window, pa.concat_tables(pending)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        epoch = self.epoch
+        start = self.resume_rows if epoch == self.resume_epoch else 0
+        for window, table in self._windows(epoch, start // self.window_rows):
+            positions = window * self.window_rows + np.arange(table.num_rows)
+            # Whole global batches go to the workers in turn, starting over at the resume position
+            keep = (positions >= start) & ((positions - start) // self.global_batch_size % num_workers == worker_id)
+            if not keep.any():
+                continue
+            rows = self._window_order(epoch, window, table.num_rows)[keep]
+            for text in self.format_texts(table.take(rows)).to_pylist():
+                yield {"text": text}
+
+
+class TokenizingCollator:
+    """Tokenizes a batch of {"text": ...} rows with tokenize_function, then collates it with collator
+
+    Already tokenized features (the validation split) go to collator unchanged.
+    """
+
+    def __init__(self, tokenizer, tokenize_function, collator):
+        self.tokenizer = tokenizer
+        self.tokenize_function = tokenize_function
+        self.collator = collator
+
+    def __call__(self, features):
+        if "text" not in features[0]:
+            return self.collator(features)
+        tokenized = self.tokenize_function({"text": [feature["text"] for feature in features]}, self.tokenizer, False)
+        return self.collator([{key: values[i] for key, values in tokenized.items()} for i in range(len(features))])
+
+
+class StreamPositionCallback(TrainerCallback):
+    """Record the dataset's stream position in every checkpoint directory"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        checkpoint_dir = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        if not os.path.isdir(checkpoint_dir):
+            return
+        epoch, rows = self.dataset.position_at_step(state.global_step)
+        with open(os.path.join(checkpoint_dir, STREAM_POSITION_NAME), "w", encoding="utf-8") as f:
+            json.dump({
+                "epoch": epoch,
+                "rows": rows,
+                "global_step": state.global_step,
+                "num_rows": self.dataset.num_rows,
+                "global_batch_size": self.dataset.global_batch_size,
+                "seed": self.dataset.seed,
+            }, f, indent=2)
+
+
+def load_stream_position(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, STREAM_POSITION_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def make_streaming_dataset(data_path, format_texts, training_args, shuffle_window=8192, columns=None):
+    """StreamingParquetDataset for the training split, resumed from training_args.resume_from_checkpoint
+
+    Adjusts training_args for streaming: accelerate must shard the stream per
+    rank instead of dispatching batches from rank 0, the raw text column must
+    reach the collator, and the Trainer must not skip batches on resume
+    (the dataset starts at the checkpoint's position instead). For the rest of
+    a resumed epoch the fractional epoch in the Trainer's logs counts from the
+    resume point.
+    """
+    training_args.accelerator_config.dispatch_batches = False
+    training_args.remove_unused_columns = False
+    training_args.ignore_data_skip = True
+    dataset = StreamingParquetDataset(
+        data_path, format_texts,
+        global_batch_size=training_args.per_device_train_batch_size * training_args.world_size,
+        gradient_accumulation_steps=training_args.gradient_accumulation_steps,
+        columns=columns,
+        shuffle_window=shuffle_window,
+        seed=training_args.data_seed if training_args.data_seed is not None else training_args.seed,
+    )
+    if training_args.resume_from_checkpoint:
+        position = load_stream_position(training_args.resume_from_checkpoint)
+        if position is None:
+            raise FileNotFoundError(f"No {STREAM_POSITION_NAME} in {training_args.resume_from_checkpoint}; "
+                                    f"it was not saved by a --streaming run")
+        dataset.set_position(position["epoch"], position["rows"])
+    if training_args.process_index == 0:
+        print(f"Streaming {data_path}: {len(dataset.files)} files, {len(dataset.units)} row groups, "
+              f"{dataset.num_rows} of {dataset.total_rows} rows per epoch")
+        if dataset.resume_epoch is not None:
+            print(f"Resuming the stream at epoch {dataset.resume_epoch}, row {dataset.resume_rows}")
+    return dataset
@@ -16,13 +16,30 @@ from transformers import (
     TrainingArguments,
 )
 
+import sft_data
+from dataset_cache import load_or_build_dataset
+from sft_data import PackedDataCollator, pack_sequences, prepare_model_for_packing, text_column
+from streaming_data import StreamPositionCallback, TokenizingCollator, make_streaming_dataset
+
 
 @dataclass
 class BeautyScriptArguments:
     model_dir: str = "../basemodel/Qwen3-1-7B-expand"
     train_data_path: str = "../data/training_data_train.parquet"
     val_data_path: str = "../data/training_data_val.parquet"
+    # Concatenate samples into rows of up to packing_max_length tokens (needs transformers>=4.53 or flash_attention_2)
+    packing: bool = False
+    packing_max_length: int = 4096
+    # Directory of tokenized dataset caches shared across ranks and runs; empty to disable
+    dataset_cache_dir: str = "./tokenized_cache"
+    # Stream the training parquet file (or directory of files), tokenizing in the dataloader workers
+    streaming: bool = False
+    # Rows shuffled together when streaming (row groups are shuffled too); 0 keeps file order
+    stream_shuffle_window: int = 8192
+
 
+# Bump when the chat template changes; part of the tokenized dataset cache key
+TEMPLATE_VERSION = "align-v1"
 
 def prepare_dataset(data_path, sample_size=None, local_rank=0):
     if local_rank == 0:
@@ -50,10 +67,14 @@ def prepare_dataset(data_path, sample_size=None, local_rank=0):
     }
     return Dataset.from_dict(dataset_dict)
 
-def tokenize_function(examples, tokenizer):
+def format_texts(table):
+    # Streaming counterpart of prepare_dataset: the description is the whole text
+    return text_column(table, 'description')
+
+def tokenize_function(examples, tokenizer, padding='longest'):
     tokenized = tokenizer(
         examples['text'],
-        padding='longest',
+        padding=padding,
         truncation=True,
         max_length=4096,
         add_special_tokens=True,
@@ -61,6 +82,28 @@ def tokenize_function(examples, tokenizer):
     )
     return tokenized
 
+def build_tokenized_dataset(data_path, tokenizer, packing_max_length=0, local_rank=0):
+    dataset = prepare_dataset(data_path, local_rank=local_rank)
+    # Packed rows are built from unpadded samples
+    padding = False if packing_max_length else 'longest'
+    dataset = dataset.map(
+        lambda x: tokenize_function(x, tokenizer, padding),
+        batched=True,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing"
+    )
+    if packing_max_length:
+        dataset = dataset.map(
+            lambda x: pack_sequences(x, packing_max_length),
+            batched=True,
+            remove_columns=dataset.column_names,
+            desc="Packing"
+        )
+    return dataset
+
+# Code whose source is part of the tokenized dataset cache key; sft_data (packing) is hashed whole
+DATASET_CACHE_FUNCTIONS = (prepare_dataset, tokenize_function, build_tokenized_dataset, sft_data)
+
 def get_special_tokens():
     special_tokens = []
 
@@ -141,45 +184,56 @@ if __name__ == "__main__":
             if param.requires_grad:
                 print(f"  {name}: {param.shape}")
 
-    if training_args.local_rank == 0:
-        print("\\nLoading training dataset...")
+    # Tokenized (and packed) splits come from the dataset cache; the main process builds them on a miss
+    packing_max_length = script_args.packing_max_length if script_args.packing else 0
+    if script_args.packing:
+        prepare_model_for_packing(model)
+        # PackedDataCollator reads seq_lengths (and user_start), which the Trainer drops as unused columns
+        training_args.remove_unused_columns = False
+        if training_args.local_rank == 0:
+            print(f"Packing samples into rows of up to {packing_max_length} tokens")
+    cache_params = {"packing_max_length": packing_max_length}
 
-    train_dataset = prepare_dataset(train_data_path, local_rank=training_args.local_rank)
     if training_args.local_rank == 0:
-        print(f"Loaded raw train dataset, total samples: {len(train_dataset)}")
+        print("\\nLoading training dataset...")
+    if script_args.streaming:
+        if script_args.packing:
+            raise ValueError("--packing is not supported with --streaming")
+        train_dataset = make_streaming_dataset(
+            train_data_path, format_texts, training_args, script_args.stream_shuffle_window, ["description"]
+        )
+    else:
+        train_dataset = load_or_build_dataset(
+            script_args.dataset_cache_dir, train_data_path, tokenizer, TEMPLATE_VERSION,
+            lambda: build_tokenized_dataset(train_data_path, tokenizer, packing_max_length, training_args.local_rank),
+            DATASET_CACHE_FUNCTIONS, cache_params, training_args
+        )
+        if training_args.local_rank == 0:
+            print(f"Tokenized train dataset, total rows: {len(train_dataset)}")
 
     if training_args.local_rank == 0:
         print("\\nLoading validation dataset...")
-    val_dataset = prepare_dataset(val_data_path, local_rank=training_args.local_rank)
-    if training_args.local_rank == 0:
-        print(f"Loaded raw validation dataset, total samples: {len(val_dataset)}")
-
-    if training_args.local_rank == 0:
-        print("Tokenizing training dataset...")
-    train_dataset = train_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=train_dataset.column_names,
-        desc="Tokenizing training data"
-    )
-    if training_args.local_rank == 0:
-        print(f"Tokenized train dataset, total samples: {len(train_dataset)}")
-
-    if training_args.local_rank == 0:
-        print("Tokenizing validation dataset...")
-    val_dataset = val_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=val_dataset.column_names,
-        desc="Tokenizing validation data"
+    val_dataset = load_or_build_dataset(
+        script_args.dataset_cache_dir, val_data_path, tokenizer, TEMPLATE_VERSION,
+        lambda: build_tokenized_dataset(val_data_path, tokenizer, packing_max_length, training_args.local_rank),
+        DATASET_CACHE_FUNCTIONS, cache_params, training_args
     )
     if training_args.local_rank == 0:
-        print(f"Tokenized validation dataset, total samples: {len(val_dataset)}")
-
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
+        print(f"Tokenized validation dataset, total rows: {len(val_dataset)}")
+
+    if script_args.packing:
+        # Alignment trains on every token, so only sample starts and pad tokens are masked
+        data_collator = PackedDataCollator(tokenizer=tokenizer, mask_user_turn=False)
+    else:
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,
+        )
+    callbacks = [EarlyStoppingCallback(early_stopping_patience=2)]
+    if script_args.streaming:
+        # Training batches arrive as text; the validation split is already tokenized
+        data_collator = TokenizingCollator(tokenizer, tokenize_function, data_collator)
+        callbacks.append(StreamPositionCallback(train_dataset))
 
     trainer = Trainer(
         model=model,
@@ -187,7 +241,7 @@ if __name__ == "__main__":
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         data_collator=data_collator,
-        callbacks=[EarlyStoppingCallback(early_stopping_patience=2)],
+        callbacks=callbacks,
     )
 
     if training_args.local_rank == 0:
@@ -197,7 +251,7 @@ if __name__ == "__main__":
     
     if training_args.local_rank == 0:
         print("\\nStarting training...")
-    trainer.train()
+    trainer.train(resume_from_checkpoint=training_args.resume_from_checkpoint)
 
     if training_args.local_rank == 0:
         print("\\nFinal evaluation...")
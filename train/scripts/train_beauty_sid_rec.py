@@ -4,9 +4,7 @@ from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
-import pandas as pd
 import torch
-from datasets import Dataset
 from peft import LoraConfig, TaskType, get_peft_model
 from transformers import (
     AutoModelForCausalLM,
@@ -18,6 +16,21 @@ from transformers import (
     TrainingArguments,
 )
 
+import sft_data
+from dataset_cache import load_or_build_dataset
+from sft_data import (
+    CHAT_COLUMNS,
+    CustomDataCollator,
+    PackedDataCollator,
+    add_user_turn_starts,
+    chat_dataset_from_parquet,
+    format_chat_texts,
+    pack_sequences,
+    prepare_model_for_packing,
+    user_turn_marker_ids,
+)
+from streaming_data import StreamPositionCallback, TokenizingCollator, make_streaming_dataset
+
 @dataclass
 class ModelArguments:
     model_name_or_path: Optional[str] = field(
@@ -38,62 +51,85 @@ class ModelArguments:
 class DataArguments:
     train_data_path: str = "../data/training_prediction_sid_data_train.parquet"
     val_data_path: str = "../data/training_prediction_sid_data_val.parquet"
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Concatenate samples into rows of up to packing_max_length tokens (needs transformers>=4.53 or flash_attention_2)"}
+    )
+    packing_max_length: int = field(default=4096, metadata={"help": "Tokens per packed row"})
+    dataset_cache_dir: Optional[str] = field(
+        default="./tokenized_cache",
+        metadata={"help": "Directory of tokenized dataset caches shared across ranks and runs; empty to disable"}
+    )
+    stream_batch_rows: int = field(
+        default=0,
+        metadata={"help": "Build texts from the parquet file this many rows at a time via an on-disk dataset; 0 reads it whole"}
+    )
+    streaming: bool = field(
+        default=False,
+        metadata={"help": "Stream the training parquet file (or directory of files), tokenizing in the dataloader workers"}
+    )
+    stream_shuffle_window: int = field(
+        default=8192,
+        metadata={"help": "Rows shuffled together when streaming (row groups are shuffled too); 0 keeps file order"}
+    )
+
+# Bump when the chat template changes; part of the tokenized dataset cache key
+TEMPLATE_VERSION = "sid_rec-v1"
+
+def format_texts(table):
+    return format_chat_texts(table)
 
-def prepare_chat_dataset(data_path, sample_size=None, local_rank=0):
+
+def prepare_chat_dataset(data_path, sample_size=None, local_rank=0, stream_batch_rows=0):
     if local_rank == 0:
         print(f"Loading parquet file: {data_path}")
-    data_pq = pd.read_parquet(data_path)
-    if local_rank == 0:
-        print(f"Data shape: {data_pq.shape}")
-        print(f"Columns: {list(data_pq.columns)}")
+    dataset = chat_dataset_from_parquet(data_path, format_texts, sample_size, stream_batch_rows, local_rank)
 
-    if sample_size is not None and len(data_pq) > sample_size:
-        if local_rank == 0:
-            print(f"Sampling {sample_size} samples from {len(data_pq)} total samples")
-        data_pq = data_pq.head(sample_size)
-
-    texts = []
-    
-    system_message = "You are a professional recommendation expert who needs to recommend the next possible purchase for users based on their purchase history. Please predict the most likely next product that the user will purchase based on the user's historical purchase information."
-    
-    for _, row in data_pq.iterrows():
-        assistant_content = f"<think>\n\n</think>\n{row['groundtruth']}"
-
-        formatted_text = f"""<|im_start|>system
-{system_message}<|im_end|>
-<|im_start|>user
-{row['description']}<|im_end|>
-<|im_start|>assistant
-{assistant_content}<|im_end|>
-"""
-        texts.append(formatted_text)
-    
     if local_rank == 0:
-        print(f"Total texts: {len(texts)}")
+        print(f"Total texts: {len(dataset)}")
 
         print("\\nFirst 3 text examples:")
-        for i, text in enumerate(texts[:3]):
+        for i, text in enumerate(dataset[:3]['text']):
             print(f"  [{i}] Length: {len(text)} chars")
             print(f"  [{i}] Text: {text[:300]}...")
             print(f"      (Note: Loss calculated from <|im_start|>user onwards)")
             print()
-    
-    dataset_dict = {
-        'text': texts
-    }
-    return Dataset.from_dict(dataset_dict)
+    return dataset
 
 
-def tokenize_function(examples, tokenizer):
+def tokenize_function(examples, tokenizer, padding='longest'):
     tokenized = tokenizer(
         examples['text'],
-        padding='longest',
+        padding=padding,
         truncation=True,
         max_length=4096,
         add_special_tokens=True,
         return_attention_mask=True,
     )
-    return tokenized
+    return add_user_turn_starts(tokenized, user_turn_marker_ids(tokenizer))
+
+def build_tokenized_dataset(data_path, tokenizer, packing_max_length=0, local_rank=0, stream_batch_rows=0):
+    dataset = prepare_chat_dataset(data_path, local_rank=local_rank, stream_batch_rows=stream_batch_rows)
+    # Packed rows are built from unpadded samples
+    padding = False if packing_max_length else 'longest'
+    dataset = dataset.map(
+        lambda x: tokenize_function(x, tokenizer, padding),
+        batched=True,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing"
+    )
+    if packing_max_length:
+        dataset = dataset.map(
+            lambda x: pack_sequences(x, packing_max_length),
+            batched=True,
+            remove_columns=dataset.column_names,
+            desc="Packing"
+        )
+    return dataset
+
+# Code whose source is part of the tokenized dataset cache key; sft_data is hashed whole so its
+# constants (system message, user turn marker) and helpers count too
+DATASET_CACHE_FUNCTIONS = (format_texts, prepare_chat_dataset, tokenize_function, build_tokenized_dataset, sft_data)
 
 def get_special_tokens():
     special_tokens = []
@@ -108,57 +144,6 @@ def get_special_tokens():
     
     return special_tokens
 
-class CustomDataCollator:
-    def __init__(self, tokenizer, mlm=False):
-        self.tokenizer = tokenizer
-        self.mlm = mlm
-        
-    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
-        input_ids = [feature["input_ids"] for feature in features]
-        attention_mask = [feature["attention_mask"] for feature in features]
-
-        max_length = max(len(ids) for ids in input_ids)
-
-        padded_input_ids = []
-        padded_attention_mask = []
-        labels = []
-
-        for i, (ids, mask) in enumerate(zip(input_ids, attention_mask)):
-            padding_length = max_length - len(ids)
-            padded_ids = ids + [self.tokenizer.pad_token_id] * padding_length
-            padded_mask = mask + [0] * padding_length
-
-            label = padded_ids.copy()
-
-            text = self.tokenizer.decode(ids, skip_special_tokens=False)
-            user_start_pos = text.find("<|im_start|>user")
-
-            if user_start_pos != -1:
-                user_start_tokens = self.tokenizer.encode("<|im_start|>user", add_special_tokens=False)
-
-                for j in range(len(ids) - len(user_start_tokens) + 1):
-                    if ids[j:j+len(user_start_tokens)] == user_start_tokens:
-                        for k in range(j):
-                            label[k] = -100
-                        break
-                else:
-                    for k in range(len(label)):
-                        label[k] = -100
-            else:
-                for k in range(len(label)):
-                    label[k] = -100
-
-            padded_input_ids.append(padded_ids)
-            padded_attention_mask.append(padded_mask)
-            labels.append(label)
-        
-        return {
-            "input_ids": torch.tensor(padded_input_ids, dtype=torch.long),
-            "attention_mask": torch.tensor(padded_attention_mask, dtype=torch.long),
-            "labels": torch.tensor(labels, dtype=torch.long),
-        }
-
-
 if __name__ == "__main__":
     parser = HfArgumentParser((ModelArguments, DataArguments, TrainingArguments))
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
@@ -238,45 +223,57 @@ if __name__ == "__main__":
                 if param.requires_grad:
                     print(f"  {name}: {param.shape}")
 
-    if training_args.local_rank == 0:
-        print("\\nLoading training dataset...")
+    # Tokenized (and packed) splits come from the dataset cache; the main process builds them on a miss
+    packing_max_length = data_args.packing_max_length if data_args.packing else 0
+    if data_args.packing:
+        prepare_model_for_packing(model)
+        # PackedDataCollator reads seq_lengths (and user_start), which the Trainer drops as unused columns
+        training_args.remove_unused_columns = False
+        if training_args.local_rank == 0:
+            print(f"Packing samples into rows of up to {packing_max_length} tokens")
+    cache_params = {"packing_max_length": packing_max_length}
 
-    train_dataset = prepare_chat_dataset(train_data_path, local_rank=training_args.local_rank)
     if training_args.local_rank == 0:
-        print(f"Loaded raw train dataset, total samples: {len(train_dataset)}")
+        print("\\nLoading training dataset...")
+    if data_args.streaming:
+        if data_args.packing:
+            raise ValueError("--packing is not supported with --streaming")
+        train_dataset = make_streaming_dataset(
+            train_data_path, format_texts, training_args, data_args.stream_shuffle_window, CHAT_COLUMNS
+        )
+    else:
+        train_dataset = load_or_build_dataset(
+            data_args.dataset_cache_dir, train_data_path, tokenizer, TEMPLATE_VERSION,
+            lambda: build_tokenized_dataset(train_data_path, tokenizer, packing_max_length, training_args.local_rank,
+                                            data_args.stream_batch_rows),
+            DATASET_CACHE_FUNCTIONS, cache_params, training_args
+        )
+        if training_args.local_rank == 0:
+            print(f"Tokenized train dataset, total rows: {len(train_dataset)}")
 
     if training_args.local_rank == 0:
         print("\\nLoading validation dataset...")
-    val_dataset = prepare_chat_dataset(val_data_path, local_rank=training_args.local_rank)
-    if training_args.local_rank == 0:
-        print(f"Loaded raw validation dataset, total samples: {len(val_dataset)}")
-
-    if training_args.local_rank == 0:
-        print("Tokenizing training dataset...")
-    train_dataset = train_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=train_dataset.column_names,
-        desc="Tokenizing training data"
-    )
-    if training_args.local_rank == 0:
-        print(f"Tokenized train dataset, total samples: {len(train_dataset)}")
-
-    if training_args.local_rank == 0:
-        print("Tokenizing validation dataset...")
-    val_dataset = val_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=val_dataset.column_names,
-        desc="Tokenizing validation data"
+    val_dataset = load_or_build_dataset(
+        data_args.dataset_cache_dir, val_data_path, tokenizer, TEMPLATE_VERSION,
+        lambda: build_tokenized_dataset(val_data_path, tokenizer, packing_max_length, training_args.local_rank,
+                                        data_args.stream_batch_rows),
+        DATASET_CACHE_FUNCTIONS, cache_params, training_args
     )
     if training_args.local_rank == 0:
-        print(f"Tokenized validation dataset, total samples: {len(val_dataset)}")
-
-    data_collator = CustomDataCollator(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
+        print(f"Tokenized validation dataset, total rows: {len(val_dataset)}")
+
+    if data_args.packing:
+        data_collator = PackedDataCollator(tokenizer=tokenizer)
+    else:
+        data_collator = CustomDataCollator(
+            tokenizer=tokenizer,
+            mlm=False,
+        )
+    callbacks = [EarlyStoppingCallback(early_stopping_patience=5)]
+    if data_args.streaming:
+        # Training batches arrive as text; the validation split is already tokenized
+        data_collator = TokenizingCollator(tokenizer, tokenize_function, data_collator)
+        callbacks.append(StreamPositionCallback(train_dataset))
 
     trainer = Trainer(
         model=model,
@@ -284,7 +281,7 @@ if __name__ == "__main__":
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         data_collator=data_collator,
-        callbacks=[EarlyStoppingCallback(early_stopping_patience=5)],
+        callbacks=callbacks,
     )
 
     if training_args.local_rank == 0:
@@ -294,7 +291,7 @@ if __name__ == "__main__":
     
     if training_args.local_rank == 0:
         print("\\nStarting training...")
-    trainer.train()
+    trainer.train(resume_from_checkpoint=training_args.resume_from_checkpoint)
 
     if training_args.local_rank == 0:
         print("\\nFinal evaluation...")